@@ -32,9 +32,17 @@ __version__ = "0.4.0"
 
 
 import sys, os
+import time
+import json
+import select
+import cPickle as pickle
+import resource
+import threading
+import multiprocessing
 
 from datetime import datetime
 from cStringIO import StringIO
+from contextlib import contextmanager
 
 
 
@@ -106,6 +114,17 @@ class Logger(object):
             self.logfile.write('%s\n' % message)
 
 
+    def flush(self):
+        """
+        Flush the log channel.  Must be called before forking worker
+        processes so that buffered output is not written more than once and
+        by workers before they exit so that output is not lost.
+        """
+
+        if self.logfile:
+            self.logfile.flush()
+
+
 logger = Logger('')
 
 def create_logger(filename):
@@ -113,6 +132,315 @@ def create_logger(filename):
     logger = Logger(filename)
 
 
+def _child_cpu():
+    """
+    CPU time of all reaped child processes or None if other threads are
+    running, as their children would be counted too.
+    """
+
+    if threading.active_count() > 1:
+        return None
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return usage.ru_utime + usage.ru_stime
+
+
+def _cpu_delta(start):
+    end = _child_cpu()
+
+    if start is None or end is None:
+        return None
+
+    return end - start
+
+
+def _maxrss():
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+class Profiler(object):
+    """
+    Record wall time, CPU time of child processes and peak resident set size
+    of every step decorated with report and of the external commands run
+    within a step.  The child CPU time is process-wide and therefore only
+    recorded (else null) when no other threads run, e.g. not under a thread
+    pool.  The resident set sizes are the peaks over the lifetime of the
+    process and of its children when the step ends, not per step values.
+    Each record is appended as one JSON line to a records file
+    so that steps run in forked worker processes are collected too.  The
+    records can be aggregated into a summary or converted into a timeline.
+    The profiler is disabled until enable() is called.
+    """
+
+    def __init__(self):
+        self.filename = None
+        self._local = threading.local()
+
+
+    def enable(self, filename):
+        """
+        Start recording.
+
+        :param filename: name of the file the raw records are appended to
+        :type filename: str
+        """
+
+        self.filename = os.path.abspath(filename)
+        open(self.filename, 'w').close()
+
+
+    def _origin(self):
+        thread = threading.current_thread()
+
+        return {'pid': os.getpid(), 'tid': thread.ident,
+                'process': multiprocessing.current_process().name,
+                'thread': thread.name}
+
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+
+        return self._local.stack
+
+
+    def _write(self, record):
+        # a single write on an O_APPEND descriptor keeps lines from
+        # concurrent processes intact
+        fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+
+        try:
+            os.write(fd, json.dumps(record) + '\n')
+        finally:
+            os.close(fd)
+
+
+    @contextmanager
+    def step(self, molecule, stage):
+        """
+        Context manager recording a build step.
+
+        :param molecule: name of the molecule the step works on, None to
+                         inherit it from the enclosing step
+        :type molecule: str
+        :param stage: name of the step
+        :type stage: str
+        """
+
+        if not self.filename:
+            yield
+            return
+
+        stack = self._stack()
+
+        if molecule is None:
+            molecule = stack[-1]['molecule'] if stack else ''
+
+        record = {'type': 'step', 'molecule': molecule, 'stage': stage,
+                  'commands': []}
+        record.update(self._origin() )
+        stack.append(record)
+
+        start = time.time()
+        cpu = _child_cpu()
+
+        try:
+            yield
+        finally:
+            stack.pop()
+
+            record['start'] = start
+            record['wall'] = time.time() - start
+            record['cpu_children'] = _cpu_delta(cpu)
+            record['peak_rss_kb'], record['peak_rss_children_kb'] = _maxrss()
+
+            self._write(record)
+
+
+    @contextmanager
+    def command(self, cmdline):
+        """
+        Context manager recording an external command.  The command is
+        attributed to the innermost active step.
+
+        :param cmdline: the command line
+        :type cmdline: str or list
+        """
+
+        if not self.filename:
+            yield
+            return
+
+        if not isinstance(cmdline, basestring):
+            cmdline = ' '.join(cmdline)
+
+        stack = self._stack()
+        parent = stack[-1] if stack else {'molecule': '', 'stage': '',
+                                          'commands': []}
+
+        start = time.time()
+        cpu = _child_cpu()
+
+        try:
+            yield
+        finally:
+            record = {'type': 'command', 'molecule': parent['molecule'],
+                      'stage': parent['stage'], 'command': cmdline,
+                      'program': os.path.basename(cmdline.split()[0]),
+                      'start': start, 'wall': time.time() - start,
+                      'cpu_children': _cpu_delta(cpu),
+                      'peak_rss_children_kb': _maxrss()[1]}
+            record.update(self._origin() )
+
+            parent['commands'].append(cmdline)
+            self._write(record)
+
+
+    def _records(self):
+        with open(self.filename, 'r') as records:
+            for line in records:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+    def summary(self):
+        """
+        Aggregate the raw records per molecule and stage, and per external
+        program.
+
+        :returns: dictionary with lists 'stages' and 'programs'
+        :rtype: dict
+        """
+
+        stages = {}
+        programs = {}
+
+        for rec in self._records():
+            if rec['type'] == 'step':
+                key = (rec['molecule'], rec['stage'])
+
+                if key not in stages:
+                    stages[key] = {'molecule': key[0], 'stage': key[1],
+                                   'count': 0, 'wall': 0.0,
+                                   'cpu_children': 0.0, 'peak_rss_kb': 0,
+                                   'peak_rss_children_kb': 0, 'commands': []}
+
+                agg = stages[key]
+                agg['peak_rss_kb'] = max(agg['peak_rss_kb'],
+                                         rec['peak_rss_kb'])
+                agg['commands'].extend(rec['commands'])
+            else:
+                key = rec['program']
+
+                if key not in programs:
+                    programs[key] = {'program': key, 'count': 0,
+                                     'wall': 0.0, 'cpu_children': 0.0,
+                                     'peak_rss_children_kb': 0}
+
+                agg = programs[key]
+
+            agg['count'] += 1
+            agg['wall'] += rec['wall']
+            agg['peak_rss_children_kb'] = max(agg['peak_rss_children_kb'],
+                                              rec['peak_rss_children_kb'])
+
+            # unknown if any of the records has no child CPU time
+            if agg['cpu_children'] is None or rec['cpu_children'] is None:
+                agg['cpu_children'] = None
+            else:
+                agg['cpu_children'] += rec['cpu_children']
+
+        return {'stages': [stages[k] for k in sorted(stages)],
+                'programs': [programs[k] for k in sorted(programs)]}
+
+
+    def write_summary(self, filename):
+        """
+        Write the aggregated profile.  The format is CSV if filename ends in
+        .csv and JSON otherwise.  In CSV format only the per stage data is
+        written and the commands are separated by semicolons.
+
+        :param filename: output file name
+        :type filename: str
+        """
+
+        data = self.summary()
+
+        if filename.endswith('.csv'):
+            import csv
+
+            fields = ('molecule', 'stage', 'count', 'wall', 'cpu_children',
+                      'peak_rss_kb', 'peak_rss_children_kb', 'commands')
+
+            with open(filename, 'wb') as out:
+                writer = csv.DictWriter(out, fields)
+                writer.writeheader()
+
+                for row in data['stages']:
+                    row = dict(row, commands='; '.join(row['commands']) )
+                    writer.writerow(row)
+        else:
+            with open(filename, 'w') as out:
+                json.dump(data, out, indent=2, sort_keys=True)
+
+
+    def write_trace(self, filename):
+        """
+        Write the records as a timeline in the Trace Event Format understood
+        by chrome://tracing and Perfetto.  Every worker process and thread is
+        shown on its own track, external commands are nested in the step
+        which started them.
+
+        :param filename: output file name
+        :type filename: str
+        """
+
+        records = list(self._records() )
+        events = []
+        tracks = {}
+
+        t0 = min(rec['start'] for rec in records) if records else 0.0
+
+        for rec in records:
+            if rec['type'] == 'step':
+                name = rec['stage']
+                args = {'molecule': rec['molecule'],
+                        'peak_rss_kb': rec['peak_rss_kb']}
+            else:
+                name = rec['program']
+                args = {'molecule': rec['molecule'], 'stage': rec['stage'],
+                        'command': rec['command']}
+
+            if rec['molecule']:
+                name += ' ' + rec['molecule']
+
+            args['cpu_children'] = rec['cpu_children']
+
+            events.append({'name': name, 'cat': rec['type'], 'ph': 'X',
+                           'ts': (rec['start'] - t0) * 1e6,
+                           'dur': rec['wall'] * 1e6,
+                           'pid': rec['pid'], 'tid': rec['tid'],
+                           'args': args})
+
+            tracks[rec['pid'], rec['tid']] = (rec['process'], rec['thread'])
+
+        for (pid, tid), (process, thread) in tracks.items():
+            events.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                           'tid': tid, 'args': {'name': process} })
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                           'tid': tid, 'args': {'name': thread} })
+
+        with open(filename, 'w') as out:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, out)
+
+
+profiler = Profiler()
+
+
 class DirManager(object):
     """
     Context manager for controlled entry and exit of directories.
@@ -161,9 +489,114 @@ class CaptureOutput(object):
     return True
 
 
+def run_forked(func, jobs, nproc):
+    """
+    Run a function for every argument tuple in forked worker processes.
+    Forking also works from within pool workers which must not create
+    multiprocessing pools themselves.  The workers hold cores from the
+    budget of set_core_limit().  The jobs are run serially in this process
+    if other threads are running, e.g. in a thread pool, as forking is not
+    safe then.
+
+    :param func: the function
+    :type func: callable
+    :param jobs: argument tuples
+    :type jobs: list of tuples
+    :param nproc: maximum number of concurrent workers
+    :type nproc: int
+    :returns: (True, result) or (False, error message) for every job
+    :rtype: list of tuples
+    """
+
+    from FESetup.prepare.amber.utils import reserve_cores
+
+    results = [None] * len(jobs)
+    nproc = min(nproc, len(jobs) )
+
+    if nproc < 2 or threading.active_count() > 1:
+        for idx, args in enumerate(jobs):
+            try:
+                results[idx] = (True, func(*args) )
+            except Exception as why:
+                results[idx] = (False, str(why) )
+
+        return results
+
+    queue = list(enumerate(jobs) )
+    running = {}
+
+    with reserve_cores(nproc):
+        while queue or running:
+            while queue and len(running) < nproc:
+                idx, args = queue.pop(0)
+                rfd, wfd = os.pipe()
+                pid = os.fork()
+
+                if pid == 0:
+                    # the worker must never return into the caller's stack
+                    status = 1
+
+                    try:
+                        os.close(rfd)
+
+                        try:
+                            data = pickle.dumps( (True, func(*args) ), 2)
+                        except Exception as why:
+                            data = pickle.dumps( (False, str(why) ), 2)
+
+                        while data:
+                            data = data[os.write(wfd, data):]
+
+                        status = 0
+                    except BaseException:
+                        pass
+                    finally:
+                        os._exit(status)
+
+                os.close(wfd)
+                running[rfd] = (pid, idx, [])
+
+            for rfd in select.select(list(running), [], [])[0]:
+                chunk = os.read(rfd, 65536)
+
+                if chunk:
+                    running[rfd][2].append(chunk)
+                    continue
+
+                pid, idx, chunks = running.pop(rfd)
+                os.close(rfd)
+                os.waitpid(pid, 0)
+
+                try:
+                    results[idx] = pickle.loads(''.join(chunks) )
+                except (pickle.UnpicklingError, EOFError, ValueError):
+                    results[idx] = (False, 'worker process died')
+
+    return results
+
+
+def user_cache_dir(*subdirs):
+    """
+    Directory for persistent caches shared between runs: $FESETUP_CACHE_DIR
+    or ~/.cache/fesetup.
+
+    :param subdirs: subdirectories
+    :type subdirs: str
+    :returns: directory name, not necessarily existing
+    :rtype: str
+    """
+
+    topdir = os.environ.get('FESETUP_CACHE_DIR',
+                            os.path.join(os.path.expanduser('~'), '.cache',
+                                         'fesetup') )
+
+    return os.path.join(topdir, *subdirs)
+
+
 def report(func):
     """
     Primitive report decorator which signals start and end of a function.
+    The call is also recorded as a step by the profiler.
 
     .. py:decorator:: report
     
@@ -175,7 +608,10 @@ def report(func):
     def decorator(self, *args, **kwargs):
         logger.write('\n** Starting %s' % func.__name__)
 
-        ret = func(self, *args, **kwargs)
+        molecule = getattr(self, 'mol_name', None) or getattr(self, 'name', '')
+
+        with profiler.step(molecule, func.__name__):
+            ret = func(self, *args, **kwargs)
 
         logger.write('** Finished with %s\n' % func.__name__)
 
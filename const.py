@@ -77,6 +77,7 @@ CORR_CH_FILE = 'corr.ch'
 SQM_PDB_FILE = 'sqm.pdb'
 CONV_MOL2_FILE = 'ligand_conv' + os.extsep + '%s'
 LIGAND_TMP = 'ligand_tmp'
+LIBRARY_MOL_FILE = 'ligand_lib' + os.extsep + '%s'
 FREE_MOL2_FILE = 'ligand_free' + os.extsep + '%s'
 GB_PREFIX = 'gb_charge'
 GB_FRCMOD_FILE = GB_PREFIX + os.extsep + 'frcmod'
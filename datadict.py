@@ -151,7 +151,8 @@ class DataDict(dict):
         self.data = data
 
 
-    def add_files(self, files, hash_type='sha1', compression_type='bz2'):
+    def add_files(self, files, hash_type='sha1', compression_type='bz2',
+                  basedir=''):
         """
         Add a list of files to an internal tar(pax) archive.  A manifest is
         automatically created and contains the hashes of every file.  Hashes
@@ -165,6 +166,9 @@ class DataDict(dict):
         :type hash_type: string
         :param compression_type: the compression type (gz or bz2)
         :type compression_type: string
+        :param basedir: directory relative file names are taken from, the
+           names in the archive are not changed
+        :type basedir: string
         """
         
         memtar = cStringIO.StringIO()
@@ -175,16 +179,19 @@ class DataDict(dict):
                           fileobj = memtar) as tar:
 
             for name in files:
-                tinfo = tar.gettarinfo(name)
+                path = os.path.join(basedir, name)
+                tinfo = tar.gettarinfo(path, name)
                 hash_val = hashlib.new(hash_type)
 
-                with open(name, 'rb') as member:
+                with open(path, 'rb') as member:
                     hash_val.update(member.read())
 
                 hexdig = hash_val.hexdigest()
 
                 tinfo.pax_headers = {'comment': hexdig}
-                tar.addfile(tinfo, open(name, 'rb'))
+
+                with open(path, 'rb') as member:
+                    tar.addfile(tinfo, member)
 
                 manifest.append('%s  %s\n' % (hexdig, name) )
 
@@ -32,18 +32,75 @@ import sys
 import os
 import re
 import shutil
+import cPickle as pickle
 
-from FESetup import const, errors, logger, report
+from FESetup import const, errors, logger, report, profiler
 from . import util
 
 import Sire.IO
+import Sire.Mol
 
 
 REST_PDB_NAME = 'ligand_removed.pdb'
+RECORD_NAME = 'morph_record.pkl'
 COMPAT_TABLE = {'Sire': 'pertfile', 'AMBER': 'sander/dummy',
                 'AMBER/softcore': 'sander/softcore'}
 WD_TABLE = {'pertfile': 'sire'}
 
+# Sire objects held by Morph which are dropped by release()
+_SIRE_ATTRS = ('lig_morph', 'lig_initial', 'lig_final', 'atoms_initial',
+               'atoms_final', 'con_morph', 'connect_final')
+
+# attributes passed from Morph to PertTopology
+_TOPOL_ATTRS = ('ff', 'con_morph', 'atoms_initial', 'atoms_final',
+                'lig_initial', 'lig_final', 'atom_map', 'reverse_atom_map',
+                'zz_atoms')
+
+
+def _topology_state(topol):
+    """
+    Extract the state of a PertTopology without the objects shared with
+    Morph.  Nested topologies, e.g. the sander topology used for GROMACS, are
+    handled recursively.
+
+    :param topol: the perturbed topology
+    :type topol: PertTopology
+    :returns: class and attribute dictionary
+    :rtype: tuple
+    """
+
+    state = dict( (key, val) for key, val in vars(topol).items()
+                  if key not in _TOPOL_ATTRS)
+
+    if state.get('topol'):
+        state['topol'] = _topology_state(state['topol'])
+
+    return topol.__class__, state
+
+
+def _restore_topology(saved, attrs):
+    """
+    Recreate a PertTopology from the state extracted by _topology_state().
+
+    :param saved: class and attribute dictionary
+    :type saved: tuple
+    :param attrs: the objects shared with Morph
+    :type attrs: dict
+    :returns: the perturbed topology
+    :rtype: PertTopology
+    """
+
+    cls, state = saved
+
+    topol = cls.__new__(cls)
+    topol.__dict__.update(state)
+    topol.__dict__.update(attrs)
+
+    if state.get('topol'):
+        topol.topol = _restore_topology(state['topol'], attrs)
+
+    return topol
+
 
 class Morph(object):
     """The morphing class."""
@@ -146,23 +203,25 @@ class Morph(object):
         self.mcs_timeout = mcs_timeout
         self.mcs_sel = mcs_sel
 
+        self.record_file = os.path.join(self.dst, RECORD_NAME)
+        self.record = None
+        self.released = False
+
+        # fingerprint of the inputs, set by the caller for incremental builds
+        self.fingerprint = None
 
-    # context manager used to keep track of directory changes
+
+    # context manager kept for compatibility, all files are written to dst
+    # explicitly so the process working directory is never changed
     def __enter__(self):
-        """Enter directory dst."""
+        """Log the work directory dst."""
 
-        logger.write('Entering %s' % self.dst)
-        os.chdir(self.dst)
+        logger.write('Working in %s' % self.dst)
 
         return self
 
 
     def __exit__(self, typ, value, traceback):
-        """Leave directory dst and return to topdir."""
-
-        logger.write('Entering %s\n' % self.topdir)
-        os.chdir(self.topdir)
-
         return
 
 
@@ -178,6 +237,73 @@ class Morph(object):
         :raises: SetupError
         """
 
+        with profiler.step(None, 'read_states'):
+            lig_initial, lig_final = self._read_states()
+
+        # user tagging mechanism as per feature request #1074
+        if not isotope_map:
+            lig0_isomap_file = os.path.join(basedir,
+                                            self.name + os.extsep + 'map')
+
+            isotope_map = util.create_isotope_map(lig0_isomap_file)
+
+        if isotope_map:
+            logger.write('User supplied tagging map: %s' % isotope_map)
+
+        with profiler.step(None, 'map_atoms'):
+            (lig_morph, self.atom_map, self.reverse_atom_map) = \
+                    util.map_atoms(lig_initial, lig_final, self.mcs_timeout,
+                                   isotope_map, self.mcs_sel, self.dst)
+
+        self.files_created.append(const.MCS_MAP_FILE)
+
+        logger.write('\nAtom mapping between initial and final states:')
+
+        for i, f in self.atom_map.items():
+            logger.write("%s <--> %s" % (i.name, f.name) )
+
+        logger.write('')
+
+        self.dummy_idx = [inf.index for inf in self.atom_map if not inf.atom]
+
+        self._connect(lig_morph, lig_initial, lig_final)
+
+        logger.write('\nWriting perturbed topology for %s%s\n' %
+                     (self.FE_type, '/' + self.FE_sub_type if self.FE_sub_type
+                      else '') )
+
+        try:
+            topol = __import__('topol.' + self.FE_type, globals(), locals(),
+                               ['*'], -1)
+        except ImportError as detail:
+            sys.exit('Error: Unknown free energy type: %s' %
+                     self.FE_type)
+        except AttributeError as detail:
+            sys.exit('Error: %s\nFailed to properly initialize %s' %
+                     (detail, topol) )
+
+        topol = topol.PertTopology(self.FE_sub_type, self.separate,
+                                   self.ff, self.con_morph, self.atoms_initial,
+                                   self.atoms_final, self.lig_initial,
+                                   self.lig_final, self.atom_map,
+                                   self.reverse_atom_map, self.zz_atoms,
+                                   self.gaff)
+
+        topol.setup(self.dst, self.lig_morph, cmd1, cmd2)
+        self.files_created.extend(topol.files_created)
+
+        self.topol = topol
+
+
+    def _read_states(self):
+        """
+        Read the initial and final state ligands from their vacuum topologies.
+
+        :raises: SetupError
+        :returns: initial and final state ligand
+        :rtype: Sire.Mol.Molecule, Sire.Mol.Molecule
+        """
+
         initial_dir = os.path.join(self.topdir, const.LIGAND_WORKDIR,
                                    self.initial.mol_name)
         final_dir = os.path.join(self.topdir, const.LIGAND_WORKDIR,
@@ -218,30 +344,15 @@ class Morph(object):
 
         lig_final = molecules_final.at(nmol_f[0]).molecule()
 
-        # user tagging mechanism as per feature request #1074
-        if not isotope_map:
-            lig0_isomap_file = os.path.join(basedir,
-                                            self.name + os.extsep + 'map')
-
-            isotope_map = util.create_isotope_map(lig0_isomap_file)
-
-        if isotope_map:
-            logger.write('User supplied tagging map: %s' % isotope_map)
-
-        (lig_morph, self.atom_map, self.reverse_atom_map) = \
-                    util.map_atoms(lig_initial, lig_final, self.mcs_timeout,
-                                   isotope_map, self.mcs_sel)
-
-        self.files_created.append(const.MCS_MAP_FILE)
-
-        logger.write('\nAtom mapping between initial and final states:')
+        return lig_initial, lig_final
 
-        for i, f in self.atom_map.items():
-            logger.write("%s <--> %s" % (i.name, f.name) )
 
-        logger.write('')
-
-        self.dummy_idx = [inf.index for inf in self.atom_map if not inf.atom]
+    def _connect(self, lig_morph, lig_initial, lig_final):
+        """
+        Set up parameters and connectivities of the morph molecule and
+        create coordinates for the dummy atoms.  Requires the atom maps and
+        the dummy indices.
+        """
 
         atoms_initial = lig_initial.atoms()
         atoms_final = lig_final.atoms()
@@ -256,29 +367,6 @@ class Morph(object):
                                   self.reverse_atom_map, connect_final,
                                   self.zz_atoms, self.dummy_idx)
 
-        logger.write('\nWriting perturbed topology for %s%s\n' %
-                     (self.FE_type, '/' + self.FE_sub_type if self.FE_sub_type
-                      else '') )
-
-        try:
-            topol = __import__('topol.' + self.FE_type, globals(), locals(),
-                               ['*'], -1)
-        except ImportError as detail:
-            sys.exit('Error: Unknown free energy type: %s' %
-                     self.FE_type)
-        except AttributeError as detail:
-            sys.exit('Error: %s\nFailed to properly initialize %s' %
-                     (detail, topol) )
-
-        topol = topol.PertTopology(self.FE_sub_type, self.separate,
-                                   self.ff, con_morph, atoms_initial,
-                                   atoms_final, lig_initial, lig_final,
-                                   self.atom_map, self.reverse_atom_map,
-                                   self.zz_atoms, self.gaff)
-
-        topol.setup(os.getcwd(), lig_morph, cmd1, cmd2)
-        self.files_created.extend(topol.files_created)
-
         self.lig_morph = lig_morph
         self.lig_initial = lig_initial
         self.lig_final = lig_final
@@ -289,7 +377,116 @@ class Morph(object):
         self.con_morph = con_morph
         self.connect_final = connect_final
 
-        self.topol = topol
+
+    @report
+    def save_record(self):
+        """
+        Write a compact record of the morph to dst: the atom mapping, the
+        dummy indices, the zz atoms and the state of the perturbed topology
+        without any Sire objects.  From this the morph can be recreated with
+        rehydrate() without repeating the MCS search or the topology setup.
+
+        *Must* run after setup().
+        """
+
+        if not self.topol:
+            raise errors.SetupError('save_record(): setup() has not been run')
+
+        index_map = [(i.index.value(), f.index.value())
+                     for i, f in self.atom_map.items() if i.atom and f.atom]
+
+        record = {
+            'index_map': index_map,
+            'dummy_idx': [idx.value() for idx in self.dummy_idx],
+            'zz_atoms': [str(name.value() ) for name in self.zz_atoms],
+            'topol': _topology_state(self.topol),
+            'files_created': self.files_created
+            }
+
+        with open(self.record_file, 'wb') as rec:
+            pickle.dump(record, rec, pickle.HIGHEST_PROTOCOL)
+
+        self.record = self.record_file
+
+
+    def attach_record(self):
+        """
+        Use the record of a previous run instead of calling setup().  The
+        morph is marked as released and will be rehydrated from the record
+        when needed.
+
+        :raises: SetupError
+        """
+
+        if not os.path.isfile(self.record_file):
+            raise errors.SetupError('no morph record %s' % self.record_file)
+
+        logger.write('Using morph record %s' % self.record_file)
+
+        self.record = self.record_file
+        self.released = True
+
+
+    def release(self):
+        """
+        Drop all Sire objects to save memory.  They will be recreated from
+        the record on the next call of create_coords().
+
+        :raises: SetupError
+        """
+
+        if not self.record:
+            raise errors.SetupError('release(): no record saved for %s' %
+                                    self.name)
+
+        for attr in _SIRE_ATTRS:
+            setattr(self, attr, None)
+
+        self.atom_map = None
+        self.reverse_atom_map = None
+        self.dummy_idx = []
+        self.zz_atoms = []
+        self.topol = None
+
+        self.released = True
+
+
+    @report
+    def rehydrate(self):
+        """
+        Recreate the Sire objects from the record written by save_record().
+        The ligands are re-read from their vacuum topologies and the atom
+        mapping is rebuilt from the stored indices.
+
+        :raises: SetupError
+        """
+
+        try:
+            with open(self.record, 'rb') as rec:
+                record = pickle.load(rec)
+        except (IOError, TypeError, pickle.UnpicklingError) as why:
+            raise errors.SetupError('cannot read morph record %s: %s' %
+                                    (self.record, why) )
+
+        lig_initial, lig_final = self._read_states()
+
+        lig_morph, self.atom_map, self.reverse_atom_map = \
+                   util.morph_from_map(lig_initial, lig_final,
+                                       dict(record['index_map']) )
+
+        self.dummy_idx = [Sire.Mol.AtomIdx(idx) for idx in
+                          record['dummy_idx'] ]
+        self.zz_atoms = [Sire.Mol.AtomName(name) for name in
+                         record['zz_atoms'] ]
+        self.files_created = record['files_created']
+
+        self._connect(lig_morph, lig_initial, lig_final)
+
+        self.topol = _restore_topology(record['topol'],
+                                       dict( (attr, getattr(self, attr) )
+                                             for attr in _TOPOL_ATTRS) )
+
+        self.released = False
 
 
     @report
@@ -320,25 +517,29 @@ class Morph(object):
         :type sys_rev_path: str
         """
 
-        os.chdir(self.dst)        # FIXME: kludge to allow non-context use
-        curr_dir = os.getcwd()
+        if self.released:
+            self.rehydrate()
+
+        curr_dir = self.dst
 
         if type(system) != self.ff.Complex and \
                type(system) != self.ff.Ligand:
             raise errors.SetupError('create_coord(): system must be '
                                     'either Ligand or Complex')
 
-        if not os.access(workdir, os.F_OK):
-            os.mkdir(workdir)
+        sys_dir = os.path.join(curr_dir, workdir)
 
-        os.chdir(workdir)
+        if not os.access(sys_dir, os.F_OK):
+            os.mkdir(sys_dir)
 
         crd = os.path.join(sys_base, system.amber_crd)
         top = os.path.join(sys_base, system.amber_top)
 
-        if system.ssbond_file and not os.path.isfile(system.ssbond_file):
+        ssbond_file = os.path.join(sys_dir, system.ssbond_file)
+
+        if system.ssbond_file and not os.path.isfile(ssbond_file):
             os.symlink(os.path.join(sys_base, system.ssbond_file),
-                       system.ssbond_file)
+                       ssbond_file)
 
         if not crd:
             raise errors.SetupError('no suitable rst7 file found')
@@ -396,7 +597,7 @@ class Morph(object):
         # is in the center contrary to the prmtop which has it in one box
         # corner unless "set default nocenter on" is used (and coordinates
         # stay unmodified)
-        with open(REST_PDB_NAME, 'w') as pdb:
+        with open(os.path.join(sys_dir, REST_PDB_NAME), 'w') as pdb:
             moln = rest.molNums()
             moln.sort()
 
@@ -469,5 +670,3 @@ class Morph(object):
 
         self.topol.create_coords(curr_dir, workdir, self.lig_morph,
                                  REST_PDB_NAME, system, cmd1, cmd2, boxdims)
-
-        os.chdir(curr_dir)
@@ -146,6 +146,8 @@ class PertTopology(object):
 
         topol.setup(curr_dir, lig_morph, cmd1, cmd2)
 
+        wd = lambda filename: os.path.join(curr_dir, filename)
+
         lig0 = topol.lig0._parm_overwrite
         lig1 = topol.lig1._parm_overwrite
         top = topol.lig0.TOP_EXT
@@ -153,23 +155,26 @@ class PertTopology(object):
 
         # top0 and top1 written mainly for debugging purposes
         top0 = gromacs.GromacsTop()
-        top0.readParm(lig0 + top, lig0 + rst)
-        top0.writeTop(lig0 + const.GROMACS_ITP_EXT, lig0 + '.atp')
-        top0.writeGro(lig0 + const.GROMACS_GRO_EXT)
+        top0.readParm(wd(lig0 + top), wd(lig0 + rst) )
+        top0.writeTop(lig0 + const.GROMACS_ITP_EXT, lig0 + '.atp',
+                      workdir=curr_dir)
+        top0.writeGro(wd(lig0 + const.GROMACS_GRO_EXT) )
 
         top1 = gromacs.GromacsTop()
-        top1.readParm(lig1 + top, lig1 + rst)
-        top1.writeTop(lig1 + const.GROMACS_ITP_EXT, lig1 + '.atp')
-        top1.writeGro(lig1 + const.GROMACS_GRO_EXT)
+        top1.readParm(wd(lig1 + top), wd(lig1 + rst) )
+        top1.writeTop(lig1 + const.GROMACS_ITP_EXT, lig1 + '.atp',
+                      workdir=curr_dir)
+        top1.writeGro(wd(lig1 + const.GROMACS_GRO_EXT) )
 
         if self.FE_sub_type == 'dummy':
-            gromacs.mixer(top0, top1)
+            gromacs.mixer(top0, top1, wd(const.GROMACS_PERT_ITP),
+                          wd(const.GROMACS_PERT_ATP) )
 
             # FIXME: ugly kludges!
-            if not os.access(MORPH_GRO, os.F_OK):
-                os.symlink(lig0 + const.GROMACS_GRO_EXT, MORPH_GRO)
+            if not os.access(wd(MORPH_GRO), os.F_OK):
+                os.symlink(lig0 + const.GROMACS_GRO_EXT, wd(MORPH_GRO) )
 
-            with open(MORPH_TOP, 'w') as mtop:
+            with open(wd(MORPH_TOP), 'w') as mtop:
                 mtop.write(TOP_TMPL.format(title='one-step TI/FEP',
                                            atp=const.GROMACS_PERT_ATP,
                                            itp=const.GROMACS_PERT_ITP,
@@ -179,7 +184,7 @@ class PertTopology(object):
                                                             self.dummies1,
                                                             self.separate)
 
-            with open(VAC_MDP_FILE, 'w') as mdp:
+            with open(wd(VAC_MDP_FILE), 'w') as mdp:
                 mdp.write(
                     (VAC_MDP % (COMMON_MDP_TMPL,
                                 FE_TMPL)).format(nsteps='2000000',
@@ -197,28 +202,28 @@ class PertTopology(object):
             int_name = topol.int_state._parm_overwrite
 
             int_state = gromacs.GromacsTop()
-            int_state.readParm(int_name + top, int_name + rst)
+            int_state.readParm(wd(int_name + top), wd(int_name + rst) )
             int_state.writeTop(int_name + const.GROMACS_ITP_EXT,
-                               int_name + '.atp')
-            int_state.writeGro(int_name + const.GROMACS_GRO_EXT)
+                               int_name + '.atp', workdir=curr_dir)
+            int_state.writeGro(wd(int_name + const.GROMACS_GRO_EXT) )
 
-            gromacs.mixer(top0, int_state, PERT1_ITP, PERT1_ATP)
-            gromacs.mixer(int_state, top1, PERT2_ITP, PERT2_ATP)
+            gromacs.mixer(top0, int_state, wd(PERT1_ITP), wd(PERT1_ATP) )
+            gromacs.mixer(int_state, top1, wd(PERT2_ITP), wd(PERT2_ATP) )
 
             # FIXME: ugly kludges!
-            if not os.access(MORPH1_GRO, os.F_OK):
-                os.symlink(lig0 + const.GROMACS_GRO_EXT, MORPH1_GRO)
+            if not os.access(wd(MORPH1_GRO), os.F_OK):
+                os.symlink(lig0 + const.GROMACS_GRO_EXT, wd(MORPH1_GRO) )
 
-            if not os.access(MORPH2_GRO, os.F_OK):
-                os.symlink(lig1 + const.GROMACS_GRO_EXT, MORPH2_GRO)
+            if not os.access(wd(MORPH2_GRO), os.F_OK):
+                os.symlink(lig1 + const.GROMACS_GRO_EXT, wd(MORPH2_GRO) )
 
-            with open(MORPH1_TOP, 'w') as mtop:
+            with open(wd(MORPH1_TOP), 'w') as mtop:
                 mtop.write(TOP_TMPL.format(title='step 1/2: q_off and vdW '
                                            'on/off',
                                            atp=PERT1_ATP, itp=PERT1_ITP,
                                            ligname=const.LIGAND_NAME))
 
-            with open(MORPH2_TOP, 'w') as mtop:
+            with open(wd(MORPH2_TOP), 'w') as mtop:
                 mtop.write(TOP_TMPL.format(title='step 2/2: q_on',
                                            atp=PERT2_ATP, itp=PERT2_ITP,
                                            ligname=const.LIGAND_NAME))
@@ -231,7 +236,7 @@ class PertTopology(object):
                     '0.0 0.0 0.0')
             seps = 'step 1: q_off (disappearing) followed by vdW on/off'
 
-            with open(VAC1_MDP_FILE, 'w') as mdp:
+            with open(wd(VAC1_MDP_FILE), 'w') as mdp:
                 mdp.write(
                     (VAC_MDP % (COMMON_MDP_TMPL,
                                 FE_TMPL)).format(nsteps='2000000',
@@ -245,7 +250,7 @@ class PertTopology(object):
             masl = '0.0 0.0 0.0 0.0 0.0 0.0'
             seps = 'step 2: q_on (appearing)'
 
-            with open(VAC2_MDP_FILE, 'w') as mdp:
+            with open(wd(VAC2_MDP_FILE), 'w') as mdp:
                 mdp.write(
                     (VAC_MDP % (COMMON_MDP_TMPL,
                                 FE_TMPL)).format(nsteps='2000000',
@@ -275,22 +280,25 @@ class PertTopology(object):
         self.topol.create_coords(curr_dir, dir_name, lig_morph, pdb_file,
                                  system, cmd1, cmd2, boxdims)
 
+        sys_dir = os.path.join(curr_dir, dir_name)
+        wd = lambda filename: os.path.join(sys_dir, filename)
+
         if self.FE_sub_type == 'dummy':
             # FIXME: ugly kludge, assuming the file is one level up
-            if not os.access(const.GROMACS_PERT_ATP, os.F_OK):
+            if not os.access(wd(const.GROMACS_PERT_ATP), os.F_OK):
                 os.symlink('../%s' % const.GROMACS_PERT_ATP,
-                           '%s' % const.GROMACS_PERT_ATP)
+                           wd(const.GROMACS_PERT_ATP) )
 
-            if not os.access(const.GROMACS_PERT_ITP, os.F_OK):
+            if not os.access(wd(const.GROMACS_PERT_ITP), os.F_OK):
                 os.symlink('../%s' % const.GROMACS_PERT_ITP,
-                           '%s' % const.GROMACS_PERT_ITP)
+                           wd(const.GROMACS_PERT_ITP) )
 
 
             top = gromacs.GromacsTop()
             top.readParm(self.topol.parmtop, self.topol.inpcrd)
 
             # FIXME: need to reparse ATP file
-            with open(const.GROMACS_PERT_ATP, 'r') as atp:
+            with open(wd(const.GROMACS_PERT_ATP), 'r') as atp:
                 atomtypes = []
 
                 for line in atp:
@@ -299,13 +307,14 @@ class PertTopology(object):
                                        float(tmp[6]) ) )
 
             top.addAtomTypes(atomtypes)
-            top.writeTop(MORPH_TOP, '', const.LIGAND_NAME, False)
-            top.writeGro(MORPH_GRO)
+            top.writeTop(MORPH_TOP, '', const.LIGAND_NAME, False,
+                         workdir=sys_dir)
+            top.writeGro(wd(MORPH_GRO) )
 
             fepl, vdwl, masl, seps, sc_coul = _lambda_paths(self.dummies0,
                                                             self.dummies1,
                                                             self.separate)
-            with open(SOL_MDP_FILE, 'w') as mdp:
+            with open(wd(SOL_MDP_FILE), 'w') as mdp:
                 mdp.write(
                     (SOL_MDP % (COMMON_MDP_TMPL,
                                 FE_TMPL)).format(nsteps='500000',
@@ -316,24 +325,16 @@ class PertTopology(object):
                                                  sc_coul=sc_coul))
         elif self.FE_sub_type == 'dummy3':
             # FIXME: ugly kludge, assuming the file is one level up
-            if not os.access(PERT1_ATP, os.F_OK):
-                os.symlink('../%s' % PERT1_ATP, '%s' % PERT1_ATP)
-
-            if not os.access(PERT2_ATP, os.F_OK):
-                os.symlink('../%s' % PERT2_ATP, '%s' % PERT2_ATP)
-
-            if not os.access(PERT1_ITP, os.F_OK):
-                os.symlink('../%s' % PERT1_ITP, '%s' % PERT1_ITP)
-
-            if not os.access(PERT2_ITP, os.F_OK):
-                os.symlink('../%s' % PERT2_ITP, '%s' % PERT2_ITP)
+            for filename in (PERT1_ATP, PERT2_ATP, PERT1_ITP, PERT2_ITP):
+                if not os.access(wd(filename), os.F_OK):
+                    os.symlink('../%s' % filename, wd(filename) )
 
 
             top0 = gromacs.GromacsTop()
             top0.readParm(self.topol.parmtop0, self.topol.inpcrd0)
 
             # FIXME: need to reparse ATP file
-            with open(PERT1_ATP, 'r') as atp:
+            with open(wd(PERT1_ATP), 'r') as atp:
                 atomtypes = []
 
                 for line in atp:
@@ -343,8 +344,8 @@ class PertTopology(object):
 
             top0.addAtomTypes(atomtypes)
             top0.writeTop(MORPH1_TOP, PERT1_ATP, const.LIGAND_NAME, False,
-                          PERT1_ITP)
-            top0.writeGro(MORPH1_GRO)
+                          PERT1_ITP, workdir=sys_dir)
+            top0.writeGro(wd(MORPH1_GRO) )
 
             fepl = ('0.0 0.2 0.4 0.6 0.8 1.0 1.0 1.0 1.0 1.0 1.0 1.0 1.0 '
                     '1.0 1.0 1.0')
@@ -354,7 +355,7 @@ class PertTopology(object):
                     '0.0 0.0 0.0')
             seps = 'step 1: q_off (disappearing) followed by vdW on/off'
 
-            with open(SOL1_MDP_FILE, 'w') as mdp:
+            with open(wd(SOL1_MDP_FILE), 'w') as mdp:
                 mdp.write(
                     (SOL_MDP % (COMMON_MDP_TMPL,
                                 FE_TMPL)).format(nsteps='500000',
@@ -368,7 +369,7 @@ class PertTopology(object):
             top1.readParm(self.topol.parmtop1, self.topol.inpcrd1)
 
             # FIXME: need to reparse ATP file
-            with open(PERT2_ATP, 'r') as atp:
+            with open(wd(PERT2_ATP), 'r') as atp:
                 atomtypes = []
 
                 for line in atp:
@@ -378,14 +379,14 @@ class PertTopology(object):
 
             top1.addAtomTypes(atomtypes)
             top1.writeTop(MORPH2_TOP, PERT2_ATP, const.LIGAND_NAME, False,
-                          PERT2_ITP)
-            top1.writeGro(MORPH2_GRO)
+                          PERT2_ITP, workdir=sys_dir)
+            top1.writeGro(wd(MORPH2_GRO) )
 
             coul = '0.0 0.2 0.4 0.6 0.8 1.0'
             masl = '0.0 0.0 0.0 0.0 0.0 0.0'
             seps = 'step 2: q_on (appearing)'
 
-            with open(SOL2_MDP_FILE, 'w') as mdp:
+            with open(wd(SOL2_MDP_FILE), 'w') as mdp:
                 mdp.write(
                     (SOL_MDP % (COMMON_MDP_TMPL,
                                  FE_TMPL)).format(nsteps='500000',
@@ -37,6 +37,7 @@ from parmed.tools import change
 
 from FESetup import const, errors, logger
 from FESetup.mutate import util
+from FESetup.prepare.amber import leapcache
 
 
 
@@ -88,7 +89,7 @@ class PertTopology(object):
         # FIXME: Ligand class needs some redesign!
         lig = self.ff.Ligand(const.MORPH_NAME, start_file = mol2,
                              start_fmt = 'mol2', frcmod = self.frcmod,
-                             gaff=self.gaff)
+                             gaff=self.gaff, workdir=curr_dir)
 
         # prevent antechamber from running over the MOL2 file
         lig.set_atomtype(self.gaff)
@@ -100,7 +101,7 @@ class PertTopology(object):
         # To get the bonded parameters we reload the morph topolgy because
         # lig_morph does not have the "amberparameters" property. Would it be
         # possible to create those? We assume the ligand is the first molecule.
-        top, crd = lig.amber_top, lig.amber_crd
+        top, crd = lig._wd(lig.amber_top), lig._wd(lig.amber_crd)
 
         try:
             molecules = Sire.IO.Amber().readCrdTop(crd, top)[0]
@@ -118,7 +119,8 @@ class PertTopology(object):
                            'initial_LJ', 'final_LJ', 'initial_ambertype',
                            'final_ambertype', self.lig_initial,
                            self.lig_final, self.atoms_final, self.atom_map,
-                           self.reverse_atom_map, self.zz_atoms, False)
+                           self.reverse_atom_map, self.zz_atoms, False,
+                           workdir=curr_dir)
 
             self.files_created.extend(('onestep.parm7', 'onestep.rst7',
                                        const.MORPH_NAME + os.extsep + 'onestep'
@@ -130,26 +132,30 @@ class PertTopology(object):
                                'final_LJ', 'final_LJ', 'final_ambertype',
                                'final_ambertype', self.lig_initial,
                                self.lig_final, self.atoms_final, self.atom_map,
-                               self.reverse_atom_map, self.zz_atoms, True)
+                               self.reverse_atom_map, self.zz_atoms, True,
+                               workdir=curr_dir)
                 make_pert_file(lig_morph, new_morph, 'vdw',
                                'initial_charge', 'initial_charge',
                                'initial_LJ', 'final_LJ', 'initial_ambertype',
                                'final_ambertype', self.lig_initial,
                                self.lig_final, self.atoms_final, self.atom_map,
-                               self.reverse_atom_map, self.zz_atoms, False)
+                               self.reverse_atom_map, self.zz_atoms, False,
+                               workdir=curr_dir)
             else:
                 make_pert_file(lig_morph, new_morph, 'charge',
                                'initial_charge', 'final_charge',
                                'initial_LJ', 'initial_LJ', 'initial_ambertype',
                                'initial_ambertype', self.lig_initial,
                                self.lig_final, self.atoms_final, self.atom_map,
-                               self.reverse_atom_map, self.zz_atoms, True)
+                               self.reverse_atom_map, self.zz_atoms, True,
+                               workdir=curr_dir)
                 make_pert_file(lig_morph, new_morph, 'vdw',
                                'final_charge', 'final_charge',
                                'initial_LJ', 'final_LJ', 'initial_ambertype',
                                'final_ambertype', self.lig_initial,
                                self.lig_final, self.atoms_final, self.atom_map,
-                               self.reverse_atom_map, self.zz_atoms, False)
+                               self.reverse_atom_map, self.zz_atoms, False,
+                               workdir=curr_dir)
 
             self.files_created.extend(('charge.parm7', 'charge.rst7',
                                        const.MORPH_NAME + os.extsep +
@@ -163,21 +169,24 @@ class PertTopology(object):
                            'initial_LJ', 'initial_LJ', 'initial_ambertype',
                            'initial_ambertype', self.lig_initial,
                            self.lig_final, self.atoms_final, self.atom_map,
-                           self.reverse_atom_map, self.zz_atoms, False)
+                           self.reverse_atom_map, self.zz_atoms, False,
+                           workdir=curr_dir)
 
             make_pert_file(lig_morph, new_morph, 'vdw',
                            'zero_all', 'zero_all',
                            'initial_LJ', 'final_LJ', 'initial_ambertype',
                            'final_ambertype', self.lig_initial,
                            self.lig_final, self.atoms_final, self.atom_map,
-                           self.reverse_atom_map, self.zz_atoms, False)
+                           self.reverse_atom_map, self.zz_atoms, False,
+                           workdir=curr_dir)
 
             make_pert_file(lig_morph, new_morph, 'recharge',
                            'zero_all', 'final_charge',
                            'final_LJ', 'final_LJ', 'final_ambertype',
                            'final_ambertype', self.lig_initial,
                            self.lig_final, self.atoms_final, self.atom_map,
-                           self.reverse_atom_map, self.zz_atoms, False)
+                           self.reverse_atom_map, self.zz_atoms, False,
+                           workdir=curr_dir)
 
             self.files_created.extend(('decharge.parm7', 'decharge.rst7',
                                        const.MORPH_NAME + os.extsep +
@@ -189,7 +198,7 @@ class PertTopology(object):
                                        const.MORPH_NAME + os.extsep +
                                        'recharge' + os.extsep + 'pert'))
 
-        patch_element(lig.amber_top, lig_morph, self.lig_initial,
+        patch_element(lig._wd(lig.amber_top), lig_morph, self.lig_initial,
                       self.lig_final, self.atom_map)
 
     def create_coords(self, curr_dir, dir_name, lig_morph, pdb_file, system,
@@ -197,14 +206,15 @@ class PertTopology(object):
         """
         """
 
-        mol2 = os.path.join(curr_dir, dir_name, const.MORPH_NAME +
-                            const.MOL2_EXT)
+        sys_dir = os.path.join(curr_dir, dir_name)
+
+        mol2 = os.path.join(sys_dir, const.MORPH_NAME + const.MOL2_EXT)
         util.write_mol2(lig_morph, mol2, False, self.zz_atoms)
 
         # we should now have a new MOL2 with updated coordinates for the ligand
         # these will have to be 'pasted' into the system and new crd/top be
         # prepared
-        com = self.ff.Complex(pdb_file, mol2)
+        com = self.ff.Complex(pdb_file, mol2, sys_dir)
         com.box_dims = boxdims
         com.frcmod = self.frcmod
         com.ligand_fmt = 'mol2'
@@ -214,7 +224,7 @@ class PertTopology(object):
         # FIXME: we do that already in setup but calling create_coords
         #        from morph.py has not picked up on this
         lig_morph = finalise_morph(lig_morph, self.atoms_final, self.atom_map)
-        patch_element(com.amber_top, lig_morph, self.lig_initial,
+        patch_element(com._wd(com.amber_top), lig_morph, self.lig_initial,
                       self.lig_final, self.atom_map)
 
         com.lig_flex()
@@ -256,6 +266,8 @@ def patch_element(parmtop, lig_morph, lig_initial, lig_final, atom_map):
         mass_change = change(parm, 'MASS @%i %f' % (idx+1, mass))
         mass_change.execute()
 
+    # the topology may be a hardlink into the leap cache
+    leapcache.unshare(parmtop)
     parm.save(parmtop, format='amber', overwrite=True)
  
     return
@@ -363,7 +375,7 @@ def make_pert_file(old_morph, new_morph, stepname, qprop0, qprop1,
                    lig_initial, lig_final, atoms_final, atom_map,
                    reverse_atom_map, zz_atoms, qonly,
                    turnoffdummyangles=False, shrinkdummybonds=False,
-                   zero_dih_dummies=False):
+                   zero_dih_dummies=False, workdir=''):
 
     """
     Create a perturbation file for Sire.
@@ -407,6 +419,8 @@ def make_pert_file(old_morph, new_morph, stepname, qprop0, qprop1,
     :param zero_dih_dummies: use zero dihedrals and impropers when all atoms are
     dummies
     :type zero_dih_dummies: bool
+    :param workdir: directory to write the perturbation file to
+    :type workdir: str
     :raises: SetupError
     """
 
@@ -414,7 +428,7 @@ def make_pert_file(old_morph, new_morph, stepname, qprop0, qprop1,
     pert_fname = const.MORPH_NAME + os.extsep + stepname + os.extsep + 'pert'
     logger.write('Writing perturbation file %s...\n' % pert_fname)
 
-    pertfile = open(pert_fname, 'w')
+    pertfile = open(os.path.join(workdir, pert_fname), 'w')
 
     outstr = 'version 1\n'
     outstr += 'molecule %s\n' % (const.LIGAND_NAME)
@@ -102,7 +102,8 @@ class PertTopology(object):
             raise NotImplementedError
 
         amber.write_mdin(self.atoms_initial, self.atoms_final,
-                         self.atom_map, 'pmemd', self.FE_sub_type, True)
+                         self.atom_map, 'pmemd', self.FE_sub_type, True,
+                         curr_dir)
 
         mol2_0 = os.path.join(curr_dir, const.MORPH_NAME + '0' +
                               const.MOL2_EXT)
@@ -119,7 +120,7 @@ class PertTopology(object):
 
         lig = self.ff.Ligand(const.MORPH_NAME, start_file=mol2_0,
                              start_fmt='mol2', frcmod=frcmod0,
-                             gaff=self.gaff)
+                             gaff=self.gaff, workdir=curr_dir)
 
         lig.set_atomtype(self.gaff)
 
@@ -166,7 +167,7 @@ class PertTopology(object):
 
             lig = self.ff.Ligand(const.MORPH_NAME, start_file=mol2_0,
                                  start_fmt='mol2', frcmod=frcmod0,
-                                 gaff=self.gaff)
+                                 gaff=self.gaff, workdir=curr_dir)
             lig.set_atomtype(self.gaff)
 
             if self.dummies0:
@@ -185,7 +186,7 @@ class PertTopology(object):
 
             lig = self.ff.Ligand(const.MORPH_NAME, start_file=mol2_int,
                                  start_fmt='mol2', frcmod=frcmod1,
-                                 gaff=self.gaff)
+                                 gaff=self.gaff, workdir=curr_dir)
             lig.set_atomtype(self.gaff)
 
             if self.dummies1:
@@ -208,7 +209,7 @@ class PertTopology(object):
         elif self.FE_sub_type == 'softcore3' or self.FE_sub_type == 'dummy3':
             lig = self.ff.Ligand(const.MORPH_NAME, start_file=mol2_0,
                                  start_fmt='mol2', frcmod=frcmod0,
-                                 gaff=self.gaff)
+                                 gaff=self.gaff, workdir=curr_dir)
             lig.set_atomtype(self.gaff)
             lig._parm_overwrite = 'decharge'
 
@@ -222,7 +223,7 @@ class PertTopology(object):
 
             lig = self.ff.Ligand(const.MORPH_NAME, start_file=mol2_1,
                                  start_fmt='mol2', frcmod=frcmod1,
-                                 gaff=self.gaff)
+                                 gaff=self.gaff, workdir=curr_dir)
             lig.set_atomtype(self.gaff)
             lig._parm_overwrite = 'recharge'
 
@@ -247,11 +248,13 @@ class PertTopology(object):
 
         if self.FE_sub_type[:5] == 'dummy':
             for prm in patch_parms:
-                util.patch_parmtop(prm[0] + lig.TOP_EXT, "", prm[1], prm[2])
+                util.patch_parmtop(lig._wd(prm[0] + lig.TOP_EXT), "", prm[1],
+                                   prm[2])
 
 
     def create_coords(self, curr_dir, dir_name, lig_morph, pdb_file, system,
                       cmd1, cmd2, boxdims):
+        sys_dir = os.path.join(curr_dir, dir_name)
 
         patch_parms = []
 
@@ -269,7 +272,8 @@ class PertTopology(object):
             raise NotImplementedError
 
         amber.write_mdin(self.atoms_initial, self.atoms_final,
-                         self.atom_map, 'pmemd', self.FE_sub_type, False)
+                         self.atom_map, 'pmemd', self.FE_sub_type, False,
+                         sys_dir)
 
         mol2_0 = os.path.join(curr_dir, const.MORPH_NAME + '0' +
                               const.MOL2_EXT)
@@ -279,7 +283,7 @@ class PertTopology(object):
                               const.MOL2_EXT)
         util.write_mol2(state1, mol2_1, resname = const.LIGAND1_NAME)
 
-        com = self.ff.Complex(pdb_file, mol2_0)
+        com = self.ff.Complex(pdb_file, mol2_0, sys_dir)
         com.__class__.SSBONDS_OFFSET = 2 # FIXME: kludge
         com.box_dims = boxdims
         com.ligand_fmt = 'mol2'
@@ -321,7 +325,7 @@ class PertTopology(object):
                                     const.MOL2_EXT)
             util.write_mol2(int_state, mol2_int, resname = const.INT_NAME)
 
-            com = self.ff.Complex(pdb_file, mol2_0)
+            com = self.ff.Complex(pdb_file, mol2_0, sys_dir)
             com.__class__.SSBONDS_OFFSET = 2 # FIXME: kludge
             com.box_dims = boxdims
             com.ligand_fmt = 'mol2'
@@ -340,7 +344,7 @@ class PertTopology(object):
             com.leap.add_mol(mol2_int, 'mol2', [self.frcmod1])
             com.create_top(boxtype='set', addcmd=cmd1 + cmd2)
 
-            com = self.ff.Complex(pdb_file, mol2_int)
+            com = self.ff.Complex(pdb_file, mol2_int, sys_dir)
             com.__class__.SSBONDS_OFFSET = 2 # FIXME: kludge
             com.box_dims = boxdims
             com.ligand_fmt = 'mol2'
@@ -361,7 +365,7 @@ class PertTopology(object):
 
         # FIXME: residue name will be both the same
         elif self.FE_sub_type == 'softcore3' or self.FE_sub_type == 'dummy3':
-            com = self.ff.Complex(pdb_file, mol2_0)
+            com = self.ff.Complex(pdb_file, mol2_0, sys_dir)
             com.__class__.SSBONDS_OFFSET = 2 # FIXME: kludge
             com.box_dims = boxdims
             com.ligand_fmt = 'mol2'
@@ -372,7 +376,7 @@ class PertTopology(object):
             com.leap.add_mol(mol2_0, 'mol2', [self.frcmod0], pert=pert0)
             com.create_top(boxtype='set', addcmd=cmd1 + cmd2)
 
-            com = self.ff.Complex(pdb_file, mol2_1)
+            com = self.ff.Complex(pdb_file, mol2_1, sys_dir)
             com.__class__.SSBONDS_OFFSET = 2 # FIXME: kludge
             com.box_dims = boxdims
             com.ligand_fmt = 'mol2'
@@ -389,4 +393,5 @@ class PertTopology(object):
 
         if self.FE_sub_type[:5] == 'dummy':
             for prm in patch_parms:
-                util.patch_parmtop(prm[0] + com.TOP_EXT, "", prm[1], prm[2])
+                util.patch_parmtop(com._wd(prm[0] + com.TOP_EXT), "", prm[1],
+                                   prm[2])
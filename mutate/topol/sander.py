@@ -118,7 +118,8 @@ class PertTopology(object):
 
         if self.mdin:
             amber.write_mdin(self.atoms_initial, self.atoms_final,
-                             self.atom_map, 'sander', self.FE_sub_type, True)
+                             self.atom_map, 'sander', self.FE_sub_type, True,
+                             curr_dir)
 
         mol2_0 = os.path.join(curr_dir, const.MORPH_NAME + '0' +
                               const.MOL2_EXT)
@@ -128,7 +129,7 @@ class PertTopology(object):
 
         lig0 = self.ff.Ligand(const.MORPH_NAME, start_file=mol2_0,
                               start_fmt='mol2', frcmod=frcmod0,
-                              gaff=self.gaff)
+                              gaff=self.gaff, workdir=curr_dir)
 
         lig0.set_atomtype(self.gaff)
         lig0._parmchk(mol2_0, 'mol2', frcmod0)
@@ -149,7 +150,7 @@ class PertTopology(object):
 
         lig1 = self.ff.Ligand(const.MORPH_NAME, start_file=mol2_1,
                               start_fmt='mol2', frcmod=frcmod1,
-                              gaff=self.gaff)
+                              gaff=self.gaff, workdir=curr_dir)
 
         lig1.set_atomtype(self.gaff)
         lig1._parmchk(mol2_1, 'mol2', frcmod1)
@@ -186,7 +187,7 @@ class PertTopology(object):
 
             lig = self.ff.Ligand(const.MORPH_NAME, start_file=mol2_int,
                                  start_fmt='mol2', frcmod=frcmod0,
-                                 gaff=self.gaff)
+                                 gaff=self.gaff, workdir=curr_dir)
             lig.set_atomtype(self.gaff)
             lig._parm_overwrite = 'state_int'
 
@@ -194,8 +195,8 @@ class PertTopology(object):
             lig.create_top(boxtype='', addcmd=cmd1 + cmd2)
 
         if self.FE_sub_type == 'dummy' or self.FE_sub_type == 'dummy2':
-            top0 = lig0._parm_overwrite + lig0.TOP_EXT
-            top1 = lig1._parm_overwrite + lig1.TOP_EXT
+            top0 = lig0._wd(lig0._parm_overwrite + lig0.TOP_EXT)
+            top1 = lig1._wd(lig1._parm_overwrite + lig1.TOP_EXT)
 
             util.patch_parmtop(top0, top1, ':%s' % const.LIGAND_NAME, '')
 
@@ -210,16 +211,16 @@ class PertTopology(object):
 
             lig = self.ff.Ligand(const.MORPH_NAME, start_file=mol2_int,
                                  start_fmt='mol2', frcmod=frcmod1,
-                                 gaff=self.gaff)
+                                 gaff=self.gaff, workdir=curr_dir)
             lig.set_atomtype(self.gaff)
             lig._parm_overwrite = 'state_int'
 
             lig.prepare_top(pert=pert1_info)
             lig.create_top(boxtype='')
 
-            top0 = lig0._parm_overwrite + lig0.TOP_EXT
-            int_name = lig._parm_overwrite + lig.TOP_EXT
-            top1 = lig1._parm_overwrite + lig1.TOP_EXT
+            top0 = lig0._wd(lig0._parm_overwrite + lig0.TOP_EXT)
+            int_name = lig._wd(lig._parm_overwrite + lig.TOP_EXT)
+            top1 = lig1._wd(lig1._parm_overwrite + lig1.TOP_EXT)
 
             util.patch_parmtop(top0, int_name, ':%s' % const.LIGAND_NAME, '')
             util.patch_parmtop(int_name, top1, ':%s' % const.LIGAND_NAME, '')
@@ -229,6 +230,7 @@ class PertTopology(object):
 
     def create_coords(self, curr_dir, dir_name, lig_morph, pdb_file, system,
                       cmd1, cmd2, boxdims):
+        sys_dir = os.path.join(curr_dir, dir_name)
 
         if self.FE_sub_type[:8] == 'softcore':
             state0, state1 = \
@@ -249,13 +251,14 @@ class PertTopology(object):
 
         if self.mdin:
             amber.write_mdin(self.atoms_initial, self.atoms_final,
-                             self.atom_map, 'sander', self.FE_sub_type, False)
+                             self.atom_map, 'sander', self.FE_sub_type, False,
+                             sys_dir)
 
         mol2_0 = os.path.join(curr_dir, const.MORPH_NAME + '0' +
                               const.MOL2_EXT)
         util.write_mol2(state0, mol2_0)
 
-        com0 = self.ff.Complex(pdb_file, mol2_0)
+        com0 = self.ff.Complex(pdb_file, mol2_0, sys_dir)
         com0.box_dims = boxdims
         com0.ligand_fmt = 'mol2'
         com0.frcmod = self.frcmod0
@@ -274,7 +277,7 @@ class PertTopology(object):
                               const.MOL2_EXT)
         util.write_mol2(state1, mol2_1)
 
-        com1 = self.ff.Complex(pdb_file, mol2_1)
+        com1 = self.ff.Complex(pdb_file, mol2_1, sys_dir)
         com1.box_dims = boxdims
         com1.ligand_fmt = 'mol2'
         com1.frcmod = self.frcmod1
@@ -302,7 +305,7 @@ class PertTopology(object):
                                     const.MOL2_EXT)
             util.write_mol2(int_state, mol2_int, resname = const.INT_NAME)
 
-            com = self.ff.Complex(pdb_file, mol2_int)
+            com = self.ff.Complex(pdb_file, mol2_int, sys_dir)
             com.box_dims = boxdims
             com.ligand_fmt = 'mol2'
             com.frcmod = self.frcmod1
@@ -311,13 +314,13 @@ class PertTopology(object):
             com.create_top(boxtype='set', addcmd=cmd1 + cmd2)
 
         if self.FE_sub_type == 'dummy' or self.FE_sub_type == 'dummy2':
-            top0 = com0._parm_overwrite + com0.TOP_EXT
-            top1 = com1._parm_overwrite + com1.TOP_EXT
+            top0 = com0._wd(com0._parm_overwrite + com0.TOP_EXT)
+            top1 = com1._wd(com1._parm_overwrite + com1.TOP_EXT)
 
             util.patch_parmtop(top0, top1, ':%s' % const.LIGAND_NAME, '')
             
             self.parmtop = top0
-            self.inpcrd = com0._parm_overwrite + com0.RST_EXT
+            self.inpcrd = com0._wd(com0._parm_overwrite + com0.RST_EXT)
 
         if self.FE_sub_type == 'dummy3':  # for GROMACS and CHARMM
             ow_add = '_int'
@@ -328,7 +331,7 @@ class PertTopology(object):
                                     const.MOL2_EXT)
             util.write_mol2(int_mol, mol2_int, resname = const.LIGAND_NAME)
 
-            com = self.ff.Complex(pdb_file, mol2_int)
+            com = self.ff.Complex(pdb_file, mol2_int, sys_dir)
             com.box_dims = boxdims
             com.ligand_fmt = 'mol2'
             com.frcmod = self.frcmod1
@@ -341,15 +344,15 @@ class PertTopology(object):
 
             com.create_top(boxtype='set')
 
-            top0 = com0._parm_overwrite + com0.TOP_EXT
-            int_name = com._parm_overwrite + com.TOP_EXT
-            top1 = com1._parm_overwrite + com1.TOP_EXT
+            top0 = com0._wd(com0._parm_overwrite + com0.TOP_EXT)
+            int_name = com._wd(com._parm_overwrite + com.TOP_EXT)
+            top1 = com1._wd(com1._parm_overwrite + com1.TOP_EXT)
 
             util.patch_parmtop(top0, int_name, ':%s' % const.LIGAND_NAME, '')
             util.patch_parmtop(int_name, top1, ':%s' % const.LIGAND_NAME, '')
 
             self.parmtop0 = top0
-            self.inpcrd0 = com0._parm_overwrite + com0.RST_EXT
+            self.inpcrd0 = com0._wd(com0._parm_overwrite + com0.RST_EXT)
             self.parmtop1 = top1
-            self.inpcrd1 = com1._parm_overwrite + com1.RST_EXT
+            self.inpcrd1 = com1._wd(com1._parm_overwrite + com1.RST_EXT)
             self.int_state = com
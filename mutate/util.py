@@ -53,6 +53,7 @@ from parmed.amber.readparm import AmberParm
 import parmed.tools.actions as Action
 
 from FESetup import const, errors, logger
+from FESetup.prepare.amber import leapcache
 
 from FESetup.munkres import Munkres, print_matrix
 
@@ -229,7 +230,8 @@ else:
                    ringMatchesRingOnly = True, completeRingsOnly = True,
                    threshold = None)
 
-def mcss(mol2str_1, mol2str_2, maxtime=60, isotope_map=None, selec=''):
+def mcss(mol2str_1, mol2str_2, maxtime=60, isotope_map=None, selec='',
+         workdir=''):
     """
     Maximum common substructure search via RDKit/fmcs.
 
@@ -243,6 +245,8 @@ def mcss(mol2str_1, mol2str_2, maxtime=60, isotope_map=None, selec=''):
     :type isotope_map: dict
     :param selec: selection method for multiple MCS
     :type selec: string
+    :param workdir: directory to write the MCS files to
+    :type workdir: string
     :raises: SetupError
     :returns: index map
     :rtype: dict
@@ -481,9 +485,9 @@ def mcss(mol2str_1, mol2str_2, maxtime=60, isotope_map=None, selec=''):
 
     obmol1.EndModify()
 
-    conv.WriteFile(obmol1, const.MCS_MOL_FILE)
+    conv.WriteFile(obmol1, os.path.join(workdir, const.MCS_MOL_FILE) )
 
-    with open(const.MCS_MAP_FILE, 'wb') as pkl:
+    with open(os.path.join(workdir, const.MCS_MAP_FILE), 'wb') as pkl:
         pickle.dump(mapping.keys(), pkl, 0)
         pickle.dump(mapping.values(), pkl, 0)
 
@@ -511,7 +515,7 @@ def split_system(mols):
 
 
 def map_atoms(lig_initial, lig_final, timeout, isotope_map = None,
-              mcs_sel = ''):
+              mcs_sel = '', workdir = ''):
     """
     Compute the atom mapping between initial and final state using MCSS.
     Creates lig_morph, appends to atom_map and reverse_atom_map.
@@ -528,6 +532,8 @@ def map_atoms(lig_initial, lig_final, timeout, isotope_map = None,
     :type timeout: float
     :param isotope_map: explicit user atom mapping
     :type isotope_map: dict
+    :param workdir: directory to write the MCS files to
+    :type workdir: string
     :raises: SetupError
     :returns: morph molecule, forward map, reverse map
     :rtype: Sire.Mol.CutGroup, OrderedDict of Sire.Mol.AtomName to
@@ -626,11 +632,30 @@ def map_atoms(lig_initial, lig_final, timeout, isotope_map = None,
     #print (isotope_map)
     #import pdb ; pdb.set_trace()
     #sys.exit(-1)
-    index_map = mcss(mol1, mol2, timeout, isotope_map, mcs_sel)
+    index_map = mcss(mol1, mol2, timeout, isotope_map, mcs_sel, workdir)
 
     if not index_map:
         raise errors.SetupError('MCSS error')
 
+    return morph_from_map(lig_initial, lig_final, index_map)
+
+
+def morph_from_map(lig_initial, lig_final, index_map):
+    """
+    Create lig_morph, atom_map and reverse_atom_map from a known index map
+    between initial and final state, e.g. as computed by mcss().
+
+    :param lig_initial: the initial state molecule
+    :type lig_initial: Sire.Mol.Molecule
+    :param lig_final: the final state molecule
+    :type lig_final: Sire.Mol.Molecule
+    :param index_map: 0-based atom indices of the initial state mapping to
+       those of the final state
+    :type index_map: dict
+    :returns: morph molecule, forward map, reverse map
+    :rtype: Sire.Mol.CutGroup, OrderedDict of Sire.Mol.AtomName to
+      Sire.Mol.AtomName, OrderedDict of Sire.Mol.AtomName to Sire.Mol.AtomName
+    """
 
     # NOTE: lig_morph = Sire.Mol.Molecule(lig_initial) would create a new
     #       molecule including all properties, but in adding new atoms below
@@ -1436,10 +1461,12 @@ def patch_parmtop(parm0_fn, parm1_fn, mask0, mask1, copy_dih=True):
     _add_improper(impropers1, impropers0, parm0)
 
     #parm0.overwrite = True
+    leapcache.unshare(parm0_fn)
     parm0.write_parm(parm0_fn)
 
     if not pmemd:
         #parm1.overwrite = True
+        leapcache.unshare(parm1_fn)
         parm1.write_parm(parm1_fn)
 
 
@@ -0,0 +1,157 @@
+#  Copyright (C) 2017  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r"""
+Reader and writer for the antechamber AC file format.  Only the charges and
+coordinates can be modified, all other records are written back unchanged.
+"""
+
+__revision__ = "$Id$"
+
+
+from collections import namedtuple
+
+from FESetup import errors
+
+
+
+# fixed columns of the ATOM record as written by antechamber
+_NAME = slice(13, 17)
+_RESNAME = slice(17, 21)
+_RESNUM = slice(21, 26)
+_X = slice(26, 38)
+_Y = slice(38, 46)
+_Z = slice(46, 54)
+_CHARGE = slice(54, 64)
+_TYPE = slice(64, None)
+
+ACAtom = namedtuple('ACAtom', 'name, resname, resnum, x, y, z, charge, type')
+
+
+class ACFile(object):
+    """
+    An antechamber AC file.
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: name of the AC file
+        :type filename: str
+        :raises: SetupError
+        """
+
+        self.filename = filename
+        self.lines = []
+        self.atoms = []
+        self._atom_lines = []
+
+        try:
+            with open(filename, 'r') as acfile:
+                for line in acfile:
+                    if line.startswith('ATOM'):
+                        self._atom_lines.append(len(self.lines) )
+                        self.atoms.append(self._parse_atom(line) )
+
+                    self.lines.append(line)
+        except IOError as why:
+            raise errors.SetupError('cannot read AC file: %s' % why)
+        except ValueError as why:
+            raise errors.SetupError('malformed ATOM record in %s: %s' %
+                                    (filename, why) )
+
+
+    @staticmethod
+    def _parse_atom(line):
+        return ACAtom(line[_NAME].strip(), line[_RESNAME].strip(),
+                      int(line[_RESNUM]), float(line[_X]), float(line[_Y]),
+                      float(line[_Z]), float(line[_CHARGE]),
+                      line[_TYPE].strip() )
+
+
+    @property
+    def charges(self):
+        """The atom charges."""
+
+        return [atom.charge for atom in self.atoms]
+
+
+    def set_charges(self, charges):
+        """
+        Replace the atom charges.  The total charge in the CHARGE record is
+        updated accordingly.
+
+        :param charges: the new charges, one per atom
+        :type charges: list of float
+        :raises: SetupError
+        """
+
+        if len(charges) != len(self.atoms):
+            raise errors.SetupError('%i charges given for %i atoms in %s' %
+                                    (len(charges), len(self.atoms),
+                                     self.filename) )
+
+        for idx, (lineno, charge) in enumerate(zip(self._atom_lines,
+                                                   charges) ):
+            line = self.lines[lineno]
+            self.lines[lineno] = (line[:_CHARGE.start] + '%10.6f' % charge +
+                                  line[_CHARGE.stop:])
+            self.atoms[idx] = self.atoms[idx]._replace(charge=charge)
+
+        total = sum(charges)
+
+        for lineno, line in enumerate(self.lines):
+            if line.startswith('CHARGE'):
+                self.lines[lineno] = 'CHARGE%10.2f ( %i )\n' % \
+                                     (total, int(round(total) ) )
+                break
+
+
+    def set_coordinates(self, coords):
+        """
+        Replace the atom coordinates.
+
+        :param coords: the new coordinates, one 3-tuple per atom
+        :type coords: list of 3-tuples of float
+        :raises: SetupError
+        """
+
+        if len(coords) != len(self.atoms):
+            raise errors.SetupError('%i coordinates given for %i atoms in %s'
+                                    % (len(coords), len(self.atoms),
+                                       self.filename) )
+
+        for idx, (lineno, (x, y, z) ) in enumerate(zip(self._atom_lines,
+                                                       coords) ):
+            line = self.lines[lineno]
+            self.lines[lineno] = (line[:_X.start] +
+                                  '%12.3f%8.3f%8.3f' % (x, y, z) +
+                                  line[_Z.stop:])
+            self.atoms[idx] = self.atoms[idx]._replace(x=x, y=y, z=z)
+
+
+    def write(self, filename):
+        """
+        Write the AC file.
+
+        :param filename: output file name
+        :type filename: str
+        """
+
+        with open(filename, 'w') as acfile:
+            acfile.writelines(self.lines)
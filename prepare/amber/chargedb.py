@@ -0,0 +1,229 @@
+#  Copyright (C) 2017  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r"""
+Persistent store of ligand charges.  Deriving AM1/BCC or GB charges with
+antechamber and sqm is the most expensive step of the ligand setup.  The
+store is an SQLite database which may be shared between projects.  Entries
+are keyed by the canonical connectivity and input geometry of the ligand,
+the net charge, the GAFF version and the charge method and hold the final AC
+file with the symmetrised charges.
+"""
+
+__revision__ = "$Id$"
+
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from collections import namedtuple
+
+import openbabel as ob
+
+
+
+# waiting time for concurrent writers
+_TIMEOUT = 120.0
+# coordinates are compared at this precision
+_COORD_FMT = '%.3f %.3f %.3f'
+
+_SCHEMA = '''\
+CREATE TABLE IF NOT EXISTS charges (
+  key TEXT PRIMARY KEY,
+  smiles TEXT,
+  charge REAL,
+  gaff TEXT,
+  method TEXT,
+  charges TEXT,
+  ac TEXT,
+  ac_orig TEXT,
+  created REAL,
+  used REAL
+)'''
+
+ChargeEntry = namedtuple('ChargeEntry', 'smiles, charge, charges, ac, '
+                         'ac_orig')
+
+
+def structure_key(filename, fmt):
+    """
+    Compute the canonical SMILES and a hash of the atom names, elements and
+    coordinates of a molecule.
+
+    :param filename: structure file name
+    :type filename: str
+    :param fmt: file format
+    :type fmt: str
+    :returns: canonical SMILES and hex digest of the geometry
+    :rtype: str, str
+    """
+
+    conv = ob.OBConversion()
+    conv.SetInAndOutFormats(fmt, 'can')
+    mol = ob.OBMol()
+
+    if not conv.ReadFile(mol, filename):
+        return None, None
+
+    smiles = conv.WriteString(mol).split()[0]
+    digest = hashlib.sha1()
+
+    for atom in ob.OBMolAtomIter(mol):
+        res = atom.GetResidue()
+        name = res.GetAtomID(atom).strip() if res else ''
+
+        digest.update('%s %i ' % (name, atom.GetAtomicNum() ) )
+        digest.update(_COORD_FMT % (atom.GetX(), atom.GetY(), atom.GetZ() ) +
+                      '\n')
+
+    return smiles, digest.hexdigest()
+
+
+class ChargeStore(object):
+    """
+    SQLite database of ligand charges.  A connection is opened for every
+    access so that the store can be used from threads and forked worker
+    processes.
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: database file name, created if it does not exist
+        :type filename: str
+        """
+
+        self.filename = os.path.abspath(filename)
+
+        with self._connect() as conn:
+            conn.execute(_SCHEMA)
+
+
+    def _connect(self):
+        conn = sqlite3.connect(self.filename, timeout=_TIMEOUT)
+        conn.text_factory = str
+
+        return conn
+
+
+    def key(self, filename, fmt, charge, gaff, method, options=''):
+        """
+        Compute the key of a ligand.
+
+        :param filename: structure file name
+        :type filename: str
+        :param fmt: file format
+        :type fmt: str
+        :param charge: net molecular charge
+        :type charge: float
+        :param gaff: GAFF version
+        :type gaff: str
+        :param method: charge method
+        :type method: str
+        :param options: further options affecting the charges e.g. the sqm
+                        strategy
+        :type options: str
+        :returns: key and canonical SMILES or None, None if the structure
+                  cannot be read
+        :rtype: str, str
+        """
+
+        smiles, geometry = structure_key(filename, fmt)
+
+        if not smiles:
+            return None, None
+
+        data = json.dumps( (smiles, geometry, int(round(charge) ), gaff,
+                            method, options,
+                            os.path.realpath(os.environ.get('AMBERHOME',
+                                                            '') ) ) )
+
+        return hashlib.sha1(data).hexdigest(), smiles
+
+
+    def fetch(self, key):
+        """
+        Look up the charges of a ligand.
+
+        :param key: key as computed by key()
+        :type key: str
+        :returns: the stored entry or None
+        :rtype: ChargeEntry
+        """
+
+        with self._connect() as conn:
+            row = conn.execute('SELECT smiles, charge, charges, ac, ac_orig '
+                               'FROM charges WHERE key = ?',
+                               (key, ) ).fetchone()
+
+            if not row:
+                return None
+
+            conn.execute('UPDATE charges SET used = ? WHERE key = ?',
+                         (time.time(), key) )
+
+        return ChargeEntry(row[0], row[1], json.loads(row[2]), row[3], row[4])
+
+
+    def add(self, key, smiles, charge, gaff, method, charges, ac, ac_orig):
+        """
+        Add the charges of a ligand.  An existing entry is kept.
+
+        :param key: key as computed by key()
+        :type key: str
+        :param smiles: canonical SMILES
+        :type smiles: str
+        :param charge: total charge
+        :type charge: float
+        :param gaff: GAFF version
+        :type gaff: str
+        :param method: charge method
+        :type method: str
+        :param charges: the symmetrised atom charges
+        :type charges: list of float
+        :param ac: contents of the AC file with the final charges
+        :type ac: str
+        :param ac_orig: contents of the AC file as created by antechamber
+        :type ac_orig: str
+        """
+
+        now = time.time()
+
+        with self._connect() as conn:
+            conn.execute('INSERT OR IGNORE INTO charges VALUES '
+                         '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         (key, smiles, charge, gaff, method,
+                          json.dumps(charges), ac, ac_orig, now, now) )
+
+
+store = None
+
+
+def configure(filename):
+    """
+    Set up the charge store.
+
+    :param filename: database file name, no store if empty
+    :type filename: str
+    """
+
+    global store
+
+    store = ChargeStore(filename) if filename else None
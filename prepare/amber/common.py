@@ -37,17 +37,28 @@ __revision__ = "$Id$"
 
 
 import os, sys, re, shutil
+import numpy as np
 import openbabel as ob
 import pybel
 
 import utils                            # relative import
-from FESetup import const, errors, logger, report
+from FESetup import const, errors, logger, report, profiler
 from leap import Leap
+from parm7 import Parm7, read_rst7_box, box_volume
 
 import Sire.IO
 
 
 
+def _stage_name(kind, namelist):
+    """Name of an MD stage for the profiler: kind and protocol name."""
+
+    if namelist.startswith('%'):
+        return '%s %s' % (kind, namelist[1:].lower() )
+
+    return '%s custom' % kind
+
+
 def ssbonds(ss_file, offset=0):
     """
     Read file with SS-bond information.
@@ -119,14 +130,18 @@ class Common(object):
         return object.__new__(cls)
 
 
-    def __init__(self, mol_name):
+    def __init__(self, mol_name, workdir=None):
         """
         :param mol_name: (file) name of molecules
         :type mol_name: string
+        :param workdir: directory in which all files are read and written and
+           all external programs are run, the current directory if None
+        :type workdir: string
         :raises: SetupError
         """
 
         self.mol_name = mol_name
+        self.workdir = workdir
         self.mol_file = ''
         self.mol_fmt = ''
 
@@ -158,36 +173,54 @@ class Common(object):
         #self.solvent_box, self.MDEngine, self.parmchk_version, self.gaff
 
 
+    def _wd(self, filename):
+        """
+        Resolve a file name relative to the working directory.  Absolute
+        file names are returned unchanged.
+
+        :param filename: the file name
+        :type filename: string
+        :returns: the file name as seen from the current directory
+        """
+
+        if self.workdir:
+            return os.path.join(self.workdir, filename)
+
+        return filename
+
+
     # FIXME: remove
-    @staticmethod
-    def copy_files(srcs, filenames=None, overwrite=False):
+    def copy_files(self, srcs, filenames=None, overwrite=False):
         """
-        Copy files from basedir to the current directory.
+        Copy files from basedir to the working directory.
 
         :param src: the source directories to copy from
         :type src: list of str
         :param filenames: the filenames to be copied
         :type filenames: list of str
-        :param overwrite: overwrite the files in the current dir?
+        :param overwrite: overwrite the files in the working dir?
         :type overwrite: bool
         """
 
+        dst = self._wd('.')
+
         try:
             for src in srcs:
                 logger.write('%sopying directory contents of %s to %s' %
                              ('Overwrite mode: c' if overwrite else 'C', src,
-                              os.getcwd()))
+                              os.path.abspath(dst)))
 
                 if not filenames:
                     filenames = os.listdir(src)
 
                 for filename in filenames:
-                    if overwrite or not os.access(filename, os.F_OK):
+                    if overwrite or not os.access(self._wd(filename),
+                                                  os.F_OK):
                         src_file = os.path.join(src, filename)
 
                         # FIXME: only here to accommodate Complex
                         if os.access(src_file, os.F_OK):
-                            shutil.copy(src_file, '.')
+                            utils.place_file(src_file, dst)
 
         except OSError as why:
             raise errors.SetupError(why)
@@ -216,8 +249,9 @@ class Common(object):
 
         leapin = self.leap.generate_init()
 
-        if os.access(const.SSBOND_FILE, os.R_OK):
-            pairs = ssbonds(const.SSBOND_FILE, self.__class__.SSBONDS_OFFSET)
+        if os.access(self._wd(const.SSBOND_FILE), os.R_OK):
+            pairs = ssbonds(self._wd(const.SSBOND_FILE),
+                            self.__class__.SSBONDS_OFFSET)
             cmd = []
 
             for a, b in pairs:
@@ -332,7 +366,8 @@ class Common(object):
         self.mdengine = self.MDEngine(self.amber_top, self.amber_crd,
                                       self.sander_crd, self.sander_rst,
                                       self.amber_pdb, self.box_dims,
-                                      self.solvent, mdprog, mdpref, mdpost)
+                                      self.solvent, mdprog, mdpref, mdpost,
+                                      workdir=self.workdir)
 
 
     @report
@@ -359,7 +394,9 @@ class Common(object):
             raise errors.SetupError('Topology and/or coordinates missing.  '
                                     'Please run amber_create_top first.')
 
-        self.mdengine.minimize(namelist, nsteps, ncyc, restraint, restr_force)
+        with profiler.step(None, _stage_name('min', namelist) ):
+            self.mdengine.minimize(namelist, nsteps, ncyc, restraint,
+                                   restr_force)
         self.amber_crd = self.mdengine.sander_crd  # FIXME: only for AMBER
 
 
@@ -397,8 +434,9 @@ class Common(object):
             raise errors.SetupError('No namelist supplied.')
 
         # FIXME: clean up nrestr to be consistent between MD programs
-        self.mdengine.md(namelist, nsteps, T, p, restraint, restr_force,
-                         nrestr, wrap)
+        with profiler.step(None, _stage_name('md', namelist) ):
+            self.mdengine.md(namelist, nsteps, T, p, restraint, restr_force,
+                             nrestr, wrap)
 
         # FIXME: do we also want to density?
         self.box_dims = self.mdengine.get_box_dims()
@@ -446,7 +484,8 @@ class Common(object):
                      ', '.join(const.AROMATICS) )
 
         amber = Sire.IO.Amber()
-        molecules = amber.readCrdTop(self.amber_crd, self.amber_top)[0]
+        molecules = amber.readCrdTop(self._wd(self.amber_crd),
+                                     self._wd(self.amber_top))[0]
 
         zmat_maker = Sire.IO.ZmatrixMaker()
         protein_zmatrices = os.path.join(Sire.Config.parameter_directory,
@@ -505,7 +544,7 @@ class Common(object):
             molec = curr_mol.edit().setProperty('coordinates', ncoor).commit()
             newmols.add(molec)
 
-        Sire.IO.PDB().write(newmols, const.FLAT_RINGS_FILE)
+        Sire.IO.PDB().write(newmols, self._wd(const.FLAT_RINGS_FILE))
 
         self.amber_pdb = const.FLAT_RINGS_FILE
         self.mol_file = self.amber_pdb
@@ -524,42 +563,25 @@ class Common(object):
         if not filename:
             filename = self.sander_rst
 
-        with open(filename, 'r') as rst:
-            for line in rst:
-                self.box_dims = line
-
-        self.box_dims = self.box_dims.split()
+        self.box_dims = utils.last_line(self._wd(filename) ).split()
 
 
     # called in common.py/_amber_top_common (1x)
     def get_box_info(self):
         """
-        Use Sire to get information about the system: volume, density,
-        box dimensions.
-
-        NOTE: Sire prmtop reader is slow!
+        Get information about the system: volume, density, box dimensions.
+        The masses are taken from the topology and the box from the last
+        line of the coordinate file.
         """
 
-        # Sire.Mol.Molecules, Sire.Vol.PeriodicBox or Sire.Vol.Cartesian
-        molecules, space = \
-                   Sire.IO.Amber().readCrdTop(self.amber_crd, self.amber_top)
-
-        if space.isPeriodic():
-            self.volume = space.volume().value()  # in A^3
-
-            # NOTE: currently rectangular box only
-            x = space.dimensions().x()
-            y = space.dimensions().y()
-            z = space.dimensions().z()
-            self.box_dims = (x, y, z)   # in Angstrom
- 
-            total_mass = 0.0            # in amu
-            
-            for num in molecules.molNums():
-                mol = molecules.at(num).molecule()
-
-                for atom in mol.atoms():
-                    total_mass += atom.property('mass').value()
+        parm = Parm7(self._wd(self.amber_top) )
+
+        if parm.has_box:
+            box = read_rst7_box(self._wd(self.amber_crd) )
+            self.volume = box_volume(box)   # in A^3
+            self.box_dims = tuple(box[:3])  # in Angstrom
+
+            total_mass = np.array(parm.get('MASS'), dtype=np.float64).sum()
 
             # in g/cc
             self.density = total_mass * const.AMU2GRAMS / self.volume
@@ -29,6 +29,8 @@ __revision__ = "$Id$"
 
 
 
+import numpy as np
+
 import FESetup
 from FESetup import const, errors, logger
 import utils
@@ -39,6 +41,65 @@ from common import *
 
 
 
+# number of atoms per block in the brute force distance search
+_DIST_BLOCK = 2048
+
+
+def _shortest_distances(points, ref, box=None, cutoff=np.inf):
+    """
+    Compute the distance of every point to its nearest reference point.
+    Distances follow the minimum image convention if a rectangular box is
+    given.
+
+    :param points: coordinates, shape (N, 3)
+    :type points: numpy.ndarray
+    :param ref: reference coordinates, shape (M, 3)
+    :type ref: numpy.ndarray
+    :param box: box lengths or None
+    :type box: numpy.ndarray
+    :param cutoff: distances beyond the cutoff may be returned as inf
+    :type cutoff: float
+    :returns: shortest distances, shape (N)
+    :rtype: numpy.ndarray
+    """
+
+    if not len(points) or not len(ref):
+        return np.full(len(points), np.inf)
+
+    try:
+        from scipy.spatial import cKDTree
+    except ImportError:
+        cKDTree = None
+
+    if cKDTree:
+        if box is not None:
+            # the periodic tree requires all points inside the box
+            points = np.mod(points, box)
+            points = np.where(points >= box, 0.0, points)
+            ref = np.mod(ref, box)
+            ref = np.where(ref >= box, 0.0, ref)
+
+        tree = cKDTree(ref, boxsize=box)
+        dist, dummy = tree.query(points, k=1, distance_upper_bound=cutoff)
+
+        return dist
+
+    dist = np.empty(len(points) )
+
+    for start in range(0, len(points), _DIST_BLOCK):
+        diff = (points[start:start+_DIST_BLOCK, np.newaxis, :] -
+                ref[np.newaxis, :, :])
+
+        if box is not None:
+            diff -= box * np.round(diff / box)
+
+        dist[start:start+_DIST_BLOCK] = \
+                                  np.sqrt((diff * diff).sum(axis=2).min(axis=1) )
+
+    return dist
+
+
+
 class Complex(Common):
     """The complex setup class."""
 
@@ -46,12 +107,14 @@ class Complex(Common):
 
     SSBONDS_OFFSET = 1
 
-    def __init__(self, protein, ligand):
+    def __init__(self, protein, ligand, workdir=None):
         """
         :param protein: the protein for complex composition
         :type protein: Protein or string
         :param ligand: the ligand for complex composition
         :type ligand: Ligand or string
+        :param workdir: output work directory, the current directory if None
+        :type workdir: string
         :raises: SetupError
         """
 
@@ -61,13 +124,13 @@ class Complex(Common):
         #        this is still used for the Morph class
         if type(protein) == str and type(ligand) == str:
             super(Complex, self).__init__(protein + const.PROT_LIG_SEP +
-                                          ligand)
+                                          ligand, workdir)
 
             self.protein_file = protein
             self.ligand_file = ligand
 
             # FIXME: quick fix to allow dGprep to redo complex morph
-            self.ligand = Ligand(ligand, '')
+            self.ligand = Ligand(ligand, '', workdir=workdir)
 
             return
 
@@ -77,7 +140,7 @@ class Complex(Common):
         self.complex_name = protein.mol_name + const.PROT_LIG_SEP + \
                             ligand.mol_name
 
-        super(Complex, self).__init__(self.complex_name)
+        super(Complex, self).__init__(self.complex_name, workdir)
 
         self.ligand_file = ligand.orig_file
         self.protein_file = protein.orig_file
@@ -102,12 +165,13 @@ class Complex(Common):
         """
 
         # ensure ligand is in MOL2/GAFF format
-        if os.access(const.LIGAND_AC_FILE, os.F_OK):
+        if os.access(self._wd(const.LIGAND_AC_FILE), os.F_OK):
             mol_file = const.GAFF_MOL2_FILE
             antechamber = utils.check_amber('antechamber')
             utils.run_amber(antechamber,
                             '-i %s -fi ac -o %s -fo mol2 -j 1 -at %s -pf y' %
-                            (const.LIGAND_AC_FILE, mol_file, gaff) )
+                            (const.LIGAND_AC_FILE, mol_file, gaff),
+                            cwd=self.workdir)
             self.ligand_fmt = 'mol2'
         else:
             # antechamber has trouble with dummy atoms
@@ -164,7 +228,8 @@ class Complex(Common):
                                         remove_first=remove_first,
                                         conc=conc, dens=dens)
 
-        utils.run_leap(self.amber_top, self.amber_crd, 'tleap', leapin)
+        utils.run_leap(self.amber_top, self.amber_crd, 'tleap', leapin,
+                       cwd=self.workdir)
 
 
     @report
@@ -188,7 +253,8 @@ class Complex(Common):
         import Sire.IO
 
         amber = Sire.IO.Amber()
-        molecules, space = amber.readCrdTop(self.sander_crd, self.amber_top)
+        molecules, space = amber.readCrdTop(self._wd(self.sander_crd),
+                                            self._wd(self.amber_top) )
 
         moleculeNumbers = molecules.molNums()
         moleculeNumbers.sort()
@@ -201,60 +267,65 @@ class Complex(Common):
         ligand = moleculeList[0]
         not_ligand = moleculeList[1:]
 
-        sc_bb_residues = []
-
         logger.write('Computing flexible protein residues from %s' %
                      self.sander_crd)
 
-        for cut in cut_sidechain, cut_backbone:
-            cut_residues = []
-            cut2 = cut**2
+        def heavy_coords(atoms):
+            coords = []
+
+            for atom in atoms:
+                if atom.property('mass').value() < const.MAX_HYDROGEN_MASS:
+                    continue
 
-            for molecule in not_ligand:
+                vec = atom.property('coordinates')
+                coords.append( (vec.x(), vec.y(), vec.z() ) )
 
-                #for residue in molecule.residues():
-                nmolresidues = molecule.nResidues()
-                for z in range(0,nmolresidues):
-                    residue = molecule.residues()[z]
-                    # FIXME: a better way to skip unwanted residues would be to
-                    # examine amber.zmatrices directly
-                    # .value() returns a QtString!
-                    if (str(residue.name().value()) not in
-                        const.AMBER_PROTEIN_RESIDUES):
-                        continue
+            return coords
 
-                    shortest_dist2 = float('inf')
+        lig_coords = np.array(heavy_coords(ligand.atoms() ),
+                              dtype=np.float64).reshape(-1, 3)
 
-                    #for resat in residue.atoms():
-                    nresatoms = residue.nAtoms()
-                    for x in range(0,nresatoms):
-                        resat = residue.atoms()[x]
+        # collect the heavy atoms of all protein residues in one pass,
+        # atom_res maps every atom to its residue
+        residues = []
+        coords = []
+        atom_res = []
 
-                        if (resat.property('mass').value() <
-                            const.MAX_HYDROGEN_MASS):
-                            continue
+        for molecule in not_ligand:
+            for residue in molecule.residues():
+                # FIXME: a better way to skip unwanted residues would be to
+                # examine amber.zmatrices directly
+                # .value() returns a QtString!
+                if (str(residue.name().value()) not in
+                    const.AMBER_PROTEIN_RESIDUES):
+                    continue
 
-                        rescoords = resat.property('coordinates')
+                res_coords = heavy_coords(residue.atoms() )
+                coords.extend(res_coords)
+                atom_res.extend([len(residues)] * len(res_coords) )
+                residues.append(residue)
 
-                        #for ligat in ligand.atoms():
-                        nligatoms = ligand.nAtoms()
-                        for y in range(0,nligatoms):
-                            ligat = ligand.atoms()[y]
+        coords = np.array(coords, dtype=np.float64).reshape(-1, 3)
+        atom_res = np.array(atom_res, dtype=int)
 
-                            if (ligat.property('mass').value() <
-                                const.MAX_HYDROGEN_MASS):
-                                continue
+        if space.isPeriodic():
+            dims = space.dimensions()
+            box = np.array( (dims.x(), dims.y(), dims.z() ) )
+        else:
+            box = None
 
-                            ligcoords = ligat.property('coordinates')
-                            dist2 = space.calcDist2(rescoords, ligcoords)
+        # one search answers both cutoffs
+        dist = _shortest_distances(coords, lig_coords, box,
+                                   max(cut_sidechain, cut_backbone) )
 
-                            if dist2 < shortest_dist2:
-                                shortest_dist2 = dist2
+        shortest = np.full(len(residues), np.inf)
+        np.minimum.at(shortest, atom_res, dist)
 
-                    if shortest_dist2 < cut2:
-                        cut_residues.append(residue)
+        sc_bb_residues = []
 
-            sc_bb_residues.append(cut_residues)
+        for cut in cut_sidechain, cut_backbone:
+            sc_bb_residues.append([residues[i] for i in
+                                   np.flatnonzero(shortest < cut)])
 
         lines = ['''# Flexible residues were only selected from the following list of residue names
 # %s
@@ -285,7 +356,7 @@ class Complex(Common):
 
             lines.append('%s\n' % line)
 
-        with open(const.PROTEIN_FLEX_FILE, 'w') as output:
+        with open(self._wd(const.PROTEIN_FLEX_FILE), 'w') as output:
             output.write(''.join(lines))
 
 
@@ -28,6 +28,7 @@ __revision__ = "$Id$"
 
 
 
+import os
 from collections import OrderedDict
 
 import Sire.IO
@@ -37,7 +38,7 @@ from FESetup import const, errors, logger
 
 
 
-def dlf_write(mol, postfix = '', pdb_name = const.LIGAND_NAME):
+def dlf_write(mol, postfix = '', pdb_name = const.LIGAND_NAME, workdir = ''):
     """
     Extract topology and coordinate information from mol and convert to
     UDFF and PDB format.
@@ -48,6 +49,8 @@ def dlf_write(mol, postfix = '', pdb_name = const.LIGAND_NAME):
     :type postfix: string
     :param pdb_name: molecule PDB name
     :type pdb_name: string
+    :param workdir: directory to write the files to
+    :type workdir: string
     """
 
     try:
@@ -59,7 +62,7 @@ def dlf_write(mol, postfix = '', pdb_name = const.LIGAND_NAME):
     tot_natoms = mol.nAtoms()
     mw = 0
 
-    Sire.IO.PDB().write(mol, const.DLFIELD_PDB_NAME)
+    Sire.IO.PDB().write(mol, os.path.join(workdir, const.DLFIELD_PDB_NAME) )
 
     connects = OrderedDict()
     atom_info = []
@@ -98,7 +101,7 @@ def dlf_write(mol, postfix = '', pdb_name = const.LIGAND_NAME):
 
         connects[atom_name] = cl
 
-    udff = open(const.DLFIELD_UDFF_NAME, 'w')
+    udff = open(os.path.join(workdir, const.DLFIELD_UDFF_NAME), 'w')
 
     udff.write('UNIT kcal/mol\nPOTENTIAL AMBER\n\n')
 
@@ -515,7 +515,7 @@ class GromacsTop(object):
 
     # FIXME: #include 'atomtypes.itp'
     def writeTop(self, topname, typename='atomtypes.atp', pertname='',
-                 itp=True, itp_inc_file=const.GROMACS_PERT_ITP):
+                 itp=True, itp_inc_file=const.GROMACS_PERT_ITP, workdir=''):
         """Write top or itp file.
         :param topname: AMBER parmtop file name
         :type topname: string
@@ -527,9 +527,12 @@ class GromacsTop(object):
         :type itp: bool
         :param itp_inc_file: ITP file to include
         :type itp_inc_file: string
+        :param workdir: directory the files are written to, include
+                        directives are not affected
+        :type workdir: string
         """
 
-        with open(topname, 'w') as top:
+        with open(os.path.join(workdir, topname), 'w') as top:
             if not itp:
                 top.write(default_header)
 
@@ -539,7 +542,7 @@ class GromacsTop(object):
             if not typename:
                 handle = top
             else:
-                handle = open(typename, 'w')
+                handle = open(os.path.join(workdir, typename), 'w')
 
             for typ in sorted(self.top.atomtypes):
                 handle.write('%-4s %-4s %8.3f   0.0000  A  %12.6e %12.6e\n' %
@@ -0,0 +1,361 @@
+#  Copyright (C) 2017  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r"""
+Cache for the results of leap scripts.  The key is the hash of the script
+text, of the contents of every file the script loads and of the leap
+installation.  The value are the files written by the save commands of the
+script and the output of leap.  Cache hits are hardlinked into place where
+possible and copied otherwise.  The cache directory may be shared by several
+users and runs, its size is limited by evicting the least recently used
+entries.
+"""
+
+__revision__ = "$Id$"
+
+
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+
+
+
+META_FILE = 'meta.json'
+OUTPUT_FILE = 'leap.out'
+
+_LOAD = re.compile(r'^\s*(?:[A-Za-z_]\w*\s*=\s*)?(?:load\w+|source)\s+'
+                   r'"?([^"\s]+)', re.IGNORECASE)
+_SAVE = re.compile(r'^\s*save\w+\s+\S+\s+(.*)$', re.IGNORECASE)
+_BLOCK_SIZE = 1024 * 1024
+
+
+def _hash_file(filename, digest):
+    with open(filename, 'rb') as data:
+        while True:
+            block = data.read(_BLOCK_SIZE)
+
+            if not block:
+                break
+
+            digest.update(block)
+
+
+def output_files(script, cwd):
+    """
+    Names of the files written by the save commands of a leap script.
+
+    :param script: the leap script
+    :type script: str
+    :param cwd: directory leap runs in
+    :type cwd: str
+    :returns: absolute file names
+    :rtype: list of str
+    """
+
+    files = []
+
+    for line in script.split('\n'):
+        match = _SAVE.match(line)
+
+        if not match:
+            continue
+
+        for name in match.group(1).split():
+            name = name.strip('"')
+
+            # saveMol2 has a trailing integer flag
+            if name.isdigit():
+                continue
+
+            files.append(os.path.join(cwd, name) )
+
+    return files
+
+
+def unshare(filename):
+    """
+    Break a hardlink into the cache before a file is modified in place.
+
+    :param filename: name of the file about to be rewritten
+    :type filename: str
+    """
+
+    if not os.path.isfile(filename) or os.stat(filename).st_nlink < 2:
+        return
+
+    tmpname = '%s.%i' % (filename, os.getpid() )
+    shutil.copy2(filename, tmpname)
+    os.rename(tmpname, filename)
+
+
+class LeapCache(object):
+    """
+    A directory of leap results.  Every entry is a subdirectory named after
+    the key holding the output files, leap's output and a small meta data
+    file.  Entries are written to a temporary directory first and renamed
+    into place so that concurrent runs never see partial entries.
+    """
+
+    def __init__(self, cachedir, max_size, link=True):
+        """
+        :param cachedir: cache directory
+        :type cachedir: str
+        :param max_size: maximum size of the cache in bytes
+        :type max_size: int
+        :param link: hardlink hits into place instead of copying
+        :type link: bool
+        """
+
+        self.cachedir = os.path.abspath(cachedir)
+        self.max_size = max_size
+        self.link = link
+
+        if not os.path.isdir(self.cachedir):
+            try:
+                os.makedirs(self.cachedir)
+            except OSError:
+                if not os.path.isdir(self.cachedir):
+                    raise
+
+
+    def key(self, leap, script, cwd):
+        """
+        Compute the cache key of a leap script.  Loaded files which do not
+        exist relative to cwd are taken from leap's search path and are
+        represented by their name and the leap installation.
+
+        :param leap: full path of the leap executable
+        :type leap: str
+        :param script: the leap script
+        :type script: str
+        :param cwd: directory leap runs in
+        :type cwd: str
+        :returns: hex digest
+        :rtype: str
+        """
+
+        digest = hashlib.sha1()
+        digest.update('%s\0%s\0%s\0' % (os.path.realpath(leap),
+                                        os.environ.get('AMBERHOME', ''),
+                                        script) )
+
+        for line in script.split('\n'):
+            match = _LOAD.match(line)
+
+            if not match:
+                continue
+
+            filename = os.path.join(cwd, match.group(1) )
+
+            if os.path.isfile(filename):
+                _hash_file(filename, digest)
+            else:
+                digest.update('\0%s\0' % match.group(1) )
+
+        return digest.hexdigest()
+
+
+    def _entry(self, key):
+        return os.path.join(self.cachedir, key)
+
+
+    def _place(self, src, dst):
+        if os.path.lexists(dst):
+            os.remove(dst)
+
+        if self.link:
+            try:
+                os.link(src, dst)
+                return
+            except OSError:
+                # other file system or foreign file
+                pass
+
+        shutil.copy(src, dst)
+
+
+    def fetch(self, key, outputs):
+        """
+        Materialise a cached result.
+
+        :param key: cache key
+        :type key: str
+        :param outputs: names of the files the script writes
+        :type outputs: list of str
+        :returns: output of leap or None if not in the cache
+        :rtype: str
+        """
+
+        entry = self._entry(key)
+
+        try:
+            with open(os.path.join(entry, META_FILE), 'r') as meta:
+                nfiles = json.load(meta)['files']
+
+            if nfiles != len(outputs):
+                return None
+
+            for i, filename in enumerate(outputs):
+                self._place(os.path.join(entry, str(i) ), filename)
+
+            with open(os.path.join(entry, OUTPUT_FILE), 'r') as out:
+                text = out.read()
+        except (IOError, OSError, ValueError, KeyError):
+            # evicted concurrently or incomplete
+            return None
+
+        # mark as recently used, entries of other users cannot be touched
+        try:
+            os.utime(entry, None)
+        except OSError:
+            pass
+
+        return text
+
+
+    def prepare(self, outputs):
+        """
+        Remove output files which are still hardlinked into the cache so
+        that leap does not overwrite the cached copies.
+
+        :param outputs: names of the files the script writes
+        :type outputs: list of str
+        """
+
+        for filename in outputs:
+            if os.path.isfile(filename) and os.stat(filename).st_nlink > 1:
+                os.remove(filename)
+
+
+    def store(self, key, outputs, text):
+        """
+        Add a result to the cache.  Nothing is stored if an output file is
+        missing.
+
+        :param key: cache key
+        :type key: str
+        :param outputs: names of the files the script has written
+        :type outputs: list of str
+        :param text: output of leap
+        :type text: str
+        """
+
+        entry = self._entry(key)
+
+        if os.path.isdir(entry):
+            return
+
+        if not all(os.path.isfile(filename) for filename in outputs):
+            return
+
+        tmpdir = tempfile.mkdtemp(prefix='.tmp', dir=self.cachedir)
+        size = 0
+
+        try:
+            for i, filename in enumerate(outputs):
+                shutil.copy(filename, os.path.join(tmpdir, str(i) ) )
+                size += os.path.getsize(filename)
+
+            with open(os.path.join(tmpdir, OUTPUT_FILE), 'w') as out:
+                out.write(text)
+
+            with open(os.path.join(tmpdir, META_FILE), 'w') as meta:
+                json.dump({'files': len(outputs), 'size': size + len(text),
+                           'time': time.time()}, meta)
+
+            # readable by other users of a shared cache
+            os.chmod(tmpdir, 0755)
+            os.rename(tmpdir, entry)
+        except OSError:
+            # stored concurrently by another run
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            return
+        except:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            raise
+
+        self.evict()
+
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits into its
+        maximum size.
+        """
+
+        entries = []
+        total = 0
+
+        for name in os.listdir(self.cachedir):
+            # entries being written or deleted
+            if name.startswith('.'):
+                continue
+
+            entry = os.path.join(self.cachedir, name)
+
+            try:
+                with open(os.path.join(entry, META_FILE), 'r') as meta:
+                    size = json.load(meta)['size']
+
+                entries.append( (os.path.getmtime(entry), size, entry) )
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+
+            total += size
+
+        entries.sort()
+
+        for mtime, size, entry in entries:
+            if total <= self.max_size:
+                break
+
+            # rename first so that readers never see a half deleted entry
+            trash = tempfile.mkdtemp(prefix='.del', dir=self.cachedir)
+
+            try:
+                os.rename(entry, os.path.join(trash, 'entry') )
+            except OSError:
+                pass
+
+            shutil.rmtree(trash, ignore_errors=True)
+            total -= size
+
+
+cache = None
+
+
+def configure(cachedir, max_size=2048 * 1024 * 1024, link=True):
+    """
+    Set up the leap cache.
+
+    :param cachedir: cache directory, no caching if empty
+    :type cachedir: str
+    :param max_size: maximum size of the cache in bytes
+    :type max_size: int
+    :param link: hardlink hits into place instead of copying
+    :type link: bool
+    """
+
+    global cache
+
+    cache = LeapCache(cachedir, max_size, link) if cachedir else None
@@ -0,0 +1,344 @@
+#  Copyright (C) 2017  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r"""
+Long-lived tleap sessions.  Sourcing the force field files takes much longer
+than building the topology of a small molecule.  A session sources them once
+and is then fed the molecule specific part of every leap script over a
+pseudo terminal, so that leap does not buffer its output.  The end of a job
+is detected through a sentinel command whose output contains a unique token.
+Variables assigned by a job are cleared before the next job starts.
+Parameters and residue libraries loaded by a job cannot be unloaded, so a
+session is only reused for jobs loading the same set of such files.
+
+A leap script is split into a preamble, the leading force field commands, and
+a body.  Sessions are keyed by the preamble.  As leap has no notion of a
+working directory change, file names in the body are made absolute.
+"""
+
+__revision__ = "$Id$"
+
+
+import os
+import re
+import pty
+import time
+import atexit
+import select
+import termios
+import tempfile
+import threading
+import subprocess as subp
+
+
+
+# maximum time a single job may take before the session is given up
+_JOB_TIMEOUT = 600.0
+# output quiet time after the sentinel which marks the job as finished
+_SETTLE_TIME = 0.2
+_MAX_IDLE = 4
+
+_ASSIGN = re.compile(r'^\s*([A-Za-z_]\w*)\s*=')
+_LOAD = re.compile(r'^(\s*(?:[A-Za-z_]\w*\s*=\s*)?(?:load\w+|source)\s+)'
+                   r'("?)([^"\s]+)\2(.*)$', re.IGNORECASE)
+_SAVE = re.compile(r'^(\s*save\w+\s+\S+\s+)(.*)$', re.IGNORECASE)
+_ALIAS = re.compile(r'^\s*[A-Za-z_]\w*\s*=\s*[A-Za-z_]\w*\s*$')
+# load commands which only create a unit assigned to a variable
+_STRUCTURE = re.compile(r'^\s*(?:[A-Za-z_]\w*\s*=\s*)?'
+                        r'load(?:pdb|pdbusingseq|mol2|mol3)\s', re.IGNORECASE)
+
+
+class LeapSessionError(Exception):
+    pass
+
+
+def _absolute(name, cwd):
+    quoted = name.startswith('"')
+    name = name.strip('"')
+
+    if not os.path.isabs(name):
+        name = os.path.join(cwd, name)
+
+    return '"%s"' % name if quoted else name
+
+
+def split_script(script, cwd):
+    """
+    Split a leap script into the force field preamble and the molecule
+    specific body.  The preamble is made of the leading source and parameter
+    load commands of files found through the leap search path, alias
+    assignments and default settings.  The body is rewritten to use absolute
+    file names.
+
+    :param script: the leap script
+    :type script: str
+    :param cwd: directory relative file names are interpreted against
+    :type cwd: str
+    :returns: preamble, body, names of the variables set in the body and
+              the parameter and library files loaded by the body or None if
+              the script cannot be run in a session
+    :rtype: tuple
+    """
+
+    preamble = []
+    body = []
+    names = set()
+    loads = set()
+    in_preamble = True
+
+    for line in script.split('\n'):
+        stripped = line.strip()
+        lower = stripped.lower()
+
+        if not stripped or stripped.startswith('#'):
+            continue
+
+        if lower == 'quit':
+            break
+
+        match = _LOAD.match(line)
+        local = match and os.path.exists(os.path.join(cwd, match.group(3) ) )
+
+        if in_preamble:
+            if (match and not local and not _ASSIGN.match(line) ) or \
+                   _ALIAS.match(line) or lower.startswith('set default'):
+                preamble.append(stripped)
+                continue
+
+            in_preamble = False
+
+        # global settings would leak into later jobs
+        if lower.startswith('set default') or lower.startswith('addpath'):
+            return None
+
+        assign = _ASSIGN.match(line)
+
+        if assign:
+            names.add(assign.group(1) )
+
+        if match and not _STRUCTURE.match(line):
+            loads.add(_absolute(match.group(3), cwd) if local
+                      else match.group(3) )
+
+        if local:
+            line = (match.group(1) + match.group(2) +
+                    _absolute(match.group(3), cwd) + match.group(2) +
+                    match.group(4) )
+        else:
+            save = _SAVE.match(line)
+
+            if save:
+                files = save.group(2).split()
+
+                # saveMol2 has a trailing integer flag
+                line = save.group(1) + ' '.join(
+                    f if f.isdigit() else _absolute(f, cwd) for f in files)
+
+        body.append(line)
+
+    return '\n'.join(preamble), '\n'.join(body), names, frozenset(loads)
+
+
+class LeapSession(object):
+    """
+    A tleap process running on a pseudo terminal.
+    """
+
+    _count = 0
+
+    def __init__(self, leap, preamble, env, loads=frozenset() ):
+        """
+        :param leap: full path of the tleap executable
+        :type leap: str
+        :param preamble: force field commands sourced once
+        :type preamble: str
+        :param env: environment for leap
+        :type env: dict
+        :param loads: parameter and library files loaded by the jobs
+        :type loads: frozenset of str
+        """
+
+        self.preamble = preamble
+        self.loads = loads
+        self.owner = os.getpid()
+        self._rundir = tempfile.mkdtemp(prefix='leap_session')
+
+        master, slave = pty.openpty()
+
+        attrs = termios.tcgetattr(slave)
+        attrs[3] &= ~termios.ECHO
+        termios.tcsetattr(slave, termios.TCSANOW, attrs)
+
+        self.proc = subp.Popen([leap], stdin=slave, stdout=slave,
+                               stderr=slave, env=env, cwd=self._rundir,
+                               close_fds=True)
+        os.close(slave)
+        self.master = master
+
+        self.alive = True
+        self._talk(preamble)
+
+
+    def _talk(self, commands):
+        LeapSession._count += 1
+        token = '__fesetup_sync_%i_%i' % (os.getpid(), LeapSession._count)
+
+        # loading a non-existent file makes leap print the token only once
+        # the preceding commands have been processed
+        os.write(self.master, '%s\nloadAmberParams %s\n' % (commands, token) )
+
+        out = []
+        seen = False
+        deadline = time.time() + _JOB_TIMEOUT
+
+        while True:
+            wait = _SETTLE_TIME if seen else deadline - time.time()
+
+            if wait <= 0.0:
+                self.close()
+                raise LeapSessionError('leap session timed out')
+
+            ready = select.select([self.master], [], [], wait)[0]
+
+            if not ready:
+                if seen:
+                    break
+
+                continue
+
+            try:
+                data = os.read(self.master, 65536)
+            except OSError:
+                data = ''
+
+            if not data:
+                self.close()
+                raise LeapSessionError('leap session terminated')
+
+            out.append(data)
+
+            if not seen:
+                seen = token in ''.join(out)
+
+        text = ''.join(out).replace('\r\n', '\n')
+
+        # drop the sentinel output
+        return text[:text.find(token)].rsplit('\n', 1)[0]
+
+
+    def run(self, body, names):
+        """
+        Run a job and clear the variables it has set.
+
+        :param body: leap commands
+        :type body: str
+        :param names: variables set by the commands
+        :type names: set of str
+        :returns: output from leap
+        :rtype: str
+        """
+
+        if names:
+            body += '\nclearVariables { %s }' % ' '.join(sorted(names) )
+
+        return self._talk(body)
+
+
+    def close(self):
+        """Terminate leap."""
+
+        if not self.alive:
+            return
+
+        self.alive = False
+
+        try:
+            os.write(self.master, 'quit\n')
+        except OSError:
+            pass
+
+        try:
+            os.close(self.master)
+        except OSError:
+            pass
+
+        if self.proc.poll() is None:
+            time.sleep(_SETTLE_TIME)
+
+            if self.proc.poll() is None:
+                self.proc.kill()
+
+        self.proc.wait()
+
+        try:
+            os.rmdir(self._rundir)
+        except OSError:
+            pass
+
+
+class SessionPool(object):
+    """
+    Idle leap sessions of this process keyed by preamble and the files loaded
+    by the jobs.  A session is used by one job at a time.  Sessions inherited
+    from a parent process are never used.
+    """
+
+    def __init__(self):
+        self._idle = []
+        self._lock = threading.Lock()
+        self.enabled = False
+
+
+    def checkout(self, leap, preamble, env, loads=frozenset() ):
+        with self._lock:
+            for session in self._idle:
+                if session.preamble == preamble and \
+                       session.loads == loads and \
+                       session.owner == os.getpid():
+                    self._idle.remove(session)
+                    return session
+
+        return LeapSession(leap, preamble, env, loads)
+
+
+    def checkin(self, session):
+        if not session.alive:
+            return
+
+        with self._lock:
+            self._idle.insert(0, session)
+            surplus = self._idle[_MAX_IDLE:]
+            del self._idle[_MAX_IDLE:]
+
+        for old in surplus:
+            old.close()
+
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+
+        for session in idle:
+            if session.owner == os.getpid():
+                session.close()
+
+
+sessions = SessionPool()
+atexit.register(sessions.close)
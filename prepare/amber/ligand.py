@@ -36,21 +36,30 @@ __revision__ = "$Id$"
 
 
 
-import os, math, shutil
+import os, math, shutil, copy, time
 
 import openbabel as ob
 
 import FESetup
-from FESetup import const, errors, logger
+from FESetup import const, errors, logger, profiler
+from FESetup.prepare.ligutil import map_atoms
 from . import dlfield
 from common import *
 import utils
+import chargedb
+import leapcache
+from acfile import ACFile
+from parm7 import Parm7, read_rst7, AMBER_CHARGE_FACTOR
 
 import Sire.IO
 
 
 
 SQM_OUT = 'sqm.out'
+SQM_SCRATCH = 'sqm_strategy'
+ANTECHAMBER_OUT = 'antechamber.out'
+ANTECHAMBER_ERR = 'antechamber.err'
+SQM_POLL = 0.5
 
 GAUSS_INP = 'esp.in'
 GUS_INP = 'esp.inp'
@@ -99,13 +108,18 @@ GB_MIN_IN = '''Minimise whole system
 '''
 
 def _calc_gb_charge(ac_file, frcmod_file, charge, scfconv, tight,
-                    sqm_extra, antechamber, gaff):
+                    sqm_extra, antechamber, gaff, workdir=None):
     """
     Compute AM1/BCC charges using a GB model via the sander QM/MM
     interface. So far, this does not prevent zwitterions from 'folding'
     but helps/enables wave function convergence, also - but not only -
     because sander does not terminate when SCF does not converge.
 
+    The topology is created once.  Between iterations only its charges are
+    replaced and the minimised coordinates are passed to antechamber through
+    the AC file, so sander and antechamber/sqm are the only programs run per
+    iteration.
+
     :param ac_file: the input AC file
     :type ac_file: string
     :param frcmod_file: the initial frcmod file
@@ -122,10 +136,14 @@ def _calc_gb_charge(ac_file, frcmod_file, charge, scfconv, tight,
     :type antechamber: string
     :param gaff: 'gaff' or 'gaff2'
     :type gaff: string
+    :param workdir: directory to run in, the current directory if None
+    :type workdir: string
     :returns: bool if converged or not
     """
 
-    tleap = utils.check_amber('tleap')
+    wd = lambda filename: os.path.join(workdir, filename) if workdir \
+         else filename
+
     sander = utils.check_amber('sander')
 
     step = 0
@@ -134,8 +152,7 @@ def _calc_gb_charge(ac_file, frcmod_file, charge, scfconv, tight,
     minin = const.GB_PREFIX + os.extsep + 'in'
     top = const.GB_PREFIX + os.extsep + 'parm7'
     crd = const.GB_PREFIX + os.extsep + 'rst7'
-    ch_file = const.GB_PREFIX + os.extsep + 'charges'
-    tmp_mol2 = const.GB_PREFIX + '_tmp' + os.extsep + 'mol2'
+    tmp_ac = const.GB_PREFIX + '_tmp' + os.extsep + 'ac'
     mol2_file = fmt % (const.GB_PREFIX, step, os.extsep + 'mol2')
 
     sqm_nml = ("qm_theory='AM1',tight_p_conv=%i,"
@@ -144,55 +161,58 @@ def _calc_gb_charge(ac_file, frcmod_file, charge, scfconv, tight,
 
     sqm_params='scfconv=%s,tight_p_conv=%i,%s' % (scfconv, tight, sqm_extra)
 
+    # the topology is only built once, afterwards only the charges in it are
+    # updated
     utils.run_amber(antechamber,
                     '-i %s -fi ac '
-                    '-o %s -fo mol2' % (ac_file, mol2_file) )
+                    '-o %s -fo mol2' % (ac_file, mol2_file), cwd=workdir)
+
+    leap_script = GB_LEAP_IN % (frcmod_file, mol2_file, top, crd)
+    utils.run_leap(top, crd, 'tleap', leap_script, cwd=workdir)
+
+    parm = Parm7(wd(top) )
+    acfile = ACFile(wd(ac_file) )
 
     # FIXME: may want to change maxcyc
-    with open(minin, 'w') as min:
+    with open(wd(minin), 'w') as min:
         min.write(GB_MIN_IN % (GB_MAX_STEP, GB_MAX_STEP, GB_MAX_STEP,
                                charge, sqm_params) )
 
-    first = True
+    old_charges = None
+    converged = False
 
-    # FIXME: more robust error checking!
     for i in range(0, GB_MAX_ITER):
-        leap_script = GB_LEAP_IN % (frcmod_file, mol2_file, top, crd)
-
-        utils.run_leap(top, crd, 'tleap', leap_script)
-
         step += 1
         mdout = fmt % (const.GB_PREFIX, step, os.extsep + 'out')
         rstrt = fmt % (const.GB_PREFIX, step, os.extsep + 'rst7')
+        step_ac = fmt % (const.GB_PREFIX, step, os.extsep + 'ac')
 
         utils.run_amber(sander, '-O -i %s -c %s -p %s -o %s '
                         '-r %s -inf %s' % (minin, crd, top, mdout, rstrt,
                                            const.GB_PREFIX + os.extsep +
-                                           'info') )
-
-        # work-around for AmberTools14 antechamber which does not
-        # write the coordinates from the rst7 to sqm.pdb
-        utils.run_amber(antechamber,
-                        '-i %s -fi ac '
-                        '-a %s -fa rst -ao crd '
-                        '-o %s -fo mol2' %
-                        (ac_file, rstrt, tmp_mol2) )
+                                           'info'), cwd=workdir)
 
-        mol2_file = fmt % (const.GB_PREFIX, step, os.extsep + 'mol2')
+        coords = read_rst7(wd(rstrt) )[0]
+        acfile.set_coordinates(coords)
+        acfile.write(wd(tmp_ac) )
 
         # NOTE: only -c bcc (and -c resp) symmetrise charges
         utils.run_amber(antechamber,
                         '-c bcc -nc %i -at %s -j 4 -s 2 -eq 2 -rn LIG '
                         '-ek "%s" '
-                        '-i %s -fi mol2 '
-                        '-o %s -fo mol2'
-                        % (charge, gaff, sqm_nml, tmp_mol2, mol2_file) )
+                        '-i %s -fi ac '
+                        '-o %s -fo ac -pf y'
+                        % (charge, gaff, sqm_nml, tmp_ac, step_ac),
+                        cwd=workdir)
+
+        acfile = ACFile(wd(step_ac) )
+        charges = acfile.charges
 
         # geometry converged?
         found = False
         nstep = 0
 
-        with open(mdout, 'r') as sander_out:
+        with open(wd(mdout), 'r') as sander_out:
             for line in sander_out:
                 if line.startswith('   NSTEP'):
                     found = True
@@ -207,47 +227,77 @@ def _calc_gb_charge(ac_file, frcmod_file, charge, scfconv, tight,
             break
 
         # charges convergenced?
-        utils.run_amber(antechamber,
-                        '-i %s -fi mol2 '
-                        '-o %s -fo mol2 '
-                        '-cf %s -c wc -s 2 ' %
-                        (mol2_file, tmp_mol2, ch_file) )
+        if old_charges:
+            max_diff = max(math.fabs(ch1 - ch2)
+                           for ch1, ch2 in zip(charges, old_charges) )
+
+            logger.write('Maximum charge change in GB iteration %i: %f' %
+                         (step, max_diff) )
+
+            if max_diff <= GB_MAX_CHARGE:
+                converged = True
+                break
+
+        old_charges = charges
 
-        charges = []
+        parm.set('CHARGE', [ch * AMBER_CHARGE_FACTOR for ch in charges])
 
-        with open(ch_file, 'r') as infile:
-            for line in infile:
-                elems = line.split()
+        # the topology may be hardlinked from the leap cache
+        leapcache.unshare(wd(top) )
+        parm.write(wd(top) )
+        crd = rstrt
+
+    acfile.write(wd(ac_file) )
+
+    return converged
     
-                for elem in elems:
-                    chg = float(elem)
-                    charges.append(chg)
 
-        if first:
-            old_charges = charges
-            first = False
-            continue
+def _sqm_namelist(scfconv, tight, itrmax, maxcyc, sqm_extra):
+    """Namelist variables passed to sqm through antechamber."""
 
-        converged = True
+    return ("qm_theory='AM1',grms_tol=0.0002,tight_p_conv=%i,\n  "
+            "scfconv=%s,itrmax=%i,pseudo_diag=1,\n  "
+            "maxcyc=%i,\n%s" % (tight, scfconv, itrmax, maxcyc, sqm_extra) )
 
-        for ch1, ch2 in zip(charges, old_charges):
-            if (math.fabs(ch1) - math.fabs(ch2) ) > GB_MAX_CHARGE:
-                converged = False
-                break
 
-        if converged:
-            break
+def _sqm_failure(stdout, sqm_out, premin, scfconv):
+    """
+    Find the reason why antechamber has failed.
+
+    :param stdout: output of antechamber
+    :type stdout: str
+    :param sqm_out: name of the sqm output file
+    :type sqm_out: str
+    :param premin: number of preminimisation steps
+    :type premin: int
+    :param scfconv: SCF convergence criterion
+    :type scfconv: str
+    :returns: True if the SCF has not converged
+    :raises: SetupError for all other reasons
+    """
 
-        old_charges = charges
+    if 'the assigned bond types may be wrong' in stdout:
+        logger.write('Error: antechamber failed to assign '
+                     'atom/bond types properly\n')
+        raise errors.SetupError('antechamber cannot assign atom '
+                                'and/or bond types, check input '
+                                'structure, e.g. with acdoctor')
 
-    # FIXME: do not read and write to the same AC file?
-    utils.run_amber(antechamber,
-                    '-i %s -fi mol2 '
-                    '-o %s -fo ac -pf y ' %
-                    (mol2_file, ac_file) )
+    with open(sqm_out, 'r') as sqm:
+        for line in sqm:
+            if 'Unable to achieve self consistency' in line:
+                logger.write('Warning: SCF has not converged '
+                             'with %i %s\n' % (premin, scfconv) )
+                return True
+
+            if 'odd number of electrons' in line:
+                logger.write('Error: odd electron number\n')
+                raise errors.SetupError('wrong ligand charge, or '
+                                        'radical')
+
+    raise errors.SetupError('unknown error see log file and %s file' %
+                            os.path.abspath(sqm_out) )
 
-    return converged
-    
 
 class Ligand(Common):
     """The ligand setup class."""
@@ -258,7 +308,7 @@ class Ligand(Common):
 
 
     def __init__(self, ligand_name, start_file='ligand.pdb', start_fmt='pdb',
-                 frcmod=const.LIGAND_FRCMOD_FILE, gaff='gaff'):
+                 frcmod=const.LIGAND_FRCMOD_FILE, gaff='gaff', workdir=None):
         # gaff option only for compatibility with morph code
         """
         :param ligand_name: name of the ligand, will be used as directory name
@@ -269,15 +319,13 @@ class Ligand(Common):
         :type start_file: string
         :param start_fmt: format of the ligand file
         :type start_fmt: string
-        :param workdir: output work directory
-        :type workdir: string
         :param frcmod: name of the leap frcmod file
         :type frcmod: string
-        :param overwrite: overwrite files in the working directory from basedir
-        :type overwrite: bool
+        :param workdir: output work directory, the current directory if None
+        :type workdir: string
         """
 
-        super(Ligand, self).__init__(ligand_name)
+        super(Ligand, self).__init__(ligand_name, workdir)
 
         self.mol_file = start_file
         self.mol_fmt = start_fmt
@@ -298,7 +346,8 @@ class Ligand(Common):
 
 
     @report
-    def param(self, gb_charges=False, sqm_strategy=None):
+    def param(self, gb_charges=False, sqm_strategy=None, sqm_parallel=1,
+              template=None):
         """
         Compute symmetrized AM1/BCC charges and generate missing forcefield
         parameters. Runs antechamber, parmchk. Finally generated MOL2 file
@@ -309,6 +358,11 @@ class Ligand(Common):
         :param sqm_strategy: a strategy pattern using preminimize() and setting
            the SCF convergence criterion for sqm
         :type sqm_strategy: list of 2-tuples
+        :param sqm_parallel: number of strategies run concurrently
+        :type sqm_parallel: int
+        :param template: work directory of an identical ligand whose charges
+                         are mapped onto this one instead of deriving them
+        :type template: str
         :raises: SetupError
         """
 
@@ -335,8 +389,43 @@ class Ligand(Common):
             '-rn %s' % const.LIGAND_NAME  # overwrite ligand name
             ]
 
+        if template:
+            self._charges_from_template(antechamber, ac_cmd, template)
+            return
+
+        store = chargedb.store
+        method = 'gb' if gb_charges else 'bcc'
+
+        if store:
+            key, smiles = store.key(self._wd(self.mol_file), self.mol_fmt,
+                                    self.charge, self.gaff, method,
+                                    repr(sqm_strategy) if sqm_strategy
+                                    else '')
+            entry = store.fetch(key) if key else None
+
+            if entry:
+                logger.write('Charges of %s taken from charge store %s' %
+                             (smiles, store.filename) )
+
+                with open(self._wd(const.LIGAND_AC_FILE), 'w') as acfile:
+                    acfile.write(entry.ac)
+
+                with open(self._wd(const.LIGAND_AC_FILE + os.extsep + '0'),
+                          'w') as acfile:
+                    acfile.write(entry.ac_orig)
+
+                self._parmchk(const.LIGAND_AC_FILE, 'ac', self.frcmod)
+
+                self.charge = entry.charge
+                logger.write('Total molecule charge is %.2f\n' % self.charge)
+
+                self.ref_file = self.mol_file
+                self.ref_fmt = self.mol_fmt
+
+                return
+
         tmp_file = const.LIGAND_TMP + os.extsep + self.mol_fmt
-        shutil.copyfile(self.mol_file, tmp_file)
+        shutil.copyfile(self._wd(self.mol_file), self._wd(tmp_file) )
 
         # NOTE: The main problem is SCF convergence. If this happens MM
         #       minimisation is used to hope to obtain a better structure with a
@@ -374,6 +463,13 @@ class Ligand(Common):
         logger.write('Optimizing structure and creating AM1/BCC charges')
         premin_done = False
 
+        if sqm_parallel > 1 and len(sqm_strategy) > 1:
+            (converged, sce, premin, scfconv, tight, maxcyc, sqm_extra) = \
+                        self._sqm_race(antechamber, ac_cmd, sqm_strategy,
+                                       sqm_parallel)
+            premin_done = premin > 0
+            sqm_strategy = ()
+
         for premin, scfconv, tight, itrmax, maxcyc, sqm_extra in sqm_strategy:
             converged = False
 
@@ -381,44 +477,18 @@ class Ligand(Common):
                 self.preminimize(nsteps = premin)
                 premin_done = True
 
-            sqm_nlv = ("qm_theory='AM1',grms_tol=0.0002,tight_p_conv=%i,\n  "
-                       "scfconv=%s,itrmax=%i,pseudo_diag=1,\n  "
-                       "maxcyc=%i,\n%s" %
-                       (tight, scfconv, itrmax, maxcyc, sqm_extra) )
-            ek = ['-ek "%s"' % sqm_nlv]  # sqm namelist variables
+            # sqm namelist variables
+            ek = ['-ek "%s"' % _sqm_namelist(scfconv, tight, itrmax, maxcyc,
+                                             sqm_extra)]
 
             # FIXME: Buffering messes with the stdout output order of
             #        antechamber (last line comes first).  Use stdbuf, pexpect
             #        or pty (probably Linux only)?
-            err = utils.run_amber(antechamber, ' '.join(ac_cmd + ek) )
+            err = utils.run_amber(antechamber, ' '.join(ac_cmd + ek),
+                                  cwd=self.workdir)
 
             if err:
-                if 'the assigned bond types may be wrong' in err[0]:
-                    logger.write('Error: antechamber failed to assign '
-                                 'atom/bond types properly\n')
-                    raise errors.SetupError('antechamber cannot assign atom '
-                                            'and/or bond types, check input '
-                                            'structure, e.g. with acdoctor')
-
-                sce = False
-
-                with open(SQM_OUT, 'r') as sqm:
-                    for line in sqm:
-                        if 'Unable to achieve self consistency' in line:
-                            logger.write('Warning: SCF has not converged '
-                                         'with %i %s\n' % (premin, scfconv) )
-                            sce = True
-                            break
-
-                        if 'odd number of electrons' in line:
-                            logger.write('Error: odd electron number\n')
-                            raise errors.SetupError('wrong ligand charge, or '
-                                                    'radical')
-
-                if not sce:
-                    raise errors.SetupError('unknown error see log file '
-                                            'and %s file' %
-                                            os.path.join(self.dst, SQM_OUT) )
+                sce = _sqm_failure(err[0], self._wd(SQM_OUT), premin, scfconv)
             else:
                 converged = True
                 break
@@ -440,7 +510,8 @@ class Ligand(Common):
                             '-o %s -fo ac' %
                             (const.LIGAND_AC_FILE,
                              tmp_file, self.mol_fmt,
-                             const.LIGAND_AC_FILE))  # FIXME: dangerous?
+                             const.LIGAND_AC_FILE),  # FIXME: dangerous?
+                            cwd=self.workdir)
 
         if not gb_charges:
             logger.write('SCF has converged with %i preminimisation steps and '
@@ -450,7 +521,7 @@ class Ligand(Common):
             H_form = 'unknown'
             grad = 'unknown'
 
-            with open(SQM_OUT, 'r') as sqm:
+            with open(self._wd(SQM_OUT), 'r') as sqm:
                 for line in sqm:
                     if line.startswith('xmin'):
                         ngconv = int(line[4:10].strip() )
@@ -477,12 +548,13 @@ class Ligand(Common):
                 parmchk = utils.check_amber('parmchk')
 
             utils.run_amber(parmchk, '-i %s -f ac -o %s' %
-                            (const.LIGAND_AC_FILE, const.GB_FRCMOD_FILE) )
+                            (const.LIGAND_AC_FILE, const.GB_FRCMOD_FILE),
+                            cwd=self.workdir)
 
             converged = _calc_gb_charge(const.LIGAND_AC_FILE,
                                         const.GB_FRCMOD_FILE, self.charge,
                                         scfconv, tight, sqm_extra,
-                                        antechamber, self.gaff)
+                                        antechamber, self.gaff, self.workdir)
 
             if not converged:
                 logger.write('Error: GB parameterisation failed\n')
@@ -491,16 +563,19 @@ class Ligand(Common):
 
         self._parmchk(const.LIGAND_AC_FILE, 'ac', self.frcmod)
 
-        charges = []
+        acfile = ACFile(self._wd(const.LIGAND_AC_FILE) )
+        charges = acfile.charges
 
-        with open(const.LIGAND_AC_FILE, 'r') as acfile:
-            for line in acfile:
-                if line[:4] == 'ATOM':
-                    charges.append(float(line[54:64]) )
+        if not charges:
+            raise errors.SetupError('no atoms found in %s' %
+                                    const.LIGAND_AC_FILE)
 
-        if filter(lambda ch: math.fabs(ch) > const.MAX_CHARGE, charges):
-            logger.write('Warning: some atom charges > %.2f' %
-                         const.MAX_CHARGE)
+        large = [atom.name for atom in acfile.atoms
+                 if math.fabs(atom.charge) > const.MAX_CHARGE]
+
+        if large:
+            logger.write('Warning: some atom charges > %.2f: %s' %
+                         (const.MAX_CHARGE, ', '.join(large) ) )
 
         total_charge = sum(charges)
         dec_frac = total_charge - round(total_charge)
@@ -514,32 +589,214 @@ class Ligand(Common):
         for idx, charge in enumerate(charges):
             charges[idx] = charge - corr
 
-        with open(const.CORR_CH_FILE, 'w') as chfile:
-           for charge in charges:
-               chfile.write('%.9f\n' % charge)
-
-        utils.run_amber(antechamber,
-                        '-i %s -fi ac '
-                        '-o %s -fo ac '
-                        '-cf %s -c rc '
-                        '-s 2 -pf y -at %s' %
-                        (const.LIGAND_AC_FILE, const.CORR_AC_FILE,
-                         const.CORR_CH_FILE, self.gaff) )
-
         # FIXME: Do we really need this? It only documents the charge orginally
         #        derived via antechamber.
-        shutil.copyfile(const.LIGAND_AC_FILE,
-                        const.LIGAND_AC_FILE + os.extsep + '0')
+        shutil.copyfile(self._wd(const.LIGAND_AC_FILE),
+                        self._wd(const.LIGAND_AC_FILE + os.extsep + '0') )
 
-        shutil.move(const.CORR_AC_FILE, const.LIGAND_AC_FILE)
+        acfile.set_charges(charges)
+        acfile.write(self._wd(const.LIGAND_AC_FILE) )
 
         self.charge = float('%.12f' % sum(charges))
         logger.write('Total molecule charge is %.2f\n' % self.charge)
 
+        if store and key:
+            with open(self._wd(const.LIGAND_AC_FILE + os.extsep + '0'),
+                      'r') as ac_orig:
+                store.add(key, smiles, self.charge, self.gaff, method,
+                          charges, ''.join(acfile.lines), ac_orig.read() )
+
+        self.ref_file = self.mol_file
+        self.ref_fmt = self.mol_fmt
+
+
+    def _charges_from_template(self, antechamber, ac_cmd, template):
+        """
+        Take the charges from an identical ligand parameterised before.  Only
+        the atom types are assigned by antechamber, the charges are mapped
+        onto the atom order of this ligand.
+
+        :param antechamber: full path of antechamber
+        :type antechamber: str
+        :param ac_cmd: antechamber options
+        :type ac_cmd: list of str
+        :param template: work directory of the identical ligand
+        :type template: str
+        :raises: SetupError
+        """
+
+        ref_ac = os.path.join(template, const.LIGAND_AC_FILE)
+        ref_mol = os.path.join(template, const.CONV_MOL2_FILE % 'mol2')
+
+        logger.write('Charges taken from identical ligand in %s' % template)
+
+        index = map_atoms(ref_mol, 'mol2', self._wd(self.mol_file),
+                          self.mol_fmt)
+
+        # atom types and names only
+        err = utils.run_amber(antechamber,
+                              ' '.join(opt for opt in ac_cmd
+                                       if not opt.startswith('-c ') ),
+                              cwd=self.workdir)
+
+        if err:
+            raise errors.SetupError('failed to assign atom types')
+
+        acfile = ACFile(self._wd(const.LIGAND_AC_FILE) )
+        ref_orig = ref_ac + os.extsep + '0'
+
+        if os.path.isfile(ref_orig):
+            charges = ACFile(ref_orig).charges
+            acfile.set_charges([charges[idx] for idx in index])
+            acfile.write(self._wd(const.LIGAND_AC_FILE + os.extsep + '0') )
+
+        charges = ACFile(ref_ac).charges
+        acfile.set_charges([charges[idx] for idx in index])
+        acfile.write(self._wd(const.LIGAND_AC_FILE) )
+
+        self._parmchk(const.LIGAND_AC_FILE, 'ac', self.frcmod)
+
+        self.charge = float('%.12f' % sum(acfile.charges) )
+        logger.write('Total molecule charge is %.2f\n' % self.charge)
+
         self.ref_file = self.mol_file
         self.ref_fmt = self.mol_fmt
 
 
+    def _start_sqm(self, antechamber, ac_cmd, strategy, topdir):
+        """
+        Start antechamber/sqm for one strategy in a scratch directory.
+
+        :returns: the antechamber process
+        """
+
+        num, premin, scfconv, tight, itrmax, maxcyc, sqm_extra = strategy
+
+        scratch_dir = os.path.join(topdir, '%s%i' % (SQM_SCRATCH, num) )
+
+        if os.path.isdir(scratch_dir):
+            shutil.rmtree(scratch_dir)
+
+        os.makedirs(scratch_dir)
+        shutil.copyfile(self._wd(self.mol_file),
+                        os.path.join(scratch_dir, self.mol_file) )
+
+        if premin:
+            scratch = copy.copy(self)
+            scratch.workdir = scratch_dir
+            scratch.preminimize(nsteps = premin)
+
+        ek = ['-ek "%s"' % _sqm_namelist(scfconv, tight, itrmax, maxcyc,
+                                         sqm_extra)]
+
+        with open(os.path.join(scratch_dir, ANTECHAMBER_OUT), 'w') as out, \
+                 open(os.path.join(scratch_dir, ANTECHAMBER_ERR), 'w') as err:
+            return utils.start_amber(antechamber, ' '.join(ac_cmd + ek),
+                                     scratch_dir, out, err)
+
+
+    def _sqm_race(self, antechamber, ac_cmd, sqm_strategy, nparallel):
+        """
+        Run several sqm strategies concurrently, each in a scratch directory
+        of its own, and keep the result of the first one which converges.
+        The other runs are terminated.  As in the sequential case the
+        preminimisation steps accumulate along the strategy list but every
+        strategy starts from the input structure.
+
+        :returns: converged and SCF error flags, preminimisation steps,
+           scfconv, tight, maxcyc and sqm_extra of the winning or else the
+           last strategy
+        :raises: SetupError
+        """
+
+        topdir = self.workdir or os.getcwd()
+        pending = []
+        total = 0
+
+        for num, strategy in enumerate(sqm_strategy):
+            total += strategy[0]
+            pending.append( (num, total) + tuple(strategy[1:]) )
+
+        nparallel = min(nparallel, len(pending) )
+        running = {}
+        winner = None
+        last = None
+        sce = False
+
+        logger.write('Running %i sqm strategies, %i concurrently' %
+                     (len(pending), nparallel) )
+
+        try:
+            with utils.reserve_cores(nparallel), \
+                     profiler.command('%s (%i sqm strategies)' %
+                                      (antechamber, len(pending) ) ):
+                while (pending or running) and not winner:
+                    while pending and len(running) < nparallel:
+                        strategy = pending.pop(0)
+                        running[strategy] = self._start_sqm(antechamber,
+                                                            ac_cmd, strategy,
+                                                            topdir)
+
+                    time.sleep(SQM_POLL)
+
+                    for strategy in sorted(running):
+                        if running[strategy].poll() is None:
+                            continue
+
+                        proc = running.pop(strategy)
+                        scratch_dir = os.path.join(topdir, '%s%i' %
+                                                   (SQM_SCRATCH, strategy[0]) )
+
+                        with open(os.path.join(scratch_dir,
+                                               ANTECHAMBER_OUT), 'r') as out:
+                            stdout = out.read()
+
+                        if not proc.returncode:
+                            winner = strategy
+                            logger.write('  stdout {\n    %s\n  }\n' %
+                                         stdout.strip() )
+                            break
+
+                        sce = _sqm_failure(stdout,
+                                           os.path.join(scratch_dir, SQM_OUT),
+                                           strategy[1], strategy[2])
+
+                        last = strategy
+
+            if winner:
+                scratch_dir = os.path.join(topdir, '%s%i' %
+                                           (SQM_SCRATCH, winner[0]) )
+
+                for name in os.listdir(scratch_dir):
+                    if name in (ANTECHAMBER_OUT, ANTECHAMBER_ERR):
+                        continue
+
+                    if os.path.exists(os.path.join(topdir, name) ):
+                        os.remove(os.path.join(topdir, name) )
+
+                    shutil.move(os.path.join(scratch_dir, name), topdir)
+        finally:
+            for proc in running.values():
+                utils.kill_amber(proc)
+
+            for num in range(len(sqm_strategy) ):
+                shutil.rmtree(os.path.join(topdir, '%s%i' %
+                                           (SQM_SCRATCH, num) ),
+                              ignore_errors=True)
+
+        converged = winner is not None
+
+        if converged:
+            logger.write('Strategy %i of %i has converged' %
+                         (winner[0] + 1, len(sqm_strategy) ) )
+        else:
+            winner = last
+
+        num, premin, scfconv, tight, itrmax, maxcyc, sqm_extra = winner
+
+        return converged, sce, premin, scfconv, tight, maxcyc, sqm_extra
+
+
     def _parmchk(self, infile, informat, outfile):
         """
         Run parmcheck to generate missing parameters.
@@ -584,7 +841,7 @@ class Ligand(Common):
 #                                             'leap', 'parm', addon) +
 #                                 os.extsep + 'dat')
 
-        utils.run_amber(parmchk, params)
+        utils.run_amber(parmchk, params, cwd=self.workdir)
 
     @report
     def prepare_top(self, gaff='gaff', pert=None, add_frcmods=[]):
@@ -606,7 +863,7 @@ class Ligand(Common):
                                 '-o %s -fo mol2 '
                                 '-at %s -s 2 -pf y' %
                                 (const.LIGAND_AC_FILE, mol_file,
-                                 self.gaff) )
+                                 self.gaff), cwd=self.workdir)
                 self.mol_file = mol_file
         elif self.mol_fmt == 'pdb':
             pass
@@ -614,7 +871,7 @@ class Ligand(Common):
             raise errors.SetupError('unsupported leap input format: %s (only '
                                     'mol2 and pdb)' % self.mol_fmt)
 
-        if os.path.isfile(self.frcmod):
+        if os.path.isfile(self._wd(self.frcmod) ):
             frcmods = [self.frcmod]
         else:
             frcmods = []
@@ -661,13 +918,13 @@ class Ligand(Common):
 
         # we allow the user to have their own leap input file which is used
         # instead of the autogenerated one
-        if os.access(const.LEAP_IN, os.F_OK):
+        if os.access(self._wd(const.LEAP_IN), os.F_OK):
             self.amber_top = const.LEAP_IN + self.TOP_EXT
             self.amber_crd = const.LEAP_IN + self.RST_EXT
             self.amber_pdb = const.LEAP_IN + const.PDB_EXT
 
             utils.run_leap(self.amber_top, self.amber_crd, program = 'tleap',
-                           script = const.LEAP_IN)
+                           script = const.LEAP_IN, cwd = self.workdir)
 
             return
 
@@ -680,14 +937,16 @@ class Ligand(Common):
         # Strangely, sleap does not create sander compatible top files with
         # TIP4P but tleap does.  Sleap also crashes when @<TRIPOS>SUBSTRUCTURE
         # is missing.  Sleap has apparently been abandonded.
-        utils.run_leap(self.amber_top, self.amber_crd, 'tleap', leapin)
+        utils.run_leap(self.amber_top, self.amber_crd, 'tleap', leapin,
+                       cwd=self.workdir)
 
         # create DL_FIELD UDFF/PDB for vacuum case
         if not boxtype:
             amber = Sire.IO.Amber()
 
             try:
-                mols = amber.readCrdTop(self.amber_crd, self.amber_top)[0]
+                mols = amber.readCrdTop(self._wd(self.amber_crd),
+                                        self._wd(self.amber_top) )[0]
             except UserWarning as error:
                 raise errors.SetupError('error opening %s/%s: %s' %
                                         (self.amber_crd, self.amber_top, error) )
@@ -702,7 +961,8 @@ class Ligand(Common):
             lig = mols.molNums()[0]
 
             if write_dlf:
-                dlfield.dlf_write(mols.at(lig).molecule(), '_AG')
+                dlfield.dlf_write(mols.at(lig).molecule(), '_AG',
+                                  workdir=self._wd('') )
 
 
     @report
@@ -741,18 +1001,18 @@ class Ligand(Common):
             if gnproc:
                 ac_cmd.append('-gn "%s"' % gnproc)
 
-            utils.run_amber(antechamber, ' '.join(ac_cmd) )
+            utils.run_amber(antechamber, ' '.join(ac_cmd), cwd=self.workdir)
         elif program == 'gus':
             conv = ob.OBConversion()
             conv.SetInAndOutFormats(self.mol_fmt, 'gamin')
 
             obm = ob.OBMol()
-            conv.ReadFile(obm, self.mol_file)
+            conv.ReadFile(obm, self._wd(self.mol_file) )
 
             inp = conv.WriteString(obm)
             nl = inp.find('\n') + 1     # skip first line
             
-            with open(GUS_INP, 'w') as gus:
+            with open(self._wd(GUS_INP), 'w') as gus:
                 gus.writelines (gus_header + inp[nl:])
                 
         else:
@@ -769,7 +1029,8 @@ class Ligand(Common):
 
         # FIXME: we only need vacuum.parm7/rst7
         try:
-            molecules = amber.readCrdTop(self.amber_crd, self.amber_top)[0]
+            molecules = amber.readCrdTop(self._wd(self.amber_crd),
+                                         self._wd(self.amber_top) )[0]
         except UserWarning as error:
             raise errors.SetupError('error opening %s/%s: %s' %
                                     (self.amber_crd, self.amber_top, error) )
@@ -801,7 +1062,7 @@ class Ligand(Common):
 
         outstr.append('endmolecule\n')
 
-        with open(const.SIRE_ABS_PERT_FILE, 'w') as pfile:
+        with open(self._wd(const.SIRE_ABS_PERT_FILE), 'w') as pfile:
             pfile.write('\n'.join(outstr))
 
         # 2-step
@@ -820,7 +1081,7 @@ class Ligand(Common):
 
         outstr.append('endmolecule\n')
 
-        with open(const.SIRE_ABS_PERT_EL_FILE, 'w') as pfile:
+        with open(self._wd(const.SIRE_ABS_PERT_EL_FILE), 'w') as pfile:
             pfile.write('\n'.join(outstr))
 
         outstr = ['version 1', 'molecule %s' % (const.LIGAND_NAME)]
@@ -844,7 +1105,7 @@ class Ligand(Common):
 
         outstr.append('endmolecule\n')
 
-        with open(const.SIRE_ABS_PERT_VDW_FILE, 'w') as pfile:
+        with open(self._wd(const.SIRE_ABS_PERT_VDW_FILE), 'w') as pfile:
             pfile.write('\n'.join(outstr))
 
 
@@ -0,0 +1,268 @@
+#  Copyright (C) 2017  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r"""
+Minimal reader and writer for AMBER parm7 topology and rst7 coordinate files.
+Sections of a topology can be read and replaced without going through leap.
+"""
+
+__revision__ = "$Id$"
+
+
+import re
+import math
+from collections import OrderedDict
+
+from FESetup import errors
+import utils                            # relative import
+
+
+
+# parm7 charges are in units of e scaled by sqrt(332.0522173)
+AMBER_CHARGE_FACTOR = 18.2223
+
+_FORMAT = re.compile(r'%FORMAT\((\d+)([aAiIeEfF])(\d+)(?:\.(\d+))?\)')
+_RST7_WIDTH = 12
+# index of IFBOX in the POINTERS section
+_IFBOX = 27
+
+
+class Parm7(object):
+    """
+    An AMBER parm7 file held as an ordered dictionary of sections.  Sections
+    are only converted to numbers when requested.
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: name of the parm7 file
+        :type filename: str
+        :raises: SetupError
+        """
+
+        self.filename = filename
+        self.header = []
+        self.sections = OrderedDict()
+
+        flag = None
+
+        try:
+            with open(filename, 'r') as parm:
+                for line in parm:
+                    if line.startswith('%FLAG'):
+                        flag = line.split()[1]
+                        self.sections[flag] = [None, []]
+                    elif line.startswith('%FORMAT') and flag:
+                        self.sections[flag][0] = line.strip()
+                    elif flag:
+                        self.sections[flag][1].append(line.rstrip('\n') )
+                    else:
+                        self.header.append(line)
+        except IOError as why:
+            raise errors.SetupError('cannot read parm7 file: %s' % why)
+
+
+    def __contains__(self, flag):
+        return flag in self.sections
+
+
+    def _format(self, flag):
+        try:
+            fmt = self.sections[flag][0]
+        except KeyError:
+            raise errors.SetupError('no section %s in %s' %
+                                    (flag, self.filename) )
+
+        match = _FORMAT.match(fmt)
+
+        if not match:
+            raise errors.SetupError('unsupported format %s in %s' %
+                                    (fmt, self.filename) )
+
+        count, typ, width, prec = match.groups()
+
+        return int(count), typ.lower(), int(width), int(prec or 0)
+
+
+    def get(self, flag):
+        """
+        Read the values of a section.
+
+        :param flag: section name e.g. CHARGE
+        :type flag: str
+        :returns: the values
+        :rtype: list of float, int or str
+        :raises: SetupError
+        """
+
+        count, typ, width, prec = self._format(flag)
+        conv = {'a': str.strip, 'i': int, 'e': float, 'f': float}[typ]
+        values = []
+
+        for line in self.sections[flag][1]:
+            for pos in range(0, len(line), width):
+                field = line[pos:pos+width]
+
+                if field.strip() or typ == 'a':
+                    values.append(conv(field) )
+
+        return values
+
+
+    @property
+    def has_box(self):
+        """True if the topology describes a periodic system."""
+
+        return self.get('POINTERS')[_IFBOX] > 0
+
+
+    def set(self, flag, values):
+        """
+        Replace the values of a section keeping its format.
+
+        :param flag: section name e.g. CHARGE
+        :type flag: str
+        :param values: the new values
+        :type values: list
+        :raises: SetupError
+        """
+
+        count, typ, width, prec = self._format(flag)
+
+        if typ == 'a':
+            fmt = '%%-%is' % width
+        elif typ == 'i':
+            fmt = '%%%ii' % width
+        else:
+            fmt = '%%%i.%i%s' % (width, prec, 'E' if typ == 'e' else 'f')
+
+        lines = []
+
+        for start in range(0, len(values), count):
+            lines.append(''.join(fmt % v for v in values[start:start+count]) )
+
+        # an empty section is written as a single blank line
+        self.sections[flag][1] = lines or ['']
+
+
+    def write(self, filename):
+        """
+        Write the topology.
+
+        :param filename: output file name
+        :type filename: str
+        """
+
+        with open(filename, 'w') as parm:
+            parm.writelines(self.header)
+
+            for flag, (fmt, lines) in self.sections.iteritems():
+                parm.write('%%FLAG %s\n%s\n' % (flag, fmt) )
+
+                for line in lines:
+                    parm.write(line + '\n')
+
+
+def read_rst7(filename):
+    """
+    Read the coordinates from an AMBER rst7 or inpcrd file.
+
+    :param filename: name of the coordinate file
+    :type filename: str
+    :returns: coordinates and box, the box is None if there is none
+    :rtype: list of 3-tuples of float, list of float
+    :raises: SetupError
+    """
+
+    try:
+        with open(filename, 'r') as rst:
+            rst.readline()
+            natoms = int(rst.readline().split()[0])
+
+            values = []
+
+            for line in rst:
+                line = line.rstrip('\n')
+
+                for pos in range(0, len(line), _RST7_WIDTH):
+                    field = line[pos:pos+_RST7_WIDTH]
+
+                    if field.strip():
+                        values.append(float(field) )
+    except (IOError, ValueError, IndexError) as why:
+        raise errors.SetupError('cannot read rst7 file %s: %s' %
+                                (filename, why) )
+
+    ncoords = 3 * natoms
+
+    if len(values) < ncoords:
+        raise errors.SetupError('rst7 file %s is too short' % filename)
+
+    coords = [tuple(values[i:i+3]) for i in range(0, ncoords, 3)]
+
+    # velocities may follow the coordinates, the box is always last
+    rest = values[ncoords:]
+    box = rest[-6:] if len(rest) in (6, ncoords + 6) else None
+
+    return coords, box
+
+
+def read_rst7_box(filename):
+    """
+    Read the box from the last line of an AMBER rst7 file without reading the
+    coordinates.  The caller must know that the file has a box, e.g. from
+    Parm7.has_box.
+
+    :param filename: name of the coordinate file
+    :type filename: str
+    :returns: box lengths and angles
+    :rtype: list of float
+    :raises: SetupError
+    """
+
+    try:
+        line = utils.last_line(filename)
+        box = [float(line[pos:pos+_RST7_WIDTH])
+               for pos in range(0, len(line), _RST7_WIDTH)
+               if line[pos:pos+_RST7_WIDTH].strip()]
+    except ValueError as why:
+        raise errors.SetupError('cannot read box from %s: %s' %
+                                (filename, why) )
+
+    if len(box) != 6:
+        raise errors.SetupError('no box in rst7 file %s' % filename)
+
+    return box
+
+
+def box_volume(box):
+    """
+    Compute the volume of a general triclinic box.
+
+    :param box: box lengths and angles in degrees
+    :type box: list of float
+    :returns: the volume
+    :rtype: float
+    """
+
+    a, b, c = box[:3]
+    cosa, cosb, cosg = [math.cos(math.radians(angle) ) for angle in box[3:6]]
+
+    return a * b * c * math.sqrt(1.0 - cosa**2 - cosb**2 - cosg**2 +
+                                 2.0 * cosa * cosb * cosg)
@@ -34,13 +34,14 @@ import FESetup
 from FESetup import const, errors, logger
 from common import *
 import utils
+import restemplate
 
 
 class Protein(Common):
     """The protein setup class."""
 
 
-    def __init__(self, protein_name, start_file='protein.pdb'):
+    def __init__(self, protein_name, start_file='protein.pdb', workdir=None):
         """
         :param protein_name: name of the protein, will be used as directory name
         :type protein_name: string
@@ -48,12 +49,12 @@ class Protein(Common):
         :type basedir: string
         :param start_file: the file name of the protein
         :type start_file: string
-        :param overwrite: overwrite files in the working directory from basedir
-        :type overwrite: string
+        :param workdir: output work directory, the current directory if None
+        :type workdir: string
         :raises: SetupError
         """
 
-        super(Protein, self).__init__(protein_name)
+        super(Protein, self).__init__(protein_name, workdir)
 
         self.leap_added = False
 
@@ -68,22 +69,39 @@ class Protein(Common):
 
 
     @report
-    def get_charge(self):
+    def get_charge(self, verify=False):
         """
-        Get the protein charge via leap.
+        Get the protein charge from the net charges of the residue templates
+        of the force field.  Leap is only run when a residue has no template
+        or when the result is to be verified.
 
+        :param verify: compare the charge with the one computed by leap
+        :type verify: bool
         :raises: SetupError
         """
 
         mol_file = self.mol_file
 
-        if not os.access(mol_file, os.R_OK):
+        if not os.access(self._wd(mol_file), os.R_OK):
             raise errors.SetupError('the protein start file %s does not exist '
                                     % mol_file)
 
+        templ_charge, unknown = restemplate.protein_charge(self._wd(mol_file),
+                                                           self.ff_cmd)
+
+        if unknown:
+            logger.write('No residue templates for %s, computing charge '
+                         'with leap' % ', '.join(sorted(set(unknown) ) ) )
+            templ_charge = None
+        elif templ_charge is not None and not verify:
+            self.charge = templ_charge
+            logger.write('Protein charge: %.3f' % self.charge)
+
+            return
+
         out = utils.run_leap('', '', 'tleap',
                              '%s\np = loadpdb %s\ncharge p\n' %
-                             (self.ff_cmd, mol_file) )
+                             (self.ff_cmd, mol_file), cwd=self.workdir)
 
         charge = None
 
@@ -101,6 +119,11 @@ class Protein(Common):
         else:
                 raise errors.SetupError('leap cannot compute charge')
 
+        if templ_charge is not None and \
+               abs(templ_charge - self.charge) > const.MAX_CHARGE_DIFF:
+            logger.write('Warning: charge from residue templates (%.3f) '
+                         'differs from leap' % templ_charge)
+
         logger.write('Protein charge: %.3f' % self.charge)
 
 
@@ -145,13 +168,13 @@ class Protein(Common):
         """
 
 
-        if os.access(const.LEAP_IN, os.F_OK):
+        if os.access(self._wd(const.LEAP_IN), os.F_OK):
             self.amber_top = const.LEAP_IN + self.TOP_EXT
             self.amber_crd = const.LEAP_IN + self.RST_EXT
             self.amber_pdb = const.LEAP_IN + const.PDB_EXT
 
             utils.run_leap(self.amber_top, self.amber_crd, program = 'tleap',
-                     script = const.LEAP_IN)
+                     script = const.LEAP_IN, cwd = self.workdir)
 
             return
 
@@ -160,4 +183,5 @@ class Protein(Common):
                                         remove_first = False,
                                         conc=conc, dens=dens)
 
-        utils.run_leap(self.amber_top, self.amber_crd, 'tleap', leapin)
+        utils.run_leap(self.amber_top, self.amber_crd, 'tleap', leapin,
+                       cwd=self.workdir)
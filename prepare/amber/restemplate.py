@@ -0,0 +1,382 @@
+#  Copyright (C) 2017  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r"""
+Net charges of residue templates from the leap library (OFF) files of a force
+field.  The leaprc files are followed like leap does to collect the library
+files, variable aliases like HIS = HIE and the PDB residue name maps which
+select the terminal variants.  The index is cached on disk per force field so
+that the charge of a protein can be computed without running leap.  Residues
+in prep files are not indexed.
+"""
+
+__revision__ = "$Id$"
+
+
+import os
+import re
+import json
+import hashlib
+import tempfile
+import threading
+
+from FESetup import logger, user_cache_dir
+
+
+
+_LEAP_DIRS = ('cmd', 'cmd/oldff', 'lib', 'lib/oldff', 'prep', 'prep/oldff')
+
+_SOURCE = re.compile(r'^\s*source\s+"?([^"\s]+)', re.IGNORECASE)
+_LOADOFF = re.compile(r'^\s*(?:\w+\s*=\s*)?loadoff\s+"?([^"\s]+)',
+                      re.IGNORECASE)
+_ALIAS = re.compile(r'^\s*([A-Za-z_][\w+-]*)\s*=\s*([A-Za-z_][\w+-]*)\s*$')
+_RESMAP = re.compile(r'\{\s*(?:([01])\s+)?"?([^"\s{}]+)"?\s+"?([^"\s{}]+)"?'
+                     r'\s*\}')
+_ATOMS = re.compile(r'^!entry\.(\S+)\.unit\.atoms table')
+
+_index_cache = {}
+_lock = threading.Lock()
+
+
+def _leap_path():
+    amberhome = os.environ.get('AMBERHOME', '')
+
+    return [os.path.join(amberhome, 'dat', 'leap', sub)
+            for sub in _LEAP_DIRS]
+
+
+def _find(filename, path):
+    if os.path.isabs(filename):
+        return filename if os.path.isfile(filename) else None
+
+    for directory in path:
+        full = os.path.join(directory, filename)
+
+        if os.path.isfile(full):
+            return full
+
+    return None
+
+
+def read_off(filename):
+    """
+    Compute the net charges of all units in a leap library file.
+
+    :param filename: the OFF file name
+    :type filename: str
+    :returns: net charge of every unit
+    :rtype: dict
+    """
+
+    charges = {}
+    unit = None
+
+    with open(filename, 'r') as off:
+        for line in off:
+            if line.startswith('!'):
+                match = _ATOMS.match(line)
+                unit = match.group(1) if match else None
+
+                if unit:
+                    charges[unit] = 0.0
+
+                continue
+
+            if unit:
+                charges[unit] += float(line.split()[-1])
+
+    return charges
+
+
+class ResidueIndex(object):
+    """
+    Residue net charges, aliases and PDB residue name maps of a force field.
+    """
+
+    def __init__(self, units=None, aliases=None, resmap=None):
+        self.units = units or {}
+        self.aliases = aliases or {}
+
+        # '0' N-terminal, '1' C-terminal, '' anywhere
+        self.resmap = resmap or {'0': {}, '1': {}, '': {}}
+
+
+    def source(self, leaprc, path):
+        """
+        Follow a leaprc file.
+
+        :param leaprc: file name
+        :type leaprc: str
+        :param path: leap search path
+        :type path: list of str
+        :returns: False if the file cannot be found
+        :rtype: bool
+        """
+
+        filename = _find(leaprc, path)
+
+        if not filename:
+            return False
+
+        with open(filename, 'r') as rc:
+            text = rc.read()
+
+        block = None
+
+        for line in text.split('\n'):
+            line = line.split('#')[0]
+
+            if block is not None:
+                block += line
+
+                if block.count('{') <= block.count('}'):
+                    self._add_resmap(block)
+                    block = None
+
+                continue
+
+            if 'addpdbresmap' in line.lower():
+                block = line
+
+                if block.count('{') and block.count('{') <= block.count('}'):
+                    self._add_resmap(block)
+                    block = None
+
+                continue
+
+            match = _SOURCE.match(line)
+
+            if match:
+                self.source(match.group(1), path)
+                continue
+
+            match = _LOADOFF.match(line)
+
+            if match:
+                off = _find(match.group(1), path)
+
+                if off:
+                    self.units.update(read_off(off) )
+                else:
+                    logger.write('Warning: library %s not found' %
+                                 match.group(1) )
+
+                continue
+
+            match = _ALIAS.match(line)
+
+            if match:
+                self.aliases[match.group(1)] = match.group(2)
+
+        return True
+
+
+    def _add_resmap(self, block):
+        # drop the command and the outer braces
+        block = block[block.index('{') + 1:block.rindex('}')]
+
+        for term, pdbname, unit in _RESMAP.findall(block):
+            self.resmap[term][pdbname] = unit
+
+
+    def unit_charge(self, resname, term=''):
+        """
+        Net charge of the unit leap would use for a PDB residue.
+
+        :param resname: PDB residue name
+        :type resname: str
+        :param term: '0' for the first and '1' for the last residue of a
+                     chain, '' otherwise
+        :type term: str
+        :returns: the charge or None if there is no template
+        :rtype: float
+        """
+
+        name = None
+
+        if term:
+            name = self.resmap[term].get(resname)
+
+        if not name:
+            name = self.resmap[''].get(resname, resname)
+
+        # aliases may be chained
+        for i in range(10):
+            if name in self.units:
+                return self.units[name]
+
+            if name not in self.aliases:
+                break
+
+            name = self.aliases[name]
+
+        return None
+
+
+def get_index(ff_cmd):
+    """
+    Get the residue index of a force field from memory, the disk cache or by
+    reading the leap files.
+
+    :param ff_cmd: leap commands loading the force field
+    :type ff_cmd: str
+    :returns: the index or None if a leaprc file cannot be found
+    :rtype: ResidueIndex
+    """
+
+    leaprcs = [match.group(1) for match in
+               (_SOURCE.match(line) for line in ff_cmd.split('\n') )
+               if match]
+    path = _leap_path()
+    digest = hashlib.sha1(os.environ.get('AMBERHOME', '') )
+
+    for leaprc in leaprcs:
+        filename = _find(leaprc, path)
+
+        if not filename:
+            return None
+
+        digest.update('\0%s %f' % (filename, os.path.getmtime(filename) ) )
+
+    key = digest.hexdigest()
+
+    with _lock:
+        if key in _index_cache:
+            return _index_cache[key]
+
+        cachedir = user_cache_dir()
+        cache_file = os.path.join(cachedir, 'restemplates-%s.json' % key)
+
+        try:
+            with open(cache_file, 'r') as cache:
+                index = ResidueIndex(**json.load(cache) )
+        except (IOError, ValueError, TypeError):
+            index = ResidueIndex()
+
+            for leaprc in leaprcs:
+                index.source(leaprc, path)
+
+            try:
+                if not os.path.isdir(cachedir):
+                    os.makedirs(cachedir)
+
+                tmp = tempfile.NamedTemporaryFile('w', dir=cachedir,
+                                                  delete=False)
+
+                with tmp:
+                    json.dump({'units': index.units,
+                               'aliases': index.aliases,
+                               'resmap': index.resmap}, tmp)
+
+                os.rename(tmp.name, cache_file)
+            except (IOError, OSError):
+                # the cache is optional
+                pass
+
+        _index_cache[key] = index
+
+    return index
+
+
+def pdb_residues(filename):
+    """
+    Read the residue names and the terminal positions from a PDB file.  A
+    chain ends at a TER record as in leap.
+
+    :param filename: PDB file name
+    :type filename: str
+    :returns: residue name and '0', '1' or '' for every residue
+    :rtype: list of 2-tuples
+    """
+
+    chains = [[]]
+    last = None
+
+    with open(filename, 'r') as pdb:
+        for line in pdb:
+            record = line[:6].strip()
+
+            if record in ('TER', 'END', 'ENDMDL'):
+                if chains[-1]:
+                    chains.append([])
+
+                last = None
+
+                if record != 'TER':
+                    break
+
+                continue
+
+            if record not in ('ATOM', 'HETATM'):
+                continue
+
+            key = line[17:27]
+
+            if key != last:
+                chains[-1].append(line[17:21].strip() )
+                last = key
+
+    residues = []
+
+    for chain in chains:
+        for idx, resname in enumerate(chain):
+            if len(chain) == 1:
+                term = ''
+            elif idx == 0:
+                term = '0'
+            elif idx == len(chain) - 1:
+                term = '1'
+            else:
+                term = ''
+
+            residues.append( (resname, term) )
+
+    return residues
+
+
+def protein_charge(filename, ff_cmd):
+    """
+    Compute the net charge of a PDB file from the residue templates.
+
+    :param filename: PDB file name
+    :type filename: str
+    :param ff_cmd: leap commands loading the force field
+    :type ff_cmd: str
+    :returns: the charge and a list of residue names without template, the
+              charge is None when there is no index
+    :rtype: float, list of str
+    """
+
+    index = get_index(ff_cmd)
+
+    if not index:
+        return None, []
+
+    charge = 0.0
+    unknown = []
+
+    for resname, term in pdb_residues(filename):
+        unit_charge = index.unit_charge(resname, term)
+
+        if unit_charge is None:
+            unknown.append(resname)
+        else:
+            charge += unit_charge
+
+    return round(charge, 6), unknown
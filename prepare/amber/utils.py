@@ -31,10 +31,219 @@ import re
 import shlex
 import string
 import glob
+import time
+import fcntl
+import shutil
+import signal
+import threading
+import multiprocessing
 import subprocess as subp
 
-from FESetup import const, errors, logger
+from contextlib import contextmanager
 
+import leapsession                      # relative import
+import leapcache                        # relative import
+
+from FESetup import const, errors, logger, profiler
+
+
+# options of MPI launchers giving the number of processes
+_NPROC_OPTS = ('-np', '-n', '--np', '--ntasks')
+_LOCK_POLL = 0.5
+# Linux ioctl cloning a file on copy-on-write file systems (btrfs, XFS)
+_FICLONE = 0x40049409
+# bytes read per step from the end of a file
+_TAIL_BLOCK = 4096
+
+_copy_mode = 'copy'
+
+
+def _set_cloexec(fileobj):
+    """
+    Keep a lock file from being inherited by the programs started while the
+    lock is held, which would keep the lock after it has been released.
+    """
+
+    flags = fcntl.fcntl(fileobj, fcntl.F_GETFD)
+    fcntl.fcntl(fileobj, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+class CoreSlots(object):
+    """
+    Weighted slot limiter for external programs.  Every launch declares the
+    number of cores it will use and waits until that many of the configured
+    total are free.  Without lock directory the counter is shared between the
+    threads of this process and all processes forked after creation.  With a
+    lock directory every core is represented by a lock file so that
+    independent processes, e.g. several dGprep runs on one node, share the
+    same budget.
+    """
+
+    def __init__(self, total, lockdir=None):
+        """
+        :param total: maximum number of cores in use at any time
+        :type total: int
+        :param lockdir: directory for the lock files, in-process counter if
+                        None
+        :type lockdir: str
+        """
+
+        if total < 1:
+            raise errors.SetupError('core budget must be at least 1')
+
+        self.total = total
+        self.lockdir = lockdir
+
+        if lockdir:
+            if not os.path.isdir(lockdir):
+                os.makedirs(lockdir)
+
+            self._guard = os.path.join(lockdir, 'cores.lock')
+        else:
+            self._cond = multiprocessing.Condition()
+            self._used = multiprocessing.Value('i', 0, lock=False)
+
+
+    def _acquire_local(self, cost):
+        with self._cond:
+            while self._used.value + cost > self.total:
+                self._cond.wait()
+
+            self._used.value += cost
+
+
+    def _release_local(self, cost):
+        with self._cond:
+            self._used.value -= cost
+            self._cond.notify_all()
+
+
+    def _acquire_files(self, cost):
+        # slots are only picked while holding the guard so that two launches
+        # cannot each hold part of what the other one needs
+        while True:
+            held = []
+
+            with open(self._guard, 'a') as guard:
+                _set_cloexec(guard)
+                fcntl.flock(guard, fcntl.LOCK_EX)
+
+                try:
+                    for slot in range(self.total):
+                        lock = open(os.path.join(self.lockdir,
+                                                 'core.%i' % slot), 'a')
+                        _set_cloexec(lock)
+
+                        try:
+                            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        except IOError:
+                            lock.close()
+                            continue
+
+                        held.append(lock)
+
+                        if len(held) == cost:
+                            return held
+                finally:
+                    fcntl.flock(guard, fcntl.LOCK_UN)
+
+            for lock in held:
+                lock.close()
+
+            time.sleep(_LOCK_POLL)
+
+
+    @contextmanager
+    def cores(self, cost):
+        """
+        Context manager holding cost cores while the body runs.  Costs above
+        the total are capped so that a single large job can still run.
+
+        :param cost: number of cores
+        :type cost: int
+        """
+
+        cost = max(1, min(cost, self.total) )
+
+        if self.lockdir:
+            held = self._acquire_files(cost)
+        else:
+            self._acquire_local(cost)
+
+        try:
+            yield
+        finally:
+            if self.lockdir:
+                for lock in held:
+                    lock.close()
+            else:
+                self._release_local(cost)
+
+
+_core_slots = None
+
+
+def set_core_limit(total, lockdir=None):
+    """
+    Limit the number of cores used by all external programs started through
+    this module.  Must be called before worker processes are forked.
+
+    :param total: maximum number of cores, no limit if None
+    :type total: int
+    :param lockdir: share the budget with other processes through lock files
+                    in this directory
+    :type lockdir: str
+    """
+
+    global _core_slots
+
+    _core_slots = CoreSlots(total, lockdir) if total else None
+
+
+@contextmanager
+def reserve_cores(cost):
+    """
+    Context manager holding cores from the budget set with set_core_limit()
+    while the body runs.
+
+    :param cost: number of cores
+    :type cost: int
+    """
+
+    if _core_slots:
+        with _core_slots.cores(cost):
+            yield
+    else:
+        yield
+
+
+def prefix_cores(prefix):
+    """
+    Number of cores requested by an MPI launcher prefix like 'mpirun -np 8'.
+
+    :param prefix: the command prefix
+    :type prefix: str
+    :returns: number of processes, 1 if none given
+    :rtype: int
+    """
+
+    words = shlex.split(prefix)
+
+    for i, word in enumerate(words):
+        opt, sep, value = word.partition('=')
+
+        if opt not in _NPROC_OPTS:
+            continue
+
+        if not sep:
+            value = words[i+1] if i + 1 < len(words) else ''
+
+        try:
+            return max(1, int(value) )
+        except ValueError:
+            pass
+
+    return 1
 
 
 def self_check():
@@ -115,7 +324,7 @@ def _setenv():
     return env
 
 
-def run_amber(program, params):
+def run_amber(program, params, cwd=None, cores=1):
     """
     Simple wrapper to execute external AMBER programs through subprocess.
 
@@ -123,6 +332,10 @@ def run_amber(program, params):
     :type program: string
     :param params: paramters to the AMBER program
     :type params: string
+    :param cwd: directory to run the program in, current directory if None
+    :type cwd: string
+    :param cores: number of cores the program will use
+    :type cores: int
     :raises: SetupError
     :returns: True on failure
     """
@@ -134,8 +347,10 @@ def run_amber(program, params):
     logger.write('Executing command:\n%s %s\n' % (program, params) )
 
     env = _setenv()
-    proc = subp.Popen(cmd, stdout=subp.PIPE, stderr=subp.PIPE, env=env)
-    out, err = proc.communicate()
+    with reserve_cores(cores), profiler.command(cmd):
+        proc = subp.Popen(cmd, stdout=subp.PIPE, stderr=subp.PIPE, env=env,
+                          cwd=cwd)
+        out, err = proc.communicate()
 
     for stream in out, err:
         text = _cleanup_string(stream)
@@ -150,7 +365,246 @@ def run_amber(program, params):
     return False
 
 
-def run_leap(top, crd, program='tleap', script=''):
+def use_leap_cache(cachedir, max_size=2048, link=True):
+    """
+    Reuse the results of leap scripts which have been run before with the
+    same input files.
+
+    :param cachedir: cache directory, no caching if empty
+    :type cachedir: str
+    :param max_size: maximum size of the cache in MB
+    :type max_size: int
+    :param link: hardlink cached files into place instead of copying
+    :type link: bool
+    """
+
+    leapcache.configure(cachedir, max_size * 1024 * 1024, link)
+
+
+def use_leap_sessions(enabled=True):
+    """
+    Run tleap scripts in long-lived sessions which keep the force fields
+    loaded instead of starting a new tleap for every script.  Jobs which fail
+    in a session are rerun with a fresh tleap.
+
+    :param enabled: switch sessions on or off
+    :type enabled: bool
+    """
+
+    leapsession.sessions.enabled = enabled
+
+
+def set_copy_mode(mode):
+    """
+    Set how input files are placed into work directories.  In link mode
+    files are reflinked (copy-on-write) where the file system supports it,
+    else hardlinked and only copied as a last resort.  Hardlinked files
+    share their contents and permissions with the source file, so the
+    sources must not be modified while they are in use.
+
+    :param mode: copy or link
+    :type mode: str
+    :raises: SetupError
+    """
+
+    global _copy_mode
+
+    if mode not in ('copy', 'link'):
+        raise errors.SetupError('unknown copy mode %s' % mode)
+
+    if mode == 'link':
+        logger.write('Warning: input files may be hardlinked into work '
+                     'directories and share their contents with the '
+                     'sources')
+
+    _copy_mode = mode
+
+
+def _reflink(src, dst):
+    with open(src, 'rb') as inp:
+        with open(dst, 'wb') as out:
+            try:
+                fcntl.ioctl(out.fileno(), _FICLONE, inp.fileno() )
+            except (IOError, OSError):
+                return False
+
+    return True
+
+
+def place_file(src, dst):
+    """
+    Place an input file into a work directory according to the copy mode.
+    An existing destination is removed first, never overwritten in place.
+
+    :param src: source file name
+    :type src: str
+    :param dst: destination file name
+    :type dst: str
+    :raises: SetupError
+    """
+
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src) )
+
+    try:
+        if os.path.lexists(dst):
+            os.remove(dst)
+
+        if _copy_mode == 'link':
+            # a reflink is an independent file and may be modified freely
+            if _reflink(src, dst):
+                shutil.copystat(src, dst)
+                return
+
+            os.remove(dst)
+
+            try:
+                # permissions of the shared inode are left untouched
+                os.link(src, dst)
+                return
+            except OSError:
+                # other file system, foreign file or no hardlink support
+                if os.path.lexists(dst):
+                    os.remove(dst)
+
+        shutil.copy(src, dst)
+    except (IOError, OSError) as why:
+        raise errors.SetupError('cannot place %s into %s: %s' %
+                                (src, dst, why) )
+
+
+def _read_last_line(filename):
+    with open(filename, 'rb') as inp:
+        inp.seek(0, os.SEEK_END)
+        pos = inp.tell()
+        data = ''
+
+        while pos > 0:
+            step = min(_TAIL_BLOCK, pos)
+            pos -= step
+            inp.seek(pos)
+            data = inp.read(step) + data
+
+            lines = data.rstrip().split('\n')
+
+            # the first line may be incomplete unless the start was reached
+            if len(lines) > 1 or pos == 0:
+                return lines[-1]
+
+    return ''
+
+
+def last_line(filename):
+    """
+    Get the last non-empty line of a file, e.g. the box of an rst7 file,
+    by reading backwards from the end of the file.
+
+    :param filename: file name
+    :type filename: str
+    :returns: the line without line terminator
+    :rtype: str
+    :raises: SetupError
+    """
+
+    try:
+        return _read_last_line(filename)
+    except IOError as why:
+        raise errors.SetupError('cannot read %s: %s' % (filename, why) )
+
+
+def _leap_created(top, crd):
+    return os.path.isfile(top) and os.path.isfile(crd) and \
+           os.path.getsize(top) > 0 and os.path.getsize(crd) > 0
+
+
+def _run_leap_session(leap, script, cwd, top, crd, env):
+    """
+    Run a leap script in a session.
+
+    :returns: output from leap or None if the script must be run by a fresh
+              tleap
+    """
+
+    split = leapsession.split_script(script, cwd or os.getcwd() )
+
+    if not split:
+        return None
+
+    preamble, body, names, loads = split
+
+    # a stale file must not be mistaken for output of a failed job
+    for filename in top, crd:
+        if filename and os.path.isfile(filename):
+            os.remove(filename)
+
+    logger.write('Executing in tleap session:\n%s\n' % body)
+
+    try:
+        with reserve_cores(1), profiler.command([leap, '(session)']):
+            session = leapsession.sessions.checkout(leap, preamble, env,
+                                                    loads)
+
+            try:
+                out = session.run(body, names)
+            finally:
+                leapsession.sessions.checkin(session)
+    except (leapsession.LeapSessionError, OSError) as why:
+        logger.write('tleap session failed: %s' % why)
+        return None
+
+    if top and crd and not _leap_created(top, crd):
+        logger.write('tleap session did not create %s, %s' % (top, crd) )
+        return None
+
+    return out
+
+
+def start_amber(program, params, cwd=None, stdout=None, stderr=None):
+    """
+    Start an AMBER program in its own process group without waiting for it.
+    The caller is responsible for reserving cores.
+
+    :param program: AMBER program file name
+    :type program: string
+    :param params: paramters to the AMBER program
+    :type params: string
+    :param cwd: directory to run the program in, current directory if None
+    :type cwd: string
+    :param stdout: file to write the standard output to
+    :type stdout: file
+    :param stderr: file to write the standard error to
+    :type stderr: file
+    :returns: the process
+    :rtype: subprocess.Popen
+    """
+
+    cmd = shlex.split(program)
+    cmd.extend(shlex.split(params))
+
+    logger.write('Starting command:\n%s %s\n' % (program, params) )
+
+    return subp.Popen(cmd, stdout=stdout, stderr=stderr, env=_setenv(),
+                      cwd=cwd, preexec_fn=os.setsid)
+
+
+def kill_amber(proc):
+    """
+    Terminate a program started with start_amber() together with all the
+    programs it has started itself, e.g. sqm run by antechamber.
+
+    :param proc: the process
+    :type proc: subprocess.Popen
+    """
+
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except OSError:
+        pass
+
+    proc.wait()
+
+
+def run_leap(top, crd, program='tleap', script='', cwd=None):
     """
     Simple wrapper to execute the AMBER leap program.
 
@@ -163,34 +617,74 @@ def run_leap(top, crd, program='tleap', script=''):
     :param script: leap script as string, if 'leap.in' read from respective file
       name
     :type script: string
+    :param cwd: directory to run leap in, relative file names are interpreted
+       relative to it, current directory if None
+    :type cwd: string
     :returns: output from leap
     :raises: SetupError
     """
 
 
     leap = check_amber(program)
-    cmd = [leap, '-f']
 
+    if top and crd and cwd:
+        top = os.path.join(cwd, top)
+        crd = os.path.join(cwd, crd)
+
+    cache = leapcache.cache
+
+    if not cache or script == 'leap.in':
+        return _execute_leap(leap, program, script, cwd, top, crd)
+
+    outputs = leapcache.output_files(script, cwd or os.getcwd() )
+    key = cache.key(leap, script, cwd or os.getcwd() )
+    out = cache.fetch(key, outputs)
+
+    if out is not None:
+        logger.write('Leap results taken from cache entry %s:\n%s\n' %
+                     (key, '\n'.join(outputs) ) )
+        return out
+
+    cache.prepare(outputs)
+    out = _execute_leap(leap, program, script, cwd, top, crd)
+    cache.store(key, outputs, out)
+
+    return out
+
+
+def _execute_leap(leap, program, script, cwd, top, crd):
+    cmd = [leap, '-f']
     env = _setenv()
 
+    if leapsession.sessions.enabled and program == 'tleap' and \
+           script != 'leap.in':
+        out = _run_leap_session(leap, script, cwd, top, crd, env)
+
+        if out is not None:
+            return out
+
+        logger.write('Rerunning with a fresh tleap')
+
     if script == 'leap.in':
         cmd.append(script)
         logger.write('Executing command:\n%s' % ' '.join(cmd) )
 
-        proc = subp.Popen(cmd, stdin=None, stdout=subp.PIPE, stderr=subp.PIPE,
-                          env=env)
-        out = proc.communicate()[0]
+        with reserve_cores(1), profiler.command(cmd):
+            proc = subp.Popen(cmd, stdin=None, stdout=subp.PIPE,
+                              stderr=subp.PIPE, env=env, cwd=cwd)
+            out = proc.communicate()[0]
     else:
         cmd.append('-')
         logger.write('Executing command:\n%s -f - <<_EOF \n%s\n_EOF\n' %
                      (leap, script) )
 
-        proc = subp.Popen(cmd, stdin=subp.PIPE, stdout=subp.PIPE,
-                          stderr=subp.PIPE, env=env)
-        out = proc.communicate(script)[0]
+        with reserve_cores(1), profiler.command(cmd):
+            proc = subp.Popen(cmd, stdin=subp.PIPE, stdout=subp.PIPE,
+                              stderr=subp.PIPE, env=env, cwd=cwd)
+            out = proc.communicate(script)[0]
 
     if top and crd:
-        if os.path.getsize(top) == 0 or os.path.getsize(crd) == 0:
+        if not _leap_created(top, crd):
             raise errors.SetupError(
                 'Leap did not create the topology and/or coordinate '
                 'file(s): %s, %s' % (top, crd)
@@ -199,12 +693,16 @@ def run_leap(top, crd, program='tleap', script=''):
     return out
 
 
-def run_exe(cmdline):
+def run_exe(cmdline, cwd=None, cores=1):
     """
     Simple wrapper to execute the external programs through subprocess.
 
     :param cmdline: complete command line as given on a shell prompt
     :type cmdline: str
+    :param cwd: directory to run the program in, current directory if None
+    :type cwd: str
+    :param cores: number of cores the program will use
+    :type cores: int
     """
 
     logger.write('Executing command:\n%s\n' % cmdline)
@@ -216,8 +714,9 @@ def run_exe(cmdline):
     else:
          env['LD_LIBRARY_PATH'] = ''
 
-    proc = subp.Popen(shlex.split(cmdline), stdout=subp.PIPE, stderr=subp.PIPE,
-                      env=env)
-    out, err =  proc.communicate()
+    with reserve_cores(cores), profiler.command(cmdline):
+        proc = subp.Popen(shlex.split(cmdline), stdout=subp.PIPE,
+                          stderr=subp.PIPE, env=env, cwd=cwd)
+        out, err =  proc.communicate()
 
     return proc.returncode, out, err
@@ -0,0 +1,249 @@
+#  Copyright (C) 2017  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r"""
+Rigid body alignment of molecules onto a reference structure.  The reference
+is read once and the optimal rotations for a whole batch of targets are
+computed with the Kabsch algorithm on stacked coordinate arrays.  Atoms are
+matched by their order as in OBAlign without symmetry.  OBAlign is only used
+when the atoms cannot be matched by order or when symmetry is requested.
+"""
+
+__revision__ = "$Id$"
+
+
+import numpy as np
+import openbabel as ob
+
+from FESetup import const, errors, logger
+
+
+
+def kabsch(ref, targets):
+    """
+    Compute the optimal superposition of a batch of targets onto a reference.
+
+    :param ref: reference coordinates, shape (N, 3)
+    :type ref: numpy.ndarray
+    :param targets: target coordinates, shape (B, N, 3)
+    :type targets: numpy.ndarray
+    :returns: rotation matrices (B, 3, 3) to be applied as x.dot(R),
+              translations (B, 3) and RMSDs (B) after superposition
+    :rtype: tuple of numpy.ndarray
+    """
+
+    ref_com = ref.mean(axis=0)
+    tgt_com = targets.mean(axis=1)
+
+    P = targets - tgt_com[:, np.newaxis, :]
+    Q = ref - ref_com
+
+    # covariance matrices of all targets at once
+    H = np.einsum('bni,nj->bij', P, Q)
+    U, S, Vt = np.linalg.svd(H)
+
+    # correct for reflections
+    d = np.sign(np.linalg.det(np.einsum('bij,bjk->bik', U, Vt) ) )
+    U[:, :, 2] *= d[:, np.newaxis]
+
+    R = np.einsum('bij,bjk->bik', U, Vt)
+    trans = ref_com - np.einsum('bi,bij->bj', tgt_com, R)
+
+    diff = np.einsum('bni,bij->bnj', P, R) - Q
+    rmsd = np.sqrt( (diff * diff).sum(axis=2).mean(axis=1) )
+
+    return R, trans, rmsd
+
+
+def _read(filename, fmt):
+    conv = ob.OBConversion()
+    mol = ob.OBMol()
+
+    # ignore warning messages about non-standard PDB
+    errlev = ob.obErrorLog.GetOutputLevel()
+    ob.obErrorLog.SetOutputLevel(0)
+
+    try:
+        success = conv.SetInFormat(fmt) and conv.ReadFile(mol, filename)
+    finally:
+        ob.obErrorLog.SetOutputLevel(errlev)
+
+    if not success:
+        raise errors.SetupError('cannot read %s (%s format)' % (filename, fmt))
+
+    return mol
+
+
+def _coordinates(mol):
+    return np.array([(atom.GetX(), atom.GetY(), atom.GetZ() )
+                     for atom in ob.OBMolAtomIter(mol)], dtype=np.float64)
+
+
+class AlignEngine(object):
+    """
+    Align molecules onto a reference structure which is read only once.
+    """
+
+    def __init__(self, ref_file, ref_fmt, inc_hyd=False, symmetry=False,
+                 filt=False):
+        """
+        :param ref_file: reference structure file name
+        :type ref_file: str
+        :param ref_fmt: format of the reference file
+        :type ref_fmt: str
+        :param inc_hyd: include hydrogens
+        :type inc_hyd: bool
+        :param symmetry: consider symmetry of the molecule, requires OBAlign
+        :type symmetry: bool
+        :param filt: ignore solvent, ions and residues in IGNORE_RESIDUES
+        :type filt: bool
+        :raises: SetupError
+        """
+
+        self.ref_file = ref_file
+        self.inc_hyd = inc_hyd
+        self.symmetry = symmetry
+        self.filt = filt
+
+        self.ref = _read(ref_file, ref_fmt)
+        self.ref_coords = _coordinates(self.ref)[self._selection(self.ref)]
+
+        # OBAlign needs the same atom set on both sides
+        self.ob_ref = ob.OBMol(self.ref)
+
+        if filt:
+            delat = [atom for atom in ob.OBMolAtomIter(self.ob_ref)
+                     if atom.GetResidue() and
+                     atom.GetResidue().GetName() in const.IGNORE_RESIDUES]
+
+            self.ob_ref.BeginModify()
+
+            for atom in delat:
+                self.ob_ref.DeleteAtom(atom, True)
+
+            self.ob_ref.EndModify()
+
+
+    def _selection(self, mol):
+        """Indices of the atoms used for fitting."""
+
+        sel = []
+
+        for idx, atom in enumerate(ob.OBMolAtomIter(mol) ):
+            if not self.inc_hyd and atom.GetAtomicNum() == 1:
+                continue
+
+            if self.filt:
+                res = atom.GetResidue()
+
+                if res and res.GetName() in const.IGNORE_RESIDUES:
+                    continue
+
+            sel.append(idx)
+
+        return np.array(sel, dtype=int)
+
+
+    def _ob_align(self, mol, coords, sel):
+        """
+        Fall back to OBAlign.  The rotation is applied to all atoms.
+
+        :returns: the new coordinates and the RMSD or None, None on failure
+        """
+
+        fit = ob.OBMol()
+
+        for idx in sel:
+            fit.AddAtom(mol.GetAtom(int(idx) + 1) )
+
+        molecs = ob.OBAlign(self.ob_ref, fit, self.inc_hyd, self.symmetry)
+
+        if not molecs.Align():
+            return None, None
+
+        rot = molecs.GetRotMatrix()
+        R = np.array([[rot.Get(i, j) for j in range(3)] for i in range(3)])
+        before = coords[sel]
+        molecs.UpdateCoords(fit)
+        after = _coordinates(fit)
+
+        # OBAlign rotates about the centroids of the fitted atoms
+        shift = after.mean(axis=0) - before.mean(axis=0).dot(R.T)
+
+        return coords.dot(R.T) + shift, molecs.GetRMSD()
+
+
+    def align(self, targets):
+        """
+        Align a batch of molecules onto the reference and overwrite their
+        files with the aligned coordinates.
+
+        :param targets: file names and formats of the molecules
+        :type targets: list of 2-tuples of str
+        :returns: RMSD of every molecule, None if its alignment failed
+        :rtype: list of float
+        :raises: SetupError
+        """
+
+        mols = []
+        batch = []
+
+        for filename, fmt in targets:
+            mol = _read(filename, fmt)
+            coords = _coordinates(mol)
+            sel = self._selection(mol)
+            mols.append( (mol, coords, sel) )
+
+            if not self.symmetry and len(sel) == len(self.ref_coords):
+                batch.append(len(mols) - 1)
+
+        rmsds = [None] * len(mols)
+        new_coords = [None] * len(mols)
+
+        if batch:
+            R, trans, rmsd = kabsch(self.ref_coords,
+                                    np.array([mols[i][1][mols[i][2]]
+                                              for i in batch]) )
+
+            for k, i in enumerate(batch):
+                new_coords[i] = mols[i][1].dot(R[k]) + trans[k]
+                rmsds[i] = float(rmsd[k])
+
+        for i, (mol, coords, sel) in enumerate(mols):
+            if new_coords[i] is None:
+                logger.write('Atoms of %s cannot be matched by order, '
+                             'using OBAlign' % targets[i][0])
+                new_coords[i], rmsds[i] = self._ob_align(mol, coords, sel)
+
+                if new_coords[i] is None:
+                    logger.write('Alignment of %s failed' % targets[i][0])
+                    continue
+
+            for atom, (x, y, z) in zip(ob.OBMolAtomIter(mol), new_coords[i]):
+                atom.SetVector(x, y, z)
+
+            conv = ob.OBConversion()
+            conv.SetOutFormat(targets[i][1])
+
+            try:
+                conv.WriteFile(mol, targets[i][0])
+            except IOError as why:
+                raise errors.SetupError(why)
+
+        return rmsds
@@ -26,15 +26,22 @@ __revision__ = "$Id$"
 
 
 
-import os, sys, re
+import os, sys, re, math, random, hashlib
+from collections import OrderedDict
 
 import pybel
 import openbabel as ob
 
-from FESetup import const, errors, report, logger
+from FESetup import const, errors, report, logger, run_forked
+from FESetup.prepare.kabsch import AlignEngine
 
 
 
+# alignment engines keyed by reference file and options
+_align_engines = {}
+_MAX_ALIGN_ENGINES = 8
+
+
 ### not-imported functions ###
 def ob_read_one(conv, filen, mol, ifmt, ofmt):
     """
@@ -77,6 +84,319 @@ def ob_read_one(conv, filen, mol, ifmt, ofmt):
     return mol, conv
 
 
+def canonical_key(filen, fmt, text=None):
+    """
+    Compute a key identifying a chemical entity independent of its name,
+    pose and atom order: the canonical SMILES, which includes the formal
+    charges, and the total charge.
+
+    :param filen: molecular structure file name
+    :type filen: string
+    :param fmt: molecular structure file format known to Openbabel
+    :type fmt: string
+    :param text: the structure itself, filen is only used for messages
+    :type text: string
+    :returns: canonical SMILES and total charge
+    :rtype: tuple
+    :raises: SetupError
+    """
+
+    conv = ob.OBConversion()
+    mol = ob.OBMol()
+
+    if text is None:
+        ob_read_one(conv, filen, mol, fmt, 'can')
+    elif not conv.SetInAndOutFormats(fmt, 'can') or \
+             not conv.ReadString(mol, text):
+        raise errors.SetupError('cannot read %s (%s format)' % (filen, fmt) )
+
+    return conv.WriteString(mol).split()[0], mol.GetTotalCharge()
+
+
+def map_atoms(ref_file, ref_fmt, filen, fmt):
+    """
+    Map the atoms of a molecule onto those of an identical molecule
+    which may have a different pose and atom order.
+
+    :param ref_file: structure file name of the reference molecule
+    :type ref_file: string
+    :param ref_fmt: format of the reference file
+    :type ref_fmt: string
+    :param filen: structure file name of the molecule
+    :type filen: string
+    :param fmt: format of the file
+    :type fmt: string
+    :returns: index of the reference atom for every atom of the molecule
+    :rtype: list of int
+    :raises: SetupError
+    """
+
+    conv = ob.OBConversion()
+    ref = ob.OBMol()
+    mol = ob.OBMol()
+    ob_read_one(conv, ref_file, ref, ref_fmt, ref_fmt)
+    ob_read_one(conv, filen, mol, fmt, fmt)
+
+    natoms = mol.NumAtoms()
+
+    if ref.NumAtoms() != natoms:
+        raise errors.SetupError('%s and %s differ in the number of atoms' %
+                                (ref_file, filen) )
+
+    query = ob.CompileMoleculeQuery(ref)
+    mapper = ob.OBIsomorphismMapper.GetInstance(query)
+    mapping = ob.vpairUIntUInt()
+    mapper.MapFirst(mol, mapping)
+
+    if len(mapping) != natoms:
+        raise errors.SetupError('cannot map the atoms of %s onto %s' %
+                                (filen, ref_file) )
+
+    index = [0] * natoms
+
+    for ref_idx, idx in mapping:
+        index[idx] = ref_idx
+
+    return index
+
+
+def _perturb_torsions(obmol, seed):
+    """
+    Set all rotatable torsions to random angles so that ensemble members
+    start from different geometries.
+    """
+
+    rand = random.Random(seed)
+
+    for bond in ob.OBMolBondIter(obmol):
+        if not bond.IsRotor():
+            continue
+
+        b = bond.GetBeginAtom()
+        c = bond.GetEndAtom()
+        a = [n for n in ob.OBAtomAtomIter(b) if n.GetIdx() != c.GetIdx()]
+        d = [n for n in ob.OBAtomAtomIter(c) if n.GetIdx() != b.GetIdx()]
+
+        if a and d:
+            obmol.SetTorsion(a[0], b, c, d[0], rand.uniform(-math.pi, math.pi))
+
+
+def _rotor_search(obmol, ffield, ref_ffield, seed, numconf, geomsteps,
+                  steep_steps, steep_econv, conj_steps, conj_econv):
+    """
+    A single weighted rotor search with pre and post minimisation.  The
+    final energy is computed with the reference force field so that results
+    from different force fields can be compared.
+
+    :returns: energy and coordinates
+    :rtype: float, list of 3-tuples
+    """
+
+    obmol = ob.OBMol(obmol)
+
+    if seed:
+        _perturb_torsions(obmol, seed)
+
+    obff = ob.OBForceField.FindForceField(ffield)
+
+    if not obff:
+        raise errors.SetupError('Error: cannot find %s force field' % ffield)
+
+    if not obff.Setup(obmol):
+        raise errors.SetupError('Error: cannot setup mol with %s force '
+                                'field' % ffield)
+
+    obff.SteepestDescent(steep_steps, steep_econv)
+    obff.WeightedRotorSearch(numconf, geomsteps)
+    obff.ConjugateGradients(conj_steps, conj_econv)
+    obff.GetCoordinates(obmol)
+
+    if ffield != ref_ffield:
+        obff = ob.OBForceField.FindForceField(ref_ffield)
+
+        if not obff or not obff.Setup(obmol):
+            raise errors.SetupError('Error: cannot setup mol with %s force '
+                                    'field' % ref_ffield)
+
+    return obff.Energy(), [(atom.GetX(), atom.GetY(), atom.GetZ() )
+                           for atom in ob.OBMolAtomIter(obmol)]
+
+
+class MolLibrary(object):
+    """
+    A multi-record SDF or MOL2 file.  The file is scanned once for the start
+    and length of every record, records are only read when requested.
+    Record names are taken from the title lines and made unique and usable
+    as directory names.
+    """
+
+    FORMATS = {'sdf': 'sdf', 'sd': 'sdf', 'mol': 'sdf', 'mol2': 'mol2'}
+
+    def __init__(self, filen, fmt=''):
+        """
+        :param filen: the library file name
+        :type filen: string
+        :param fmt: file format, sdf or mol2, from the file extension if empty
+        :type fmt: string
+        :raises: SetupError
+        """
+
+        self.filename = os.path.abspath(filen)
+
+        if not fmt:
+            fmt = os.path.splitext(filen)[1][1:]
+
+        try:
+            self.fmt = self.FORMATS[fmt.lower()]
+        except KeyError:
+            raise errors.SetupError('unsupported library format %s, must be '
+                                    'SDF or MOL2' % fmt)
+
+        self.index = OrderedDict()
+
+        try:
+            self._scan()
+        except IOError as why:
+            raise errors.SetupError('cannot read library: %s' % why)
+
+        if not self.index:
+            raise errors.SetupError('no molecules found in library %s' % filen)
+
+
+    def _scan(self):
+        records = []
+        start = None
+        pos = 0
+        title_next = False
+        blank = True
+
+        with open(self.filename, 'rb') as lib:
+            if self.fmt == 'sdf':
+                for line in lib:
+                    if start is None:
+                        start = pos
+                        title = line.strip()
+                        blank = True
+
+                    pos += len(line)
+                    blank = blank and not line.strip()
+
+                    if line.startswith('$$$$'):
+                        records.append( (title, start, pos - start) )
+                        start = None
+
+                # last record without terminator
+                if start is not None and not blank:
+                    records.append( (title, start, pos - start) )
+            else:
+                for line in lib:
+                    if line.startswith('@<TRIPOS>MOLECULE'):
+                        if start is not None:
+                            records.append( (title, start, pos - start) )
+
+                        start = pos
+                        title_next = True
+                    elif title_next:
+                        title = line.strip()
+                        title_next = False
+
+                    pos += len(line)
+
+                if start is not None:
+                    records.append( (title, start, pos - start) )
+
+        for num, (title, offset, length) in enumerate(records, 1):
+            name = re.sub(r'[^\w.+-]', '_', title).strip('.')
+
+            if not name:
+                name = 'mol%i' % num
+
+            # the renamed title may itself be taken by an earlier record
+            base = name
+            suffix = num
+
+            while name in self.index:
+                name = '%s_%i' % (base, suffix)
+                suffix += 1
+
+            if name != base:
+                logger.write('Warning: duplicate molecule title %s in %s, '
+                             'renamed to %s' % (base, self.filename, name) )
+
+            self.index[name] = (offset, length)
+
+
+    def __contains__(self, name):
+        return name in self.index
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+    @property
+    def names(self):
+        """Record names in file order."""
+
+        return self.index.keys()
+
+
+    def read(self, name):
+        """
+        Read a record.
+
+        :param name: record name
+        :type name: string
+        :returns: the record
+        :rtype: string
+        :raises: SetupError
+        """
+
+        try:
+            offset, length = self.index[name]
+        except KeyError:
+            raise errors.SetupError('no molecule %s in library %s' %
+                                    (name, self.filename) )
+
+        with open(self.filename, 'rb') as lib:
+            lib.seek(offset)
+
+            return lib.read(length)
+
+
+    def digest(self, name):
+        """
+        Compute the SHA1 of a record.
+
+        :param name: record name
+        :type name: string
+        :returns: hex digest
+        :rtype: string
+        """
+
+        return hashlib.sha1(self.read(name) ).hexdigest()
+
+
+    def extract(self, name, filen):
+        """
+        Write a record to a file.
+
+        :param name: record name
+        :type name: string
+        :param filen: output file name
+        :type filen: string
+        :raises: SetupError
+        """
+
+        text = self.read(name)
+
+        try:
+            with open(filen, 'wb') as mol:
+                mol.write(text)
+        except IOError as why:
+            raise errors.SetupError(why)
+
+
 ### imported methods ###
 @report
 def prepare(self, to_format = 'mol2', addH = False, calc_charge = False,
@@ -103,7 +423,7 @@ def prepare(self, to_format = 'mol2', addH = False, calc_charge = False,
 
     conv = ob.OBConversion()
     mol = ob.OBMol()
-    ob_read_one(conv, self.mol_file, mol, self.mol_fmt, to_format)
+    ob_read_one(conv, self._wd(self.mol_file), mol, self.mol_fmt, to_format)
 
     # FIXME: does this test for the right thing?
     if mol.GetDimension() != 3:
@@ -166,7 +486,7 @@ def prepare(self, to_format = 'mol2', addH = False, calc_charge = False,
         self.mol_fmt = to_format
 
         try:
-            conv.WriteFile(mol, self.mol_file)
+            conv.WriteFile(mol, self._wd(self.mol_file) )
         except IOError as why:
             raise errors.SetupError(why)
     else:
@@ -241,7 +561,7 @@ def preminimize(self, add_hyd = False, ffield = 'mmff94', nsteps = 10):
 
     # NOTE: Openbabel may miscalculate charges from mol2 files
     try:
-        mol = pybel.readfile(self.mol_fmt, self.mol_file).next()
+        mol = pybel.readfile(self.mol_fmt, self._wd(self.mol_file) ).next()
     except IOError as why:
         raise errors.SetupError(why)
 
@@ -255,7 +575,7 @@ def preminimize(self, add_hyd = False, ffield = 'mmff94', nsteps = 10):
                  (self.mol_file, self.mol_fmt) )
 
     try:
-        mol.write(self.mol_fmt, self.mol_file, overwrite = True)
+        mol.write(self.mol_fmt, self._wd(self.mol_file), overwrite = True)
     except IOError as why:
         raise errors.SetupError(why)
 
@@ -288,7 +608,8 @@ def flex(self, name = const.LIGAND_NAME, dobonds = True,
     re_sire_error = re.compile(const.RE_SIRE_ERROR_STR)
 
     amber = Sire.IO.Amber()
-    molecules = amber.readCrdTop(self.amber_crd, self.amber_top)[0]
+    molecules = amber.readCrdTop(self._wd(self.amber_crd),
+                                 self._wd(self.amber_top) )[0]
 
     nmol = molecules.molNums()
     nmol.sort()
@@ -509,7 +830,7 @@ translation.to(Sire.Units.angstrom), const.BASE_MAXBONDVAR, const.BASE_MAXANGLEV
         lines.append('dihedral %-4s %-4s %-4s %-4s flex %-5.3f\n' \
                  % (at0name, at1name, at2name, at3name, delta))
 
-    with open(const.LIGAND_FLEX_FILE, 'w') as output:
+    with open(self._wd(const.LIGAND_FLEX_FILE), 'w') as output:
             output.write(''.join(lines))
 
 
@@ -517,7 +838,8 @@ translation.to(Sire.Units.angstrom), const.BASE_MAXBONDVAR, const.BASE_MAXANGLEV
 def conf_search(self, do_ga = False, numconf = 30, geomsteps = 5,
                 numchildren = 5, mutability = 5, convergence = 25,
                 ffield = 'mmff94', steep_steps = 100, steep_econv = 1.0E-4,
-                conj_steps = 250, conj_econv = 1.0E-6):
+                conj_steps = 250, conj_econv = 1.0E-6, ensemble = 1,
+                nproc = 1):
     """Conformer search via OpenBabel.
 
     The default method is a weighted rotor search with pre (steepest descent)
@@ -526,13 +848,23 @@ def conf_search(self, do_ga = False, numconf = 30, geomsteps = 5,
     Python code crashes at present with segfaults when writing the output
     file.
 
+    The rotor search may be run as an ensemble of independent searches for
+    every force field in ffield, each starting from randomised torsions.
+    The conformer with the lowest energy in the first force field is kept.
+
     The output file is written to const.FREE_MOL2_FILE in MOL2/Sybyl format.
 
+    :param ffield: force field name or comma separated list of names
+    :type ffield: string
+    :param ensemble: number of searches per force field
+    :type ensemble: int
+    :param nproc: number of searches run concurrently in worker processes
+    :type nproc: int
     :raises: SetupError
     """
 
     try:
-        mol = pybel.readfile(self.mol_fmt, self.mol_file).next()
+        mol = pybel.readfile(self.mol_fmt, self._wd(self.mol_file) ).next()
     except IOError as why:
         raise errors.SetupError(why)
 
@@ -542,29 +874,52 @@ def conf_search(self, do_ga = False, numconf = 30, geomsteps = 5,
     outmol = const.FREE_MOL2_FILE % self.mol_fmt
 
     if not do_ga:
-        obff = ob.OBForceField.FindForceField(ffield)
+        ffields = [name.strip() for name in ffield.split(',')]
 
         logger.write('Performing conformer search with pre and post '
                      'minimisation on %s' % self.mol_file)
 
-        if not obff:
-            raise errors.SetupError('Error: cannot find %s force field' %
-                                    ffield)
-
-        if not obff.Setup(obmol):
-            raise errors.SetupError('Error: cannot setup mol with %s force '
-                                    'field' % ffield)
-
         logger.write('Parameters are:\nffield = %s, numconf = %i, '
                      'geomsteps = %i, steep_steps = %i,\nsteep_econv = %g, '
-                     'conj_steps = %i, conj_econv = %g\n' %
+                     'conj_steps = %i, conj_econv = %g, ensemble = %i\n' %
                      (ffield, numconf, geomsteps, steep_steps, steep_econv,
-                      conj_steps, conj_econv) )
+                      conj_steps, conj_econv, ensemble) )
+
+        jobs = [(obmol, name, ffields[0], seed, numconf, geomsteps,
+                 steep_steps, steep_econv, conj_steps, conj_econv)
+                for seed in range(max(ensemble, 1) ) for name in ffields]
+
+        if nproc > 1 and len(jobs) > 1:
+            results = run_forked(_rotor_search, jobs, nproc)
+        else:
+            results = []
 
-        obff.SteepestDescent(steep_steps, steep_econv)
-        obff.WeightedRotorSearch(numconf, geomsteps)
-        obff.ConjugateGradients(conj_steps, conj_econv)
-        obff.GetCoordinates(obmol)
+            for job in jobs:
+                try:
+                    results.append( (True, _rotor_search(*job) ) )
+                except errors.SetupError as why:
+                    results.append( (False, str(why) ) )
+
+        best = None
+
+        for job, (success, result) in zip(jobs, results):
+            if not success:
+                logger.write('Search with %s, seed %i failed: %s' %
+                             (job[1], job[3], result) )
+                continue
+
+            if len(jobs) > 1:
+                logger.write('Search with %s, seed %i: E(%s) = %.4f' %
+                             (job[1], job[3], ffields[0], result[0]) )
+
+            if not best or result[0] < best[0]:
+                best = result
+
+        if not best:
+            raise errors.SetupError(results[0][1])
+
+        for atom, (x, y, z) in zip(ob.OBMolAtomIter(obmol), best[1]):
+            atom.SetVector(x, y, z)
     else:
         search = ob.OBConformerSearch()
         cando = search.Setup(obmol, numconf, numchildren, mutability,
@@ -596,7 +951,7 @@ def conf_search(self, do_ga = False, numconf = 30, geomsteps = 5,
                  (self.mol_fmt, outmol) )
 
     try:
-        mol.write(self.mol_fmt, outmol, overwrite = True)
+        mol.write(self.mol_fmt, self._wd(outmol), overwrite = True)
     except IOError as why:
         raise errors.SetupError(why)
 
@@ -607,13 +962,16 @@ def conf_search(self, do_ga = False, numconf = 30, geomsteps = 5,
 @report
 def align(self, inc_hyd = False, symmetry = False, filt = False):
     """
-    Align two structures via OpenBabel.
+    Align the structure onto the reference structure.  The rotation is
+    computed with the Kabsch algorithm, OBAlign is only used when the atoms
+    cannot be matched by order or symmetry is requested.  The reference is
+    read only once when several molecules are aligned onto the same file.
 
     :param inc_hyd: include hydrogens
     :type inc_hyd: bool
     :param symmetry: consider symmetry of the molecule
     :type symmetry: bool
-    :param filt: invoke primitive filter
+    :param filt: ignore solvent and ions when fitting
     :type filt: bool
     :raises: SetupError
     """
@@ -625,103 +983,32 @@ def align(self, inc_hyd = False, symmetry = False, filt = False):
         logger.write('Identical files: will not perform alignment')
         return
 
-
-    conv = ob.OBConversion()
-    conv.SetInAndOutFormats(self.ref_fmt, self.mol_fmt)
-
-    ref = ob.OBMol()
-    tgt = ob.OBMol()
-
-    # ignore warning messages about non-standard PDB
-    errlev = ob.obErrorLog.GetOutputLevel()
-    ob.obErrorLog.SetOutputLevel(0)
-
-    conv.ReadFile(ref, self.ref_file)
-    conv.ReadFile(tgt, self.mol_file)
-
-    ob.obErrorLog.SetOutputLevel(errlev)
-
-
-    if filt:
-        # delete unwanted atoms in reference
-        delat = []
-
-        for atom in ob.OBMolAtomIter(ref):
-            resname = atom.GetResidue().GetName()
-
-            # FIXME: replace with proper function
-            if resname in const.IGNORE_RESIDUES:
-                delat.append(atom)
-
-        ref.BeginModify()
-
-        for atom in delat:
-            ref.DeleteAtom(atom, True)
-
-        ref.EndModify()
-
-        # copy wanted atoms from target to new OBMol
-        cpy = ob.OBMol()
-
-        for atom in ob.OBMolAtomIter(tgt):
-            resname = atom.GetResidue().GetName()
-
-            # FIXME: replace with proper function
-            if resname not in const.IGNORE_RESIDUES:
-                # NOTE: this copies only some info but incl. coordinates
-                cpy.AddAtom(atom)
-
-        molecs = ob.OBAlign(ref, cpy, inc_hyd, symmetry)
-    else:
-        molecs = ob.OBAlign(ref, tgt, inc_hyd, symmetry)
-
     logger.write('Aligning %s with %s as reference' %
                       (self.mol_file, self.ref_file) )
 
-    if not molecs.Align():
-        logger.write('Alignment failed')
-        return
-
-    logger.write('RMSD is %.2f' % molecs.GetRMSD() )
-
-    if filt:
-        rotate = molecs.GetRotMatrix()
-        molecs.UpdateCoords(ref)
-        first = True
+    ref_file = os.path.abspath(self._wd(self.ref_file) )
 
-        for atom in ob.OBMolAtomIter(tgt):
-            tmpvec = ob.vector3(atom.GetVector())
-            tmpvec *= rotate
+    try:
+        key = (ref_file, os.path.getmtime(ref_file), self.ref_fmt, inc_hyd,
+               symmetry, filt)
+    except OSError as why:
+        raise errors.SetupError(why)
 
-            if first:
-                # we obviously can't do this directly: OB's vector3 does not
-                # support the '-' but only the '-=' operator.  But the
-                # latter leads to a memory corruption bug...
-                # shift = ref.GetAtom(1).GetVector()
-                # shift -= cpy.GetAtom(1).GetVector()
+    engine = _align_engines.get(key)
 
-                # we assume atoms 1 are equivalent in both molecules...
-                v1 = ref.GetAtom(1).GetVector()
-                v2 = cpy.GetAtom(1).GetVector()
+    if not engine:
+        engine = AlignEngine(ref_file, self.ref_fmt, inc_hyd, symmetry, filt)
 
-                x = v1.GetX() - v2.GetX()
-                y = v1.GetY() - v2.GetY()
-                z = v1.GetZ() - v2.GetZ()
+        if len(_align_engines) >= _MAX_ALIGN_ENGINES:
+            _align_engines.clear()
 
-                shift = ob.vector3(x, y, z)
-                first = False
+        _align_engines[key] = engine
 
-            tmpvec += shift
-            atom.SetVector(tmpvec)
+    rmsd = engine.align([(self._wd(self.mol_file), self.mol_fmt)])[0]
 
-    else:
-        if not molecs.UpdateCoords(tgt):
-            logger.write('Coordinate update failed')
-            return
+    if rmsd is None:
+        return
 
-    try:
-        conv.WriteFile(tgt, self.mol_file)
-    except IOError as why:
-        raise errors.SetupError(why)
+    logger.write('RMSD is %.2f' % rmsd)
 
     self.mol_atomtype = 'sybyl'
@@ -59,9 +59,9 @@ class MDEngine(mdebase.MDEBase):
     #        other MD packages
     def __init__(self, amber_top, amber_crd, sander_crd, sander_rst,
                  amber_pdb, box_dims=None, solvent=None, mdprog='sander',
-                 mdpref='', mdpost=''):
+                 mdpref='', mdpost='', workdir=None):
 
-        super(MDEngine, self).__init__()
+        super(MDEngine, self).__init__(workdir)
 
         # FIXME: do not assume that top/crd are in AMBER format
         self.update_files(amber_top, amber_crd, sander_crd, sander_rst,
@@ -81,7 +81,7 @@ class MDEngine(mdebase.MDEBase):
         self.sander_rst = sander_rst
         self.amber_pdb = amber_pdb
 
-        if is_periodic(self.amber_top):
+        if is_periodic(self._wd(self.amber_top) ):
             self.min_periodic = ' ntb = 1,\n'
             self.md_periodic = ''           # must be in pre-defined namelist
         else: # FIXME: this needs a closer look
@@ -201,9 +201,7 @@ class MDEngine(mdebase.MDEBase):
         :returns: box dimensions
         """
 
-        with open(self.sander_rst, 'r') as rst:
-            for line in rst:
-                box_dims = line
+        box_dims = utils.last_line(self._wd(self.sander_rst) )
 
         # FIXME: rectangular box only
         return [float(d) for d in box_dims.split()]
@@ -219,7 +217,7 @@ class MDEngine(mdebase.MDEBase):
         prefix = prefix % self.run_no
         self.sander_rst = prefix + mdebase.RST_EXT
 
-        with open(prefix + os.extsep + 'in', 'w') as mdin:
+        with open(self._wd(prefix + os.extsep + 'in'), 'w') as mdin:
             mdin.writelines(namelist)
 
         # NOTE: we assume trajectory will be written in NetCDF
@@ -236,7 +234,9 @@ class MDEngine(mdebase.MDEBase):
 
         err = utils.run_amber(self.mdpref + ' ' + self.mdprog,
                               flags.format(prefix, self.amber_top,
-                                           self.sander_crd, self.sander_rst) )
+                                           self.sander_crd, self.sander_rst),
+                              cwd=self.workdir,
+                              cores=utils.prefix_cores(self.mdpref) )
 
         if err:
             logger.write('sander/pmemd failed with message %s' % err[1])
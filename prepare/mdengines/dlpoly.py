@@ -54,9 +54,9 @@ class MDEngine(mdebase.MDEBase):
 
     def __init__(self, amber_top, amber_crd, sander_crd, sander_rst,
                  amber_pdb, box_dims = None, solvent = None,
-                 mdprog = 'DLPOLY.Z', mdpref = '', mdpost = ''):
+                 mdprog = 'DLPOLY.Z', mdpref = '', mdpost = '', workdir = None):
 
-        super(MDEngine, self).__init__()
+        super(MDEngine, self).__init__(workdir)
 
         self.update_files(amber_top, amber_crd, sander_crd, sander_rst,
                           amber_pdb)
@@ -79,8 +79,8 @@ class MDEngine(mdebase.MDEBase):
         self.amber_pdb = amber_pdb
 
         self.dlpoly = dlpoly.DLPolyField()
-        self.dlpoly.readParm(amber_top, amber_crd)
-        self.dlpoly.writeConfig(CONFIG_FILENAME)
+        self.dlpoly.readParm(self._wd(amber_top), self._wd(amber_crd) )
+        self.dlpoly.writeConfig(self._wd(CONFIG_FILENAME) )
 
 
     def minimize(self, config = '%STD', nsteps = 100, ncyc = 100,
@@ -192,7 +192,7 @@ class MDEngine(mdebase.MDEBase):
         :returns: box dimensions
         """
 
-        config_file = CONFIG_FILENAME
+        config_file = self._wd(CONFIG_FILENAME)
         line_no = 0
         box_dims = []
 
@@ -239,13 +239,15 @@ class MDEngine(mdebase.MDEBase):
         if mask:
              self._make_restraints(mask, restr_force)
 
-        self.dlpoly.writeField(FIELD_FILENAME)
+        self.dlpoly.writeField(self._wd(FIELD_FILENAME) )
 
-        with open(CONTROL_FILENAME, 'w') as mdin:
+        with open(self._wd(CONTROL_FILENAME), 'w') as mdin:
             mdin.writelines(config)
 
         retc, out, err = utils.run_exe(' '.join((self.mdpref, self.mdprog,
-                                                 self.mdpost)))
+                                                 self.mdpost)),
+                                       cwd=self.workdir,
+                                       cores=utils.prefix_cores(self.mdpref) )
 
         if retc:
             logger.write(err)
@@ -254,13 +256,15 @@ class MDEngine(mdebase.MDEBase):
 
         for mfile in MOVE_LIST:
             try:
-                shutil.move(mfile, mfile + os.extsep + suffix)
+                shutil.move(self._wd(mfile),
+                            self._wd(mfile + os.extsep + suffix) )
             except IOError:             # some files may not be created
                 continue
 
         try:
-            shutil.copy2(REVCON_FILENAME, REVCON_FILENAME + os.extsep + suffix)
-            shutil.move(REVCON_FILENAME, CONFIG_FILENAME)
+            shutil.copy2(self._wd(REVCON_FILENAME),
+                         self._wd(REVCON_FILENAME + os.extsep + suffix) )
+            shutil.move(self._wd(REVCON_FILENAME), self._wd(CONFIG_FILENAME) )
         except IOError as why:
             raise errors.SetupError(why)
 
@@ -303,7 +307,7 @@ class MDEngine(mdebase.MDEBase):
         coords = []
         vels = []
 
-        with open(config_file, 'r') as crdvel:
+        with open(self._wd(config_file), 'r') as crdvel:
             for line in crdvel:
                 line_no += 1
 
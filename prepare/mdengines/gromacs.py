@@ -66,9 +66,9 @@ class MDEngine(mdebase.MDEBase):
 
     def __init__(self, amber_top, amber_crd, sander_crd, sander_rst,
                  amber_pdb, box_dims=None, solvent=None, mdprog='mdrun',
-                 mdpref='', mdpost=''):
+                 mdpref='', mdpost='', workdir=None):
 
-        super(MDEngine, self).__init__()
+        super(MDEngine, self).__init__(workdir)
 
         self.update_files(amber_top, amber_crd, sander_crd, sander_rst,
                           amber_pdb)
@@ -99,11 +99,11 @@ class MDEngine(mdebase.MDEBase):
 
         gtop = gromacs.GromacsTop()
 
-        gtop.readParm(amber_top, amber_crd)
+        gtop.readParm(self._wd(amber_top), self._wd(amber_crd) )
         self.molidx = gtop.molidx
 
-        gtop.writeTop(self.top, '', '', False)
-        gtop.writeGro(self.gro)
+        gtop.writeTop(self._wd(self.top), '', '', False)
+        gtop.writeGro(self._wd(self.gro) )
 
         self.gtop = gtop
 
@@ -223,9 +223,7 @@ class MDEngine(mdebase.MDEBase):
 
         gro_file = self.prefix + os.extsep + 'gro'
 
-        with open(gro_file, 'r') as rst:
-            for line in rst:
-                last_line = line
+        last_line = utils.last_line(self._wd(gro_file) )
 
         # FIXME: rectangular box only
         box_dims = [float(d) / const.A2NM for d in last_line.split()]
@@ -242,7 +240,7 @@ class MDEngine(mdebase.MDEBase):
         filename = prefix + os.extsep
         config_filename = '_' + filename + 'mdp'
 
-        with open(config_filename, 'w') as mdin:
+        with open(self._wd(config_filename), 'w') as mdin:
             mdin.writelines(config)
 
         if self.run_no == 1:
@@ -261,7 +259,8 @@ class MDEngine(mdebase.MDEBase):
         if mask:
              self._make_restraints(mask, restr_force)
 
-        retc, out, err = utils.run_exe(' '.join((self.grompp, params)))
+        retc, out, err = utils.run_exe(' '.join((self.grompp, params)),
+                                       cwd=self.workdir)
 
         if retc:
             logger.write(err)
@@ -271,7 +270,9 @@ class MDEngine(mdebase.MDEBase):
         params = '-deffnm %s' % prefix
 
         retc, out, err = utils.run_exe(' '.join((self.mdpref, self.mdprog,
-                                                 self.mdpost, params)))
+                                                 self.mdpost, params)),
+                                       cwd=self.workdir,
+                                       cores=utils.prefix_cores(self.mdpref) )
 
         if retc:
             logger.write(err)
@@ -305,8 +306,8 @@ class MDEngine(mdebase.MDEBase):
                 if i in mask_idx:
                     molt_idx.append(i)
 
-            posres_file = (const.GROMACS_POSRES_PREFIX + name +
-                           const.GROMACS_ITP_EXT)
+            posres_file = self._wd(const.GROMACS_POSRES_PREFIX + name +
+                                   const.GROMACS_ITP_EXT)
 
             if molt_idx:
                 mi = min(molt_idx)
@@ -330,7 +331,8 @@ class MDEngine(mdebase.MDEBase):
         """
 
         params = '-f %s' % (self.prev + os.extsep + 'trr')
-        retc, out, err = utils.run_exe(' '.join((self.gmxdump, params)))
+        retc, out, err = utils.run_exe(' '.join((self.gmxdump, params)),
+                                       cwd=self.workdir)
 
         if retc:
             logger.write(err)
@@ -59,8 +59,30 @@ class MDEBase(object):
     MD engine base.
     """
 
-    def __init__(self):
+    def __init__(self, workdir=None):
+        """
+        :param workdir: directory in which all files are read and written and
+           the MD program is run, the current directory if None
+        :type workdir: string
+        """
+
         self.run_no = 1
+        self.workdir = workdir
+
+
+    def _wd(self, filename):
+        """
+        Resolve a file name relative to the working directory.
+
+        :param filename: the file name
+        :type filename: string
+        :returns: the file name as seen from the current directory
+        """
+
+        if self.workdir:
+            return os.path.join(self.workdir, filename)
+
+        return filename
 
 
     def mask_indexes(self, parmtop, mask):
@@ -74,7 +96,7 @@ class MDEBase(object):
         :returns: mask index generator
         """
                 
-        p = AmberParm(parmtop)
+        p = AmberParm(self._wd(parmtop) )
         m = AmberMask(p, mask)
 
         return m.Selected()
@@ -124,7 +146,7 @@ class MDEBase(object):
             delz = minc[2] - (zz - maxc[2] + minc[2]) / 2
 
 
-        with open(self.prev + RST_EXT, 'w') as rst7:
+        with open(self._wd(self.prev + RST_EXT), 'w') as rst7:
             rst7.write('converted with FESetup\n')
             rst7.write('%5i%15.7f\n' % (natoms, 0.0) )
 
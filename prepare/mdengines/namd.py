@@ -85,9 +85,9 @@ class MDEngine(mdebase.MDEBase):
     #        other MD packages
     def __init__(self, amber_top, amber_crd, sander_crd, sander_rst,
                  amber_pdb, box_dims=[0.0, 0.0, 0.0], solvent='tip3',
-                 mdprog='namd2', mdpref='', mdpost=''):
+                 mdprog='namd2', mdpref='', mdpost='', workdir=None):
 
-        super(MDEngine, self).__init__()
+        super(MDEngine, self).__init__(workdir)
 
         # FIXME: do not assume that top/crd are in AMBER format
         self.update_files(amber_top, amber_crd, sander_crd, sander_rst,
@@ -255,12 +255,8 @@ class MDEngine(mdebase.MDEBase):
 
         xst_file = self.prefix + os.extsep + 'xst'
 
-        with open(xst_file, 'r') as rst:
-            for line in rst:
-                last_line = line
-
         # FIXME: rectangular box only
-        d = last_line.split()
+        d = utils.last_line(self._wd(xst_file) ).split()
         box_dims = [float(d[1]), float(d[5]), float(d[9]), 90.0, 90.0, 90.0]
                         
         return box_dims
@@ -274,7 +270,7 @@ class MDEngine(mdebase.MDEBase):
         :raises: SetupError
         """
         
-        prefix = self.prev + os.extsep
+        prefix = self._wd(self.prev + os.extsep)
 
         natoms, coords = namd_velcoor(prefix + 'coor')
         ncheck, vels = namd_velcoor(prefix + 'vel')
@@ -283,11 +279,7 @@ class MDEngine(mdebase.MDEBase):
             raise errors.SetupError('different number of atoms in coor(%i) '
                                     'and vel(%i) files' % (natoms, ncheck) )
 
-        with open(prefix + 'xsc') as xsc:
-            for line in xsc:
-                ext = line
-
-        ext = ext.split()
+        ext = utils.last_line(prefix + 'xsc').split()
 
         # FIXME: only cuboid box
         xx, yy, zz = float(ext[1]), float(ext[5]), float(ext[9])
@@ -304,14 +296,16 @@ class MDEngine(mdebase.MDEBase):
         filename = prefix + os.extsep
         config_filename = filename + 'in'
         
-        with open(config_filename, 'w') as mdin:
+        with open(self._wd(config_filename), 'w') as mdin:
             mdin.writelines(config)
 
         retc, out, err = utils.run_exe(' '.join((self.mdpref, self.mdprog,
                                                  self.mdpost,
-                                                 config_filename)))
+                                                 config_filename)),
+                                       cwd=self.workdir,
+                                       cores=utils.prefix_cores(self.mdpref) )
 
-        with open(filename + 'out', 'w') as outfile:
+        with open(self._wd(filename + 'out'), 'w') as outfile:
             outfile.writelines(out)
 
         if retc:
@@ -334,8 +328,8 @@ class MDEngine(mdebase.MDEBase):
         indexes = list(self.mask_indexes(self.amber_top, mask) )
         acnt = 0
 
-        with open(ofilen, 'w') as opdb:
-            with open(self.amber_pdb, 'r') as ipdb:
+        with open(self._wd(ofilen), 'w') as opdb:
+            with open(self._wd(self.amber_pdb), 'r') as ipdb:
                 for line in ipdb:
                     if line[:6] == 'ATOM  ' or line[:6] == 'HETATM':
                         if acnt in indexes:
@@ -28,22 +28,28 @@ __revision__ = "$Id$"
 
 import os
 
-from FESetup import const, report, CaptureOutput, logger
+from FESetup import const, report, CaptureOutput, logger, user_cache_dir
 
 
 # NOTE: PROPKA 3.1 can actually also protonate ligands but for the time being
 #       we only allow protein protonation
 @report
-def protonate_propka(self, pH = 7.0):
+def protonate_propka(self, pH = 7.0, nproc = 1):
     """
-    Protonate a protein with PROPKA 3.1.
+    Protonate a protein with PROPKA 3.1.  The pKas are cached on disk keyed
+    by the contents of the PDB file, the pH and the PROPKA parameter file.
 
     :param pH: desired pH for protein protonation
     :type pH: float
+    :param nproc: number of conformations computed concurrently
+    :type nproc: int
     """
 
     import os
     import sys
+    import json
+    import hashlib
+    import tempfile
     import  StringIO
 
     import propka.lib as plib
@@ -54,15 +60,45 @@ def protonate_propka(self, pH = 7.0):
 
     # add PDB file name to options to avoid warning of missing file, also
     # set config file path to module path to find propka.cfg
-    options, dummy = plib.loadOptions( ['--pH', pH, '-q', self.mol_file] )
+    mol_file = self._wd(self.mol_file)
+    options, dummy = plib.loadOptions( ['--pH', pH, '-q', mol_file] )
     options.parameters = os.path.join(os.path.dirname(pmc.__file__),
                                       options.parameters)
 
-    with CaptureOutput() as output:
-        mol = pmc.Molecular_container_new(self.mol_file, options)
-        pKas = mol.calculate_pka()
+    digest = hashlib.sha1(repr(float(pH) ) )
 
-    logger.write('%s%s' % (output[0], output[1]) )
+    for filename in (mol_file, options.parameters):
+        with open(filename, 'rb') as inp:
+            digest.update('\0' + inp.read() )
+
+    cachedir = user_cache_dir('propka')
+    cache_file = os.path.join(cachedir, digest.hexdigest() + '.json')
+
+    try:
+        with open(cache_file, 'r') as cache:
+            pKas = [tuple(pka) for pka in json.load(cache)]
+
+        logger.write('Using cached PROPKA pKas from %s' % cache_file)
+    except (IOError, ValueError, TypeError):
+        with CaptureOutput() as output:
+            mol = pmc.Molecular_container_new(mol_file, options)
+            pKas = mol.calculate_pka(nproc)
+
+        logger.write('%s%s' % (output[0], output[1]) )
+
+        try:
+            if not os.path.isdir(cachedir):
+                os.makedirs(cachedir)
+
+            tmp = tempfile.NamedTemporaryFile('w', dir=cachedir, delete=False)
+
+            with tmp:
+                json.dump(pKas, tmp)
+
+            os.rename(tmp.name, cache_file)
+        except (IOError, OSError):
+            # the cache is optional
+            pass
 
     protres = []
 
@@ -79,8 +115,8 @@ def protonate_propka(self, pH = 7.0):
 
     msg_res = set()
 
-    with open(const.PROTONATED_PDB_FILE, 'w') as newfile:
-        with open(self.mol_file, 'r') as pdbfile:
+    with open(self._wd(const.PROTONATED_PDB_FILE), 'w') as newfile:
+        with open(mol_file, 'r') as pdbfile:
             for line in pdbfile:
                 if line[:6] in ('ATOM  ', 'HETATM'):
                     resName = line[17:21].strip()
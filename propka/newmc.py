@@ -7,17 +7,85 @@ __revision__ = "$Id$"
 
 
 import sys
+import cPickle as pickle
+from cStringIO import StringIO
 
 from propka.molecular_container import *
 
+from FESetup import run_forked
+
+
+# pickling a conformation follows the links between atoms and groups
+_RECURSION_LIMIT = 100000
+
 
 class Molecular_container_new(Molecular_container):
     """Overwritten calculate_pka() for better fine control."""
 
 
-    def calculate_pka(self):
-        for name in self.conformation_names:
-            self.conformations[name].calculate_pka(self.version, self.options)
+    def _calculate_conformation(self, name):
+        """
+        Compute the pKas of a conformation in a worker process and return
+        the pickled conformation.  The container itself is not pickled but
+        replaced by the one of the main process on loading.
+        """
+
+        sys.setrecursionlimit(_RECURSION_LIMIT)
+
+        conformation = self.conformations[name]
+        conformation.calculate_pka(self.version, self.options)
+
+        out = StringIO()
+        pickler = pickle.Pickler(out, 2)
+        pickler.persistent_id = \
+                              lambda obj: 'container' if obj is self else None
+        pickler.dump(conformation)
+
+        return out.getvalue()
+
+
+    def _load_conformation(self, data):
+        unpickler = pickle.Unpickler(StringIO(data) )
+        unpickler.persistent_load = lambda pid: self
+
+        return unpickler.load()
+
+
+    def calculate_pka(self, nproc=1):
+        """
+        Compute the pKas of all conformations and average them.
+
+        :param nproc: number of conformations computed concurrently in
+                      worker processes, conformations which cannot be
+                      transferred back are computed here
+        :type nproc: int
+        :returns: residue name, residue number, chain ID and pKa of every
+                  titratable group
+        :rtype: list of tuples
+        """
+
+        names = list(self.conformation_names)
+        done = set()
+
+        if nproc > 1 and len(names) > 1:
+            results = run_forked(self._calculate_conformation,
+                                 [(name, ) for name in names], nproc)
+
+            for name, (success, data) in zip(names, results):
+                if not success:
+                    continue
+
+                try:
+                    self.conformations[name] = self._load_conformation(data)
+                    done.add(name)
+                except (pickle.UnpicklingError, EOFError, AttributeError,
+                        ImportError, RuntimeError):
+                    pass
+
+        for name in names:
+            if name not in done:
+                self.conformations[name].calculate_pka(self.version,
+                                                       self.options)
 
         self.find_non_covalently_coupled_groups()
         self.average_of_conformations()
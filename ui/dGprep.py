@@ -49,11 +49,17 @@ import glob
 import copy
 import atexit
 import warnings
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 from collections import OrderedDict, namedtuple
 
 import FESetup.prepare as prep
-from FESetup import const, errors, create_logger, logger, DirManager
+from FESetup.prepare.amber import utils as amber_utils
+from FESetup.prepare.amber import chargedb as amber_chargedb
+from FESetup.prepare import ligutil
+from FESetup import const, errors, create_logger, logger, profiler
 from FESetup.ui.iniparser import IniParser
+from FESetup.ui import dagsched, manifest
 from FESetup.modelconf import ModelConfig
 
 # FIXME: That's here solely to suppress a warning over a fmcs/Sire double
@@ -84,6 +90,25 @@ PARAM_CMDS = {
     'lib': 'loadOff'
     }
 
+# options which do not affect the result of a build stage, input files are
+# fingerprinted via their contents
+_NO_FINGERPRINT = frozenset( ('logfile', 'remake', 'overwrite', 'basedir',
+                              'molecules', 'morph_pairs', 'pairs',
+                              'sqm_parallel', 'library', 'library.range',
+                              'conf_search.nproc', 'propka.nproc') )
+
+# options only affecting the solvated stage of a molecule
+_SOLVATION_KEYS = ('box.', 'neutralize', 'ions.', 'align_axes', 'min.',
+                   'md.')
+
+# options affecting ligand morphs
+_MORPH_KEYS = ('gaff', 'FE_type', 'AFE.type', 'AFE.separate_vdw_elec',
+               'softcore_type', 'mcs.timeout', 'mcs.match_by')
+
+
+# the multi-molecule ligand file, if any, inherited by worker processes
+ligand_library = None
+
 
 class dGprepError(Exception):
     pass
@@ -149,7 +174,7 @@ def _minmd_done(dico):
     return False
 
 
-def _search_for_model(names, workdir):
+def _search_for_model(names, workdir, fingerprints=None):
     """
     Check if a model file is available.
 
@@ -159,19 +184,143 @@ def _search_for_model(names, workdir):
     :param workdir: the workdir where the model file is located
     :type name: str
     :type workdir: str
+    :param fingerprints: fingerprints of the inputs the models must have been
+                         built from, in the same order as names
+    :type fingerprints: list of str
 
-    :returns: the path to the model file or None if model file not found
+    :returns: the path to the model file or None if model file not found or
+              out of date
     """
 
-    for name in names:
+    for i, name in enumerate(names):
         path = os.path.join(workdir, name)
 
         if os.access(path, os.F_OK):
+            if fingerprints and not manifest.is_current(path,
+                                                        fingerprints[i]):
+                logger.write('Model %s is out of date' % path)
+                continue
+
             return path
 
     return None
 
 
+def _remove_outdated(names, topdir, workdir):
+    """
+    Remove the work directory of a molecule if it has out of date models so
+    that no stale intermediate files are picked up by the rebuild.  Work
+    directories without manifest were not created by a tracked build and
+    may hold files edited by the user, so they are never removed.
+
+    :param names: list of model names
+    :type names: str
+    :param topdir: the directory where the model files are located
+    :type topdir: str
+    :param workdir: the work directory of the molecule
+    :type workdir: str
+    """
+
+    if not os.path.isdir(workdir):
+        return
+
+    if not manifest.has_manifest(workdir):
+        logger.write('Keeping untracked directory %s for the rebuild' %
+                     workdir)
+        return
+
+    if any(os.access(os.path.join(topdir, name), os.F_OK) for name in names):
+        logger.write('Removing out of date directory %s' % workdir)
+        shutil.rmtree(workdir)
+
+
+def _source_dir(basedir, name):
+    if os.path.isabs(basedir):
+        return os.path.join(basedir, name)
+
+    return os.path.join(os.getcwd(), basedir, name)
+
+
+def _ligand_input(lig):
+    """
+    Name and format of the start file of a ligand in its work directory.
+    """
+
+    if ligand_library:
+        return const.LIBRARY_MOL_FILE % ligand_library.fmt, ligand_library.fmt
+
+    if not lig['file.format']:
+        fmt = os.path.splitext(lig['file.name'])[1][1:]
+    else:
+        fmt = lig['file.format']
+
+    return lig['file.name'], fmt
+
+
+def _ligand_digest(lig, name):
+    """
+    Hash of the input of a ligand: its library record or its source
+    directory.
+    """
+
+    if ligand_library:
+        return ligand_library.digest(name)
+
+    return manifest.hash_path(_source_dir(lig['basedir'], name) )
+
+
+def _fingerprints(name, ff, opts, section, load_cmds, sources):
+    """
+    Compute the fingerprints of the inputs of the vacuum and the solvated
+    stage of a molecule.  The solvated stage depends on the vacuum stage.
+
+    :param name: the name of the molecule
+    :type name: str
+    :param ff: the force field
+    :type ff: ForceField
+    :param opts: the options
+    :type opts: IniParser
+    :param section: the options section of the molecule
+    :type section: str
+    :param load_cmds: additional leap commands
+    :type load_cmds: str
+    :param sources: hashes of the input files
+    :type sources: list of str
+
+    :returns: fingerprints of the vacuum and the solvated stage
+    """
+
+    vac_opts = {}
+    sol_opts = {}
+
+    for key, val in opts[section].iteritems():
+        if key in _NO_FINGERPRINT:
+            continue
+
+        if key.startswith(_SOLVATION_KEYS):
+            sol_opts[key] = val
+        else:
+            vac_opts[key] = val
+
+    for key, val in opts[SECT_DEF].iteritems():
+        if key in _NO_FINGERPRINT or key.startswith('mcs.'):
+            continue
+
+        if key.startswith('mdengine'):
+            sol_opts[key] = val
+        else:
+            vac_opts[key] = val
+
+    # the contents of the user parameter files, not only their names
+    params = [manifest.hash_path(line.split(None, 1)[1])
+              for line in load_cmds.splitlines() if line.strip()]
+
+    vac_fprint = manifest.fingerprint(section, name, repr(ff), load_cmds,
+                                      params, sources, vac_opts)
+
+    return vac_fprint, manifest.fingerprint(vac_fprint, sol_opts)
+
+
 def read_model(filename):
     """
     Read a ModelConfig model.
@@ -199,7 +348,7 @@ def read_model(filename):
     return model
 
 
-def save_model(model, mol, filename, dest_dir):
+def save_model(model, mol, filename, dest_dir, fprint=None):
     """
     Save the current ModelConfig model.
 
@@ -211,6 +360,8 @@ def save_model(model, mol, filename, dest_dir):
     :type filename: string
     :param dest_dir: name of destination directory
     :type dest_dir: string
+    :param fprint: fingerprint of the inputs the model was built from
+    :type fprint: string
     """
 
     model['mdengine'] = options[SECT_DEF]['mdengine']
@@ -234,24 +385,75 @@ def save_model(model, mol, filename, dest_dir):
         model['box.dimensions'] = box_dims
         model['box.format'] = 'bla'  # FIXME: boxlengths-angle
 
-    if mol.ssbond_file and os.path.isfile(mol.ssbond_file):
+    if mol.ssbond_file and os.path.isfile(mol._wd(mol.ssbond_file) ):
         model['top.ssbond_file'] = mol.ssbond_file
         model.add_file(mol.ssbond_file)
 
     # the final blessing
     model['is.valid'] = 1
 
-    model.write(filename)
+    tmpname = mol._wd(filename)
+    model.write(tmpname, mol.workdir or '')
 
     mname = os.path.join(dest_dir, filename)
 
     if os.access(mname, os.F_OK):
         os.remove(mname)
 
-    shutil.move(filename, dest_dir)
+    shutil.move(tmpname, dest_dir)
+
+    if fprint:
+        manifest.stamp(mname, fprint)
+
+        # the work directory may be removed when the model is out of date
+        if mol.workdir:
+            manifest.stamp(mol.workdir, fprint)
+
+
+def _make_workdir(workdir):
+    """
+    Create a working directory if it does not exist yet.
+
+    :param workdir: the directory
+    :type workdir: str
+    """
+
+    if not os.path.isdir(workdir):
+        logger.write('Creating directory %s' % workdir)
+
+        try:
+            os.makedirs(workdir)
+        except OSError:
+            # may have been created concurrently
+            if not os.path.isdir(workdir):
+                raise
 
 
-def make_ligand(name, ff, opts):
+def _profile_stage(func):
+    """
+    Decorator recording one of the make_* functions as a profiler step.  The
+    molecule is the name passed in as first argument or, for complexes, the
+    combined name of the protein and ligand objects.
+    """
+
+    def decorator(*args):
+        if isinstance(args[0], basestring):
+            molecule = args[0]
+        else:
+            molecule = args[0].mol_name + const.PROT_LIG_SEP + args[1].mol_name
+
+        with profiler.step(molecule, func.__name__):
+            return func(*args)
+
+    # keep the name so that the function can still be pickled
+    decorator.__name__ = func.__name__
+    decorator.__doc__ = func.__doc__
+
+    return decorator
+
+
+@_profile_stage
+def make_ligand(name, ff, opts, template=None):
     """
     Prepare ligands for simulation: charge parameters, vacuum top/crd,
     confomer search + alignment (both optional), optionally hydrated
@@ -264,6 +466,9 @@ def make_ligand(name, ff, opts):
     :type ff: ForceField
     :param opts: the name of the ligandx
     :type opts: IniParser
+    :param template: name of an identical ligand built before whose charges
+                     are reused
+    :type template: str
     """
 
     logger.write('*** Working on %s ***\n' % name)
@@ -279,12 +484,25 @@ def make_ligand(name, ff, opts):
     sol_model_filename = 'solv_' + name + const.MODEL_EXT
     from_scratch = True
 
-    workdir = os.path.join(os.getcwd(), const.LIGAND_WORKDIR, name)
+    topdir = os.path.join(os.getcwd(), const.LIGAND_WORKDIR)
+    workdir = os.path.join(topdir, name)
+    src = _source_dir(lig['basedir'], name)
+    sources = [_ligand_digest(lig, name)]
+
+    if template:
+        sources.append(_ligand_digest(lig, template) )
+
+    vac_fprint, sol_fprint = _fingerprints(name, ff, opts, SECT_LIG,
+                                           load_cmds, sources)
 
     if not opts[SECT_DEF]['remake']:
         model_path = \
                    _search_for_model([sol_model_filename, vac_model_filename],
-                                     const.LIGAND_WORKDIR)
+                                     topdir, [sol_fprint, vac_fprint])
+
+        if not model_path:
+            _remove_outdated([sol_model_filename, vac_model_filename],
+                             topdir, workdir)
 
         # FIXME: check for KeyError
         if model_path:
@@ -294,37 +512,35 @@ def make_ligand(name, ff, opts):
             # FIXME: only extract when const.LIGAND_WORKDIR not present?
             model.extract(direc = workdir)
 
-            ligand = ff.Ligand(name)
+            # all files are relative to the working directory
+            ligand = ff.Ligand(name, workdir=workdir)
 
-            # invoke context manager to preset directory for absolute file
-            # creation below
-            with DirManager(workdir):
-                logger.write('Found model %s, extracting data' % name)
-
-                ligand.charge = float(model['charge.total'])
-                ligand.gaff = model['forcefield']
-                ligand.amber_top = model['top.filename']
-                ligand.amber_crd = model['crd.filename']
-                ligand.orig_file = model['crd.original']
-                ligand.mol_file = ligand.orig_file
-                ligand.mol_fmt ='mol2'
+            logger.write('Found model %s, extracting data' % name)
 
-                # this file will not be created when skip_param = True
-                try:
-                    ligand.frcmod = model['frcmod']
-                except KeyError:
-                    pass
+            ligand.charge = float(model['charge.total'])
+            ligand.gaff = model['forcefield']
+            ligand.amber_top = model['top.filename']
+            ligand.amber_crd = model['crd.filename']
+            ligand.orig_file = model['crd.original']
+            ligand.mol_file = ligand.orig_file
+            ligand.mol_fmt ='mol2'
 
-                if 'box.dimensions' in model:
-                    ligand.box_dims = [float(b) for b in
-                                       model['box.dimensions'].strip('[]')\
-                                       .split(',')]
+            # this file will not be created when skip_param = True
+            try:
+                ligand.frcmod = model['frcmod']
+            except KeyError:
+                pass
 
-                if lig['morph.absolute'] and \
-                       opts[SECT_DEF]['AFE.type'] == 'Sire':
-                    logger.write('Creating input files for absolute '
-                                 'transformations with Sire')
-                    ligand.create_absolute_Sire()
+            if 'box.dimensions' in model:
+                ligand.box_dims = [float(b) for b in
+                                   model['box.dimensions'].strip('[]')\
+                                   .split(',')]
+
+            if lig['morph.absolute'] and \
+                   opts[SECT_DEF]['AFE.type'] == 'Sire':
+                logger.write('Creating input files for absolute '
+                             'transformations with Sire')
+                ligand.create_absolute_Sire()
 
             if os.path.basename(model_path) == vac_model_filename:
                 from_scratch = False
@@ -333,172 +549,298 @@ def make_ligand(name, ff, opts):
 
     print('Making ligand %s...' % name)
 
-    if not lig['basedir']:
+    if not lig['basedir'] and not ligand_library:
         raise dGprepError('[%s] "basedir" must be set' % SECT_LIG)
 
-    if not lig['file.format']:
-        fmt = os.path.splitext(lig['file.name'])[1][1:]
-    else:
-        fmt = lig['file.format']
+    start_file, fmt = _ligand_input(lig)
 
     if from_scratch:
         model = ModelConfig(name)
-        ligand = ff.Ligand(name, lig['file.name'], fmt)
+        ligand = ff.Ligand(name, start_file, fmt, workdir=workdir)
 
     # this file will not be created when skip_param = True
-    if os.path.isfile(ligand.frcmod):
+    if os.path.isfile(ligand._wd(ligand.frcmod) ):
         model['frcmod'] = ligand.frcmod
         model.add_file(ligand.frcmod)
 
-    if os.path.isabs(lig['basedir']):
-        src = os.path.join(lig['basedir'], name)
-    else:
-        src = os.path.join(os.getcwd(), lig['basedir'], name)
+    _make_workdir(workdir)
 
-    with DirManager(workdir):
-        if from_scratch:
+    if from_scratch:
+        if ligand_library:
+            if opts[SECT_DEF]['overwrite'] or \
+                   not os.access(ligand._wd(start_file), os.F_OK):
+                ligand_library.extract(name, ligand._wd(start_file) )
+        else:
             ligand.copy_files((src,), None, opts[SECT_DEF]['overwrite'])
 
-            if not os.access(lig['file.name'], os.F_OK):
-                raise errors.SetupError('start file %s does not exist in %s' %
-                                        (lig['file.name'], os.getcwd() ) )
-
-            if lig['skip_param']:
-                if fmt != 'pdb' and fmt != 'mol2':
-                    raise dGprepError('When parameterisation is skipped, the input '
-                                      'format must be PDB or MOL2')
-
-                ligand.prepare('', lig['add_hydrogens'], lig['calc_charge'],
-                               lig['correct_for_pH'], lig['pH'])
-            elif not os.access(os.path.join(workdir, const.GAFF_MOL2_FILE),
-                               os.F_OK):
-                # IMPORTANT: do not allow OpenBabel to add Hs, it may mess up
-                # everything
-                ligand.prepare('mol2', lig['add_hydrogens'], lig['calc_charge'],
-                               lig['correct_for_pH'], lig['pH'])
-                ligand.param(lig['gb_charges'])
-            else: # FIXME: ugly
-                ligand.prepare('', lig['add_hydrogens'], lig['calc_charge'],
-                               lig['correct_for_pH'], lig['pH'])
-                ligand.mol_file = const.GAFF_MOL2_FILE
-                ligand.mol_fmt = 'mol2'
-
-            ligand.prepare_top()
-            ligand.create_top(boxtype='', addcmd=load_cmds,
-                              write_dlf=lig['write_dlf'])
+        if not os.access(ligand._wd(start_file), os.F_OK):
+            raise errors.SetupError('start file %s does not exist in %s' %
+                                    (start_file, workdir) )
+
+        if lig['skip_param']:
+            if fmt != 'pdb' and fmt != 'mol2':
+                raise dGprepError('When parameterisation is skipped, the input '
+                                  'format must be PDB or MOL2')
+
+            ligand.prepare('', lig['add_hydrogens'], lig['calc_charge'],
+                           lig['correct_for_pH'], lig['pH'])
+        elif not os.access(os.path.join(workdir, const.GAFF_MOL2_FILE),
+                           os.F_OK):
+            # IMPORTANT: do not allow OpenBabel to add Hs, it may mess up
+            # everything
+            ligand.prepare('mol2', lig['add_hydrogens'], lig['calc_charge'],
+                           lig['correct_for_pH'], lig['pH'])
+            ligand.param(lig['gb_charges'],
+                         sqm_parallel=lig['sqm_parallel'],
+                         template=template and
+                         os.path.join(topdir, template) )
+        else: # FIXME: ugly
+            ligand.prepare('', lig['add_hydrogens'], lig['calc_charge'],
+                           lig['correct_for_pH'], lig['pH'])
+            ligand.mol_file = const.GAFF_MOL2_FILE
+            ligand.mol_fmt = 'mol2'
+
+        ligand.prepare_top()
+        ligand.create_top(boxtype='', addcmd=load_cmds,
+                          write_dlf=lig['write_dlf'])
+
+        # this file will not be created when skip_param = True
+        if os.path.isfile(ligand._wd(const.LIGAND_AC_FILE) ):
+            model['charge.filename'] = const.LIGAND_AC_FILE
+            model.add_file(const.LIGAND_AC_FILE)
+
+        model['charge.total'] = ligand.charge
+        model['charge.filetype'] = 'ac'
+        model['charge.method'] = 'AM1-BCC'
+        model['forcefield'] = ligand.gaff
+        model['molecule.type'] = 'ligand'
+
+        model.add_file(ligand.mol_file)
+        model['crd.original'] = ligand.mol_file
+
+        save_model(model, ligand, vac_model_filename, topdir, vac_fprint)
+
+        if opts[SECT_DEF]['MC_prep']:
+            ligand.flex()
+
+        nconf = lig['conf_search.numconf']
+
+        if lig['morph.absolute'] and opts[SECT_DEF]['AFE.type'] == 'Sire':
+            ligand.create_absolute_Sire()
+
+        if nconf > 0:
+            ligand.conf_search(numconf = nconf,
+                               geomsteps = lig['conf_search.geomsteps'],
+                               steep_steps = lig['conf_search.steep_steps'],
+                               steep_econv = lig['conf_search.steep_econv'],
+                               conj_steps = lig['conf_search.conj_steps'],
+                               conj_econv = lig['conf_search.conj_econv'],
+                               ffield = lig['conf_search.ffield'],
+                               ensemble = lig['conf_search.ensemble'],
+                               nproc = lig['conf_search.nproc'])
+            ligand.align()
+
+    # FIXME: also check for boxlength and neutralize
+    if lig['box.type']:
+        ligand.prepare_top()
+        ligand.create_top(boxtype = lig['box.type'],
+                          boxlength = lig['box.length'],
+                          neutralize = lig['neutralize'],
+                          addcmd = load_cmds, remove_first = False)
+
+        if lig['ions.conc'] > 0.0:
+            ligand.create_top(boxtype = lig['box.type'],
+                              boxlength = lig['box.length'],
+                              neutralize = 2,
+                              addcmd = load_cmds, remove_first = False,
+                              conc = lig['ions.conc'],
+                              dens = lig['ions.dens'])
 
-            # this file will not be created when skip_param = True
-            if os.path.isfile(const.LIGAND_AC_FILE):
-                model['charge.filename'] = const.LIGAND_AC_FILE
-                model.add_file(const.LIGAND_AC_FILE)
+        restr_force = lig['min.restr_force']
+        nsteps = lig['min.nsteps']
 
-            model['charge.total'] = ligand.charge
-            model['charge.filetype'] = 'ac'
-            model['charge.method'] = 'AM1-BCC'
-            model['forcefield'] = ligand.gaff
-            model['molecule.type'] = 'ligand'
+        ligand.setup_MDEngine(opts[SECT_DEF]['mdengine'][1],
+                              opts[SECT_DEF]['mdengine.prefix'],
+                              opts[SECT_DEF]['mdengine.postfix'])
 
-            model.add_file(ligand.mol_file)
-            model['crd.original'] = ligand.mol_file
+        if nsteps > 0:
+            do_min(ligand, lig)
 
-            save_model(model, ligand, vac_model_filename, '..')
+        press_done = False
+        nsteps = lig['md.heat.nsteps']
 
-            if opts[SECT_DEF]['MC_prep']:
-                ligand.flex()
+        if nsteps > 0:
+            restr_force = lig['md.heat.restr_force']
+            do_md(ligand, lig, 'heat')
 
-            nconf = lig['conf_search.numconf']
+        nsteps = lig['md.constT.nsteps']
 
-            if lig['morph.absolute'] and opts[SECT_DEF]['AFE.type'] == 'Sire':
-                ligand.create_absolute_Sire()
+        if nsteps > 0:
+            restr_force = lig['md.constT.restr_force']
+            do_md(ligand, lig, 'constT')
 
-            if nconf > 0:
-                ligand.conf_search(numconf = nconf,
-                                   geomsteps = lig['conf_search.geomsteps'],
-                                   steep_steps = lig['conf_search.steep_steps'],
-                                   steep_econv = lig['conf_search.steep_econv'],
-                                   conj_steps = lig['conf_search.conj_steps'],
-                                   conj_econv = lig['conf_search.conj_econv'],
-                                   ffield = lig['conf_search.ffield'])
-                ligand.align()
-
-        # FIXME: also check for boxlength and neutralize
-        if lig['box.type']:
-            ligand.prepare_top()
-            ligand.create_top(boxtype = lig['box.type'],
-                              boxlength = lig['box.length'],
-                              neutralize = lig['neutralize'],
-                              addcmd = load_cmds, remove_first = False)
+        nsteps = lig['md.press.nsteps']
 
-            if lig['ions.conc'] > 0.0:
-                ligand.create_top(boxtype = lig['box.type'],
-                                  boxlength = lig['box.length'],
-                                  neutralize = 2,
-                                  addcmd = load_cmds, remove_first = False,
-                                  conc = lig['ions.conc'],
-                                  dens = lig['ions.dens'])
+        if nsteps > 0:
+            restr_force = lig['md.press.restr_force']
+            do_md(ligand, lig, 'press')
+            press_done = True
 
-            restr_force = lig['min.restr_force']
-            nsteps = lig['min.nsteps']
+        nrestr = lig['md.relax.nrestr']
 
-            ligand.setup_MDEngine(opts[SECT_DEF]['mdengine'][1],
-                                  opts[SECT_DEF]['mdengine.prefix'],
-                                  opts[SECT_DEF]['mdengine.postfix'])
+        if nrestr > 0:
+            # FIXME: unify with AMBER mdengine
+            if opts[SECT_DEF]['mdengine'][0] == 'namd':
+                ligand.md('%RELRES', lig['md.relax.nsteps'],
+                          lig['md.relax.T'], lig['md.relax.p'],
+                          lig['md.relax.restraint'], restr_force,
+                          nrestr, wrap = True)
+            else:
+                sp = restr_force / (nrestr - 1)
 
-            if nsteps > 0:
-                do_min(ligand, lig)
+                for k in range(nrestr - 2, -1, -1):
+                    if press_done:
+                        nmlist = '%PRESS'
+                    else:
+                        nmlist = '%CONSTT'
 
-            press_done = False
-            nsteps = lig['md.heat.nsteps']
+                    ligand.md(nmlist, lig['md.relax.nsteps'],
+                              lig['md.relax.T'], lig['md.relax.p'],
+                              lig['md.relax.restraint'], sp * k,
+                              wrap = True)
 
-            if nsteps > 0:
-                restr_force = lig['md.heat.restr_force']
-                do_md(ligand, lig, 'heat')
+        if opts[SECT_DEF]['mdengine'][0] != 'amber':
+            if _minmd_done(lig):
+               ligand.to_rst7()
 
-            nsteps = lig['md.constT.nsteps']
+        save_model(model, ligand, sol_model_filename, topdir, sol_fprint)
 
-            if nsteps > 0:
-                restr_force = lig['md.constT.restr_force']
-                do_md(ligand, lig, 'constT')
+    return ligand, load_cmds
 
-            nsteps = lig['md.press.nsteps']
 
-            if nsteps > 0:
-                restr_force = lig['md.press.restr_force']
-                do_md(ligand, lig, 'press')
-                press_done = True
+def select_library_ligands(library, molecules, opts):
+    """
+    Select the ligands to be built from the library: the given names, the
+    records in "library.range" or all records.
+
+    :param library: the ligand library
+    :type library: MolLibrary
+    :param molecules: names of the ligands from the input file
+    :type molecules: list of str
+    :param opts: the options
+    :type opts: IniParser
+    :returns: names of the ligands
+    :rtype: list of str
+    :raises: dGprepError
+    """
 
-            nrestr = lig['md.relax.nrestr']
+    if molecules:
+        missing = [name for name in molecules if name not in library]
 
-            if nrestr > 0:
-                # FIXME: unify with AMBER mdengine
-                if opts[SECT_DEF]['mdengine'][0] == 'namd':
-                    ligand.md('%RELRES', lig['md.relax.nsteps'],
-                              lig['md.relax.T'], lig['md.relax.p'],
-                              lig['md.relax.restraint'], restr_force,
-                              nrestr, wrap = True)
-                else:
-                    sp = restr_force / (nrestr - 1)
-
-                    for k in range(nrestr - 2, -1, -1):
-                        if press_done:
-                            nmlist = '%PRESS'
-                        else:
-                            nmlist = '%CONSTT'
+        if missing:
+            raise dGprepError('ligands not found in library %s: %s' %
+                              (library.filename, ', '.join(missing) ) )
+
+        return molecules
 
-                        ligand.md(nmlist, lig['md.relax.nsteps'],
-                                  lig['md.relax.T'], lig['md.relax.p'],
-                                  lig['md.relax.restraint'], sp * k,
-                                  wrap = True)
+    names = library.names
+    lrange = opts[SECT_LIG]['library.range']
 
-            if opts[SECT_DEF]['mdengine'][0] != 'amber':
-                if _minmd_done(lig):
-                   ligand.to_rst7()
+    if lrange:
+        # 1-based and inclusive, both ends optional
+        try:
+            first, last = [field.strip() for field in lrange.split('-')]
+            first = int(first) if first else 1
+            last = int(last) if last else len(names)
+        except ValueError:
+            raise dGprepError('malformed "library.range" key, must be '
+                              'first-last')
 
-            save_model(model, ligand, sol_model_filename, '..')
+        names = names[first - 1:last]
 
-    return ligand, load_cmds
+    return names
+
+
+def find_duplicate_ligands(molecules, opts):
+    """
+    Group ligands which are the same chemical entity, i.e. have the same
+    connectivity and formal charges, but may differ in name, pose and atom
+    order.  The first ligand of every group is parameterised and its charges
+    are reused for the others.
+
+    :param molecules: names of the ligands
+    :type molecules: list of str
+    :param opts: the options
+    :type opts: IniParser
+    :returns: name of the template for every duplicate ligand
+    :rtype: dict
+    """
+
+    lig = opts[SECT_LIG]
+    templates = {}
+
+    if not lig['dedup'] or lig['skip_param']:
+        return templates
+
+    start_file, fmt = _ligand_input(lig)
+    first = {}
+
+    for name in molecules:
+        try:
+            if ligand_library:
+                key = ligutil.canonical_key(name, fmt,
+                                            ligand_library.read(name) )
+            else:
+                key = ligutil.canonical_key(
+                    os.path.join(_source_dir(lig['basedir'], name),
+                                 start_file), fmt)
+        except errors.SetupError as why:
+            # reported when the ligand is built
+            logger.write('Warning: cannot canonicalise %s: %s' % (name, why))
+            continue
+
+        if key in first:
+            templates[name] = first[key]
+            logger.write('Ligand %s is identical to %s (%s)' %
+                         (name, first[key], key[0]) )
+        else:
+            first[key] = name
+
+    if templates:
+        print('%i duplicate ligands will use the charges of %i ligands' %
+              (len(templates), len(set(templates.values() ) ) ) )
+
+    return templates
+
+
+def _make_ligand_job(name):
+    """
+    Wrapper around make_ligand() to be run in a worker process.  The force
+    field, the options and the ligand templates are taken from the module
+    globals which the worker inherits from the main process.
+
+    :param name: the name of the ligand
+    :type name: str
 
+    :returns: tuple of name, (ligand, leap commands) or None on failure and
+              the error message or None on success
+    """
+
+    try:
+        ligand, cmds = make_ligand(name, ff, options,
+                                   ligand_templates.get(name) )
+    except errors.SetupError as why:
+        return name, None, str(why)
+    except SystemExit as why:
+        # sys.exit() would silently kill the pool worker
+        raise dGprepError('%s failed: %s' % (name, why))
+    finally:
+        logger.flush()
+
+    return name, (ligand, cmds), None
 
+
+@_profile_stage
 def make_protein(name, ff, opts):
     """
     Prepare proteins for simulation.
@@ -517,11 +859,21 @@ def make_protein(name, ff, opts):
     sol_model_filename = 'solv_' + name + const.MODEL_EXT
     from_scratch = True
 
-    workdir = os.path.join(os.getcwd(), const.PROTEIN_WORKDIR, name)
+    topdir = os.path.join(os.getcwd(), const.PROTEIN_WORKDIR)
+    workdir = os.path.join(topdir, name)
+    src = _source_dir(prot['basedir'], name)
+
+    vac_fprint, sol_fprint = _fingerprints(name, ff, opts, SECT_PROT,
+                                           load_cmds,
+                                           [manifest.hash_path(src)])
 
     if not opts[SECT_DEF]['remake']:
         model_path = _search_for_model([sol_model_filename, vac_model_filename],
-                                       const.PROTEIN_WORKDIR)
+                                       topdir, [sol_fprint, vac_fprint])
+
+        if not model_path:
+            _remove_outdated([sol_model_filename, vac_model_filename],
+                             topdir, workdir)
         # FIXME: check for KeyError
         if model_path:
             model = read_model(model_path)
@@ -532,7 +884,7 @@ def make_protein(name, ff, opts):
             # FIXME: only extract when const.PROTEIN_WORKDIR not present?
             model.extract(direc = workdir)
 
-            protein = ff.Protein(name, prot['basedir'])
+            protein = ff.Protein(name, prot['basedir'], workdir=workdir)
 
             protein.charge = float(model['charge.total'])
             protein.amber_top = model['top.filename']
@@ -555,118 +907,116 @@ def make_protein(name, ff, opts):
     if not prot['basedir']:
         raise dGprepError('[%s] "basedir" must be set' % SECT_PROT)
 
-    if os.path.isabs(prot['basedir']):
-        src = os.path.join(prot['basedir'], name)
-    else:
-        src = os.path.join(os.getcwd(), prot['basedir'], name)
-
     if from_scratch:
         model = ModelConfig(name)
-        protein = ff.Protein(name, prot['file.name'])
+        protein = ff.Protein(name, prot['file.name'], workdir=workdir)
         model['crd.original'] = protein.mol_file
         model.add_file(protein.mol_file)
 
-    with DirManager(workdir):
-        if from_scratch:
-            protein.copy_files((src,), None, opts[SECT_DEF]['overwrite'])
+    _make_workdir(workdir)
+
+    if from_scratch:
+        protein.copy_files((src,), None, opts[SECT_DEF]['overwrite'])
+
+        if prot['propka']:
+            protein.protonate_propka(pH = prot['propka.pH'],
+                                     nproc = prot['propka.nproc'])
 
-            if prot['propka']:
-                protein.protonate_propka(pH = prot['propka.pH'])
+        protein.get_charge()    # must be done explicitly
+        protein.prepare_top()
+        protein.create_top(boxtype = '')
 
-            protein.get_charge()    # must be done explicitly
-            protein.prepare_top()
-            protein.create_top(boxtype = '')
+        model['charge.total'] = protein.charge
+        model['forcefield'] = 'AMBER'    # FIXME
+        model['molecule.type'] = 'biomolecule'
 
-            model['charge.total'] = protein.charge
-            model['forcefield'] = 'AMBER'    # FIXME
-            model['molecule.type'] = 'biomolecule'
+        save_model(model, protein, vac_model_filename, topdir, vac_fprint)
 
-            save_model(model, protein, vac_model_filename, '..')
+    # FIXME: also check for boxlength and neutralize
 
-        # FIXME: also check for boxlength and neutralize
+    if prot['box.type']:
+        protein.prepare_top()
+        protein.create_top(boxtype = prot['box.type'],
+                           boxlength = prot['box.length'],
+                           neutralize = prot['neutralize'],
+                           align = prot['align_axes'],
+                           addcmd = load_cmds, remove_first = True)
 
-        if prot['box.type']:
-            protein.prepare_top()
+        if prot['ions.conc'] > 0.0:
             protein.create_top(boxtype = prot['box.type'],
                                boxlength = prot['box.length'],
-                               neutralize = prot['neutralize'],
+                               neutralize = 2,
                                align = prot['align_axes'],
-                               addcmd = load_cmds, remove_first = True)
-
-            if prot['ions.conc'] > 0.0:
-                protein.create_top(boxtype = prot['box.type'],
-                                   boxlength = prot['box.length'],
-                                   neutralize = 2,
-                                   align = prot['align_axes'],
-                                   addcmd = load_cmds, remove_first = False,
-                                   conc = prot['ions.conc'],
-                                   dens = prot['ions.dens'])
+                               addcmd = load_cmds, remove_first = False,
+                               conc = prot['ions.conc'],
+                               dens = prot['ions.dens'])
 
-            restr_force = prot['min.restr_force']
-            nsteps = prot['min.nsteps']
+        restr_force = prot['min.restr_force']
+        nsteps = prot['min.nsteps']
 
-            protein.setup_MDEngine(opts[SECT_DEF]['mdengine'][1],
-                                   opts[SECT_DEF]['mdengine.prefix'],
-                                   opts[SECT_DEF]['mdengine.postfix'])
+        protein.setup_MDEngine(opts[SECT_DEF]['mdengine'][1],
+                               opts[SECT_DEF]['mdengine.prefix'],
+                               opts[SECT_DEF]['mdengine.postfix'])
 
-            if nsteps > 0:
-                do_min(protein, prot)
+        if nsteps > 0:
+            do_min(protein, prot)
 
-            press_done = False
+        press_done = False
 
-            #protein.md('%SHRINK', 200, 5.0, 1.0, ':LIG', 5.0, wrap = True)
+        #protein.md('%SHRINK', 200, 5.0, 1.0, ':LIG', 5.0, wrap = True)
 
-            nsteps = prot['md.heat.nsteps']
+        nsteps = prot['md.heat.nsteps']
 
-            if nsteps > 0:
-                restr_force = prot['md.heat.restr_force']
-                do_md(protein, prot, 'heat')
+        if nsteps > 0:
+            restr_force = prot['md.heat.restr_force']
+            do_md(protein, prot, 'heat')
 
-            nsteps = prot['md.constT.nsteps']
+        nsteps = prot['md.constT.nsteps']
 
-            if nsteps > 0:
-                restr_force = prot['md.constT.restr_force']
-                do_md(protein, prot, 'constT')
+        if nsteps > 0:
+            restr_force = prot['md.constT.restr_force']
+            do_md(protein, prot, 'constT')
 
-            nsteps = prot['md.press.nsteps']
+        nsteps = prot['md.press.nsteps']
 
-            if nsteps > 0:
-                restr_force = prot['md.press.restr_force']
-                do_md(protein, prot, 'press')
-                press_done = True
+        if nsteps > 0:
+            restr_force = prot['md.press.restr_force']
+            do_md(protein, prot, 'press')
+            press_done = True
 
-            nrestr = prot['md.relax.nrestr']
+        nrestr = prot['md.relax.nrestr']
 
-            if nrestr > 0:
-                if opts[SECT_DEF]['mdengine'][0] == 'namd':
-                    protein.md('%RELRES', prot['md.relax.nsteps'],
-                               prot['md.relax.T'], prot['md.relax.p'],
-                               prot['md.relax.restraint'], restr_force,
-                               nrestr, wrap = True)
-                else:
-                    sp = restr_force / (nrestr - 1)
+        if nrestr > 0:
+            if opts[SECT_DEF]['mdengine'][0] == 'namd':
+                protein.md('%RELRES', prot['md.relax.nsteps'],
+                           prot['md.relax.T'], prot['md.relax.p'],
+                           prot['md.relax.restraint'], restr_force,
+                           nrestr, wrap = True)
+            else:
+                sp = restr_force / (nrestr - 1)
 
-                    for k in range(nrestr - 2, -1, -1):
-                        if press_done:
-                            nmlist = '%PRESS'
-                        else:
-                            nmlist = '%CONSTT'
+                for k in range(nrestr - 2, -1, -1):
+                    if press_done:
+                        nmlist = '%PRESS'
+                    else:
+                        nmlist = '%CONSTT'
 
-                        protein.md(nmlist, prot['md.relax.nsteps'],
-                                   prot['md.relax.T'],
-                                   prot['md.relax.p'],
-                                   prot['md.relax.restraint'], sp * k,
-                                   wrap = True)
+                    protein.md(nmlist, prot['md.relax.nsteps'],
+                               prot['md.relax.T'],
+                               prot['md.relax.p'],
+                               prot['md.relax.restraint'], sp * k,
+                               wrap = True)
 
-            if opts[SECT_DEF]['mdengine'][0] != 'amber':
-                if _minmd_done(prot):
-                   protein.to_rst7()
+        if opts[SECT_DEF]['mdengine'][0] != 'amber':
+            if _minmd_done(prot):
+               protein.to_rst7()
 
-            save_model(model, protein, sol_model_filename, '..')
+        save_model(model, protein, sol_model_filename, topdir, sol_fprint)
 
     return protein, load_cmds
 
 
+@_profile_stage
 def make_complex(prot, lig, ff, opts, load_cmds):
 
     com = opts[SECT_COM]
@@ -676,11 +1026,30 @@ def make_complex(prot, lig, ff, opts, load_cmds):
     sol_model_filename = 'solv_' + name + const.MODEL_EXT
     from_scratch = True
 
-    workdir = os.path.join(os.getcwd(), const.COMPLEX_WORKDIR, name)
+    topdir = os.path.join(os.getcwd(), const.COMPLEX_WORKDIR)
+    workdir = os.path.join(topdir, name)
+    model_path = None
+
+    lig_src = os.path.join(os.getcwd(), const.LIGAND_WORKDIR, lig.mol_name)
+    prot_src = os.path.join(os.getcwd(), const.PROTEIN_WORKDIR, prot.mol_name)
+
+    sources = [manifest.hash_path(os.path.join(lig_src, filename) )
+               for filename in (lig.orig_file, lig.frcmod,
+                                const.LIGAND_AC_FILE) if filename]
+    sources.extend(manifest.hash_path(os.path.join(prot_src, filename) )
+                   for filename in (prot.orig_file, const.SSBOND_FILE)
+                   if filename)
+
+    vac_fprint, sol_fprint = _fingerprints(name, ff, opts, SECT_COM,
+                                           load_cmds, sources)
 
     if not opts[SECT_DEF]['remake']:
         model_path = _search_for_model([sol_model_filename, vac_model_filename],
-                                       const.COMPLEX_WORKDIR)
+                                       topdir, [sol_fprint, vac_fprint])
+
+        if not model_path:
+            _remove_outdated([sol_model_filename, vac_model_filename],
+                             topdir, workdir)
 
         if model_path:
             model = read_model(model_path)
@@ -691,7 +1060,7 @@ def make_complex(prot, lig, ff, opts, load_cmds):
             # FIXME: only extract when const.COMPLEX_WORKDIR not present?
             model.extract(direc = workdir)
 
-            complex = ff.Complex(prot, lig)
+            complex = ff.Complex(prot, lig, workdir)
 
             complex.charge = float(model['charge.total'])
             complex.amber_top = model['top.filename']
@@ -714,113 +1083,530 @@ def make_complex(prot, lig, ff, opts, load_cmds):
         model = ModelConfig(name)
 
     if not model_path:
-        complex = ff.Complex(prot, lig)
-
-    lig_src = os.path.join(os.getcwd(), const.LIGAND_WORKDIR, lig.mol_name)
-    prot_src = os.path.join(os.getcwd(), const.PROTEIN_WORKDIR, prot.mol_name)
-
-    with DirManager(workdir):
-        if from_scratch:
-            complex.copy_files((lig_src, prot_src),
-                               (ligand.orig_file, ligand.frcmod, protein.orig_file,
-                                const.LIGAND_AC_FILE, const.SSBOND_FILE),
-                               opts[SECT_DEF]['overwrite'])
-
-            complex.ligand_fmt = lig.mol_fmt
-            complex.prepare_top(gaff=options[SECT_DEF]['gaff'])
-            complex.create_top(boxtype='', addcmd=load_cmds)
+        complex = ff.Complex(prot, lig, workdir)
 
-            model['name'] = complex.complex_name
-            model['charge.total'] = complex.charge
-            model['forcefield'] = 'AMBER'   # FIXME
-            model['molecule.type'] = 'complex'  # FIXME
+    _make_workdir(workdir)
 
-            save_model(model, complex, vac_model_filename, '..')
-
-        # FIXME: also check for boxlength and neutralize
-        if com['box.type']:
-            complex.prepare_top(gaff=options[SECT_DEF]['gaff'])
+    if from_scratch:
+        complex.copy_files((lig_src, prot_src),
+                           (lig.orig_file, lig.frcmod, prot.orig_file,
+                            const.LIGAND_AC_FILE, const.SSBOND_FILE),
+                           opts[SECT_DEF]['overwrite'])
+
+        complex.ligand_fmt = lig.mol_fmt
+        complex.prepare_top(gaff=options[SECT_DEF]['gaff'])
+        complex.create_top(boxtype='', addcmd=load_cmds)
+
+        model['name'] = complex.complex_name
+        model['charge.total'] = complex.charge
+        model['forcefield'] = 'AMBER'   # FIXME
+        model['molecule.type'] = 'complex'  # FIXME
+
+        save_model(model, complex, vac_model_filename, topdir, vac_fprint)
+
+    # FIXME: also check for boxlength and neutralize
+    if com['box.type']:
+        complex.prepare_top(gaff=options[SECT_DEF]['gaff'])
+        complex.create_top(boxtype=com['box.type'],
+                           boxlength=com['box.length'],
+                           neutralize=com['neutralize'],
+                           align=com['align_axes'],
+                           addcmd=load_cmds, remove_first = True)
+
+        if com['ions.conc'] > 0.0:
             complex.create_top(boxtype=com['box.type'],
                                boxlength=com['box.length'],
-                               neutralize=com['neutralize'],
+                               neutralize=2,
                                align=com['align_axes'],
-                               addcmd=load_cmds, remove_first = True)
+                               addcmd=load_cmds, remove_first=False,
+                               conc=com['ions.conc'],
+                               dens=com['ions.dens'])
 
-            if com['ions.conc'] > 0.0:
-                complex.create_top(boxtype=com['box.type'],
-                                   boxlength=com['box.length'],
-                                   neutralize=2,
-                                   align=com['align_axes'],
-                                   addcmd=load_cmds, remove_first=False,
-                                   conc=com['ions.conc'],
-                                   dens=com['ions.dens'])
+        restr_force = com['min.restr_force']
+        nsteps = com['min.nsteps']
 
-            restr_force = com['min.restr_force']
-            nsteps = com['min.nsteps']
+        complex.setup_MDEngine(opts[SECT_DEF]['mdengine'][1],
+                               opts[SECT_DEF]['mdengine.prefix'],
+                               opts[SECT_DEF]['mdengine.postfix'])
 
-            complex.setup_MDEngine(opts[SECT_DEF]['mdengine'][1],
-                                   opts[SECT_DEF]['mdengine.prefix'],
-                                   opts[SECT_DEF]['mdengine.postfix'])
+        if nsteps > 0:
+            do_min(complex, com)
 
-            if nsteps > 0:
-                do_min(complex, com)
+        if opts[SECT_DEF]['MC_prep']:
+            complex.prot_flex()
+            complex.flatten_rings()
 
-            if opts[SECT_DEF]['MC_prep']:
-                complex.prot_flex()
-                complex.flatten_rings()
+        press_done = False
 
-            press_done = False
+        #complex.md('%SHRINK', 200, 5.0, 1.0, 'bb_lig', 5.0, wrap = True)
 
-            #complex.md('%SHRINK', 200, 5.0, 1.0, 'bb_lig', 5.0, wrap = True)
+        nsteps = com['md.heat.nsteps']
 
-            nsteps = com['md.heat.nsteps']
+        if nsteps > 0:
+            restr_force = com['md.heat.restr_force']
+            do_md(complex, com, 'heat')
 
-            if nsteps > 0:
-                restr_force = com['md.heat.restr_force']
-                do_md(complex, com, 'heat')
+        nsteps = com['md.constT.nsteps']
 
-            nsteps = com['md.constT.nsteps']
+        if nsteps > 0:
+            restr_force = com['md.constT.restr_force']
+            do_md(complex, com, 'constT')
 
-            if nsteps > 0:
-                restr_force = com['md.constT.restr_force']
-                do_md(complex, com, 'constT')
+        nsteps = com['md.press.nsteps']
 
-            nsteps = com['md.press.nsteps']
+        if nsteps > 0:
+            restr_force = com['md.press.restr_force']
+            do_md(complex, com, 'press')
+            press_done = True
 
-            if nsteps > 0:
-                restr_force = com['md.press.restr_force']
-                do_md(complex, com, 'press')
-                press_done = True
+        nrestr = com['md.relax.nrestr']
+
+        if nrestr > 0:
+            if opts[SECT_DEF]['mdengine'][0] == 'namd':
+                complex.md('%RELRES', com['md.relax.nsteps'],
+                           com['md.relax.T'], com['md.relax.p'],
+                           com['md.relax.restraint'], restr_force,
+                           nrestr, wrap = True)
+            else:
+                sp = restr_force / (nrestr - 1)
 
-            nrestr = com['md.relax.nrestr']
+                for k in range(nrestr - 2, -1, -1):
+                    if press_done:
+                        nmlist = '%PRESS'
+                    else:
+                        nmlist = '%CONSTT'
 
-            if nrestr > 0:
-                if opts[SECT_DEF]['mdengine'][0] == 'namd':
-                    complex.md('%RELRES', com['md.relax.nsteps'],
+                    complex.md(nmlist, com['md.relax.nsteps'],
                                com['md.relax.T'], com['md.relax.p'],
-                               com['md.relax.restraint'], restr_force,
-                               nrestr, wrap = True)
-                else:
-                    sp = restr_force / (nrestr - 1)
-
-                    for k in range(nrestr - 2, -1, -1):
-                        if press_done:
-                            nmlist = '%PRESS'
+                               com['md.relax.restraint'], sp * k,
+                               wrap = True)
+
+        if opts[SECT_DEF]['mdengine'][0] != 'amber':
+            if _minmd_done(com):
+                complex.to_rst7()
+
+        save_model(model, complex, sol_model_filename, topdir, sol_fprint)
+
+    return complex, load_cmds
+
+
+def parse_morph_pairs(opts):
+    """
+    Parse the morph pairs and the optional user atom maps.
+
+    :param opts: the options
+    :type opts: IniParser
+
+    :returns: list of morph pairs, list of unique ligand names, dictionary of
+              atom maps keyed by morph pair
+    """
+
+    morph_pairs = copy.deepcopy(opts[SECT_LIG]['morph_pairs'])
+    molecules = copy.deepcopy(opts[SECT_LIG]['molecules'])
+    morph_maps = {}
+
+    if morph_pairs:
+        temp_pairs = []
+
+        # FIXME: better error handling, parsing through IniParser?
+        for pair in morph_pairs:
+            p1 = pair[1].split('/')
+            temp_map = {}
+
+            if len(p1) > 1:
+                p1[0] = p1[0].strip()
+
+                for idx in p1[1:]:
+                    if idx:
+                        if idx.startswith('!'):
+                            a = idx[1:]
+                            b = -1
                         else:
-                            nmlist = '%CONSTT'
+                            a, b = idx.split('=')
+
+                        try:
+                            temp_map[int(a)] = int(b)
+                        except ValueError:
+                            print('Error: map contains non-integers')
+                            sys.exit(1)
 
-                        complex.md(nmlist, com['md.relax.nsteps'],
-                                   com['md.relax.T'], com['md.relax.p'],
-                                   com['md.relax.restraint'], sp * k,
-                                   wrap = True)
+                morph_maps[pair[0],p1[0]] = temp_map
 
-            if opts[SECT_DEF]['mdengine'][0] != 'amber':
-                if _minmd_done(com):
-                    complex.to_rst7()
+            temp_pairs.append( (pair[0], p1[0]) )
 
-            save_model(model, complex, sol_model_filename, '..')
+        morph_pairs = temp_pairs
 
-    return complex, load_cmds
+        mols = [val for pairs in morph_pairs for val in pairs]  # flatten
+        uniq = list(OrderedDict( (val, None) for val in mols) )
+        molecules = uniq
+
+    return morph_pairs, molecules, morph_maps
+
+
+def _run_job(func, *args):
+    """
+    Run one of the make_* functions in a worker process.
+
+    :param func: the function to be run
+    :type func: callable
+    """
+
+    try:
+        return func(*args)
+    except SystemExit as why:
+        # sys.exit() would silently kill the pool worker
+        raise dGprepError('%s' % why)
+    finally:
+        logger.flush()
+
+
+def _duplicate_ligand_task(name, ff, opts, template, template_data):
+    """
+    Build a duplicate ligand once its template has been built.  The ligand is
+    built from scratch if the template has failed, as in the phased build.
+    """
+
+    if template_data is None:
+        print ('WARNING: %s is built from scratch because build of %s failed'
+               % (name, template) )
+        template = None
+
+    return _run_job(make_ligand, name, ff, opts, template)
+
+
+def _complex_task(ff, opts, prot_data, lig_data):
+    """Build a complex from the results of the protein and ligand tasks."""
+
+    return make_complex(prot_data[0], lig_data[0], ff, opts,
+                        lig_data[1] + prot_data[1])
+
+
+def _morph_fingerprint(morph, ff, opts, isotope_map, basedir, reverse,
+                       cmds):
+    """
+    Compute the fingerprint of the inputs of a ligand morph: the topologies
+    of both ligands, the user atom map, the morph options and the force field.
+    """
+
+    ligands = [(morph.initial, morph.initial_dir, True),
+               (morph.final, morph.final_dir, reverse)]
+    files = []
+
+    for ligand, wd, solvated in ligands:
+        names = ['vacuum' + ligand.TOP_EXT, 'vacuum' + ligand.RST_EXT]
+
+        if solvated and opts[SECT_LIG]['box.type']:
+            names.extend( (ligand.amber_top, ligand.amber_crd) )
+
+        files.extend(manifest.hash_path(os.path.join(wd, name) )
+                     for name in names)
+
+    files.append(manifest.hash_path(os.path.join(basedir,
+                                                 morph.name + os.extsep +
+                                                 'map') ) )
+
+    morph_opts = dict( (key, opts[SECT_DEF][key]) for key in _MORPH_KEYS)
+    morph_opts['box.type'] = opts[SECT_LIG]['box.type']
+
+    return manifest.fingerprint('morph', morph.name, repr(ff), files, cmds,
+                                sorted(isotope_map.items() ), morph_opts)
+
+
+def _morph_task(topdir, pair, isotope_map, reverse, stream, ff, opts, l1, l2):
+    """
+    Build a ligand morph from the results of the two ligand tasks.  In stream
+    mode the Sire objects are dropped once the morph has been written, which
+    is required when the Morph is to be sent back from a worker process.  A
+    morph whose inputs have not changed is taken from its record.
+    """
+
+    ligand1, cmd1 = l1
+    ligand2, cmd2 = l2
+
+    basedir = os.path.join(topdir, opts[SECT_LIG]['basedir'])
+    wd1 = os.path.join(topdir, const.LIGAND_WORKDIR, pair[0])
+    wd2 = os.path.join(topdir, const.LIGAND_WORKDIR, pair[1])
+
+    with mutate.Morph(ligand1, ligand2, wd1, wd2, ff,
+                      opts[SECT_DEF]['AFE.type'],
+                      opts[SECT_DEF]['AFE.separate_vdw_elec'],
+                      opts[SECT_DEF]['mcs.timeout'],
+                      opts[SECT_DEF]['mcs.match_by'],
+                      opts[SECT_DEF]['gaff']) as morph:
+
+        fprint = _morph_fingerprint(morph, ff, opts, isotope_map, basedir,
+                                    reverse, (cmd1, cmd2) )
+
+        if not opts[SECT_DEF]['remake'] and \
+               manifest.is_current(morph.record_file, fprint):
+            print ('Morph %s is up to date' % morph.name)
+            morph.attach_record()
+        else:
+            print ('Morphing %s to %s...' % pair)
+
+            morph.setup(cmd1, cmd2, basedir, isotope_map)
+
+            if opts[SECT_LIG]['box.type']:
+                morph.create_coords(ligand1, 'solvated', wd1, cmd1, cmd2,
+                                    ligand2 if reverse else None, wd2)
+
+            morph.save_record()
+            manifest.stamp(morph.record_file, fprint)
+
+            if stream:
+                morph.release()
+
+        morph.fingerprint = fprint
+
+    return morph
+
+
+def _make_morph_job(pair):
+    """
+    Wrapper around _morph_task() to be run in a worker process.  The ligands,
+    the force field and the options are taken from the module globals which
+    the worker inherits from the main process.  Unless run in a thread the
+    Morph is returned released as its Sire objects cannot be pickled.
+
+    :param pair: names of the initial and final ligand
+    :type pair: tuple of str
+
+    :returns: tuple of pair, Morph or None on failure and the error message
+              or None on success
+    """
+
+    try:
+        morph = _morph_task(os.getcwd(), pair, morph_maps.get(pair, {}),
+                            (pair[1], pair[0]) in morph_pairs,
+                            args.stream_morphs or
+                            mp.current_process().name != 'MainProcess', ff,
+                            options, ligands[pair[0] ], ligands[pair[1] ])
+    except KeyError as why:
+        return pair, None, 'ligand %s has not been built' % why
+    except errors.SetupError as why:
+        return pair, None, str(why)
+    except SystemExit as why:
+        # sys.exit() would silently kill the pool worker
+        raise dGprepError('%s failed: %s' % (pair, why))
+    finally:
+        logger.flush()
+
+    return pair, morph, None
+
+
+def _complex_morph_task(topdir, opts, com_data, morph):
+    """
+    Create the complex for a ligand morph.  Runs in the main process as the
+    Morph holds Sire objects.
+    """
+
+    complex, cmds = com_data
+
+    wd = os.path.join(topdir, const.COMPLEX_WORKDIR, complex.mol_name)
+    sys_dir = os.path.join(morph.dst, 'complex')
+
+    fprint = manifest.fingerprint(
+        'complex-morph', complex.mol_name, morph.fingerprint, cmds,
+        [manifest.hash_path(os.path.join(wd, filename) ) for filename in
+         (complex.amber_top, complex.amber_crd, complex.ssbond_file)
+         if filename])
+
+    if not opts[SECT_DEF]['remake'] and manifest.is_current(sys_dir, fprint):
+        print('Complex %s with ligand morph %s is up to date' %
+              (complex.mol_name, morph.name) )
+        return
+
+    print('Creating complex %s with ligand morph %s...' %
+          (complex.mol_name, morph.name) )
+
+    # morphs only kept as a record are released again afterwards
+    released = morph.released
+
+    try:
+        morph.create_coords(complex, 'complex', wd, cmds, '')
+    finally:
+        if released:
+            morph.release()
+
+    manifest.stamp(sys_dir, fprint)
+
+
+def make_pool(jobs, pool_type='process'):
+    """
+    Create a worker pool.  Threads can be used because all setup steps run in
+    explicit work directories and do not change the process cwd.
+
+    :param jobs: number of workers
+    :type jobs: int
+    :param pool_type: process or thread
+    :type pool_type: str
+    :returns: the worker pool
+    """
+
+    # flush so that buffered log output is not written twice after a fork
+    logger.flush()
+
+    if pool_type == 'thread':
+        return ThreadPool(jobs)
+
+    return mp.Pool(jobs)
+
+
+def run_dag(ff, opts, molecules, morph_pairs, morph_maps, jobs,
+            pool_type='process', stream=False, templates={}):
+    """
+    Build all proteins, ligands, morphs, complexes and complex morphs as a
+    dependency graph.  Every task starts as soon as its inputs are available
+    instead of waiting for the whole previous phase to finish.
+
+    :param ff: the force field
+    :type ff: ForceField
+    :param opts: the options
+    :type opts: IniParser
+    :param molecules: names of the ligands
+    :type molecules: list of str
+    :param morph_pairs: the morph pairs
+    :type morph_pairs: list of tuples
+    :param morph_maps: user atom maps keyed by morph pair
+    :type morph_maps: dict
+    :param jobs: number of workers
+    :type jobs: int
+    :param pool_type: process or thread
+    :type pool_type: str
+    :param stream: keep only a record of each morph in memory
+    :type stream: bool
+    :param templates: name of the template for every duplicate ligand
+    :type templates: dict
+
+    :returns: lists of failed proteins, ligands, complexes and morphs
+    """
+
+    topdir = os.getcwd()
+    names = {}
+
+    def _failed(key, why):
+        print ('ERROR: %s failed: %s' % (names[key], why))
+
+    def _skipped(key, dep):
+        print ('WARNING: not making %s because build of %s failed' %
+               (names[key], names[dep]) )
+
+    graph = dagsched.TaskGraph((errors.SetupError, ), _failed, _skipped)
+
+    for prot_name in opts[SECT_PROT]['molecules']:
+        key = ('protein', prot_name)
+        names[key] = prot_name
+        graph.add(key, _run_job, (make_protein, prot_name, ff, opts) )
+
+    # templates always precede their duplicates in molecules
+    for lig_name in molecules:
+        key = ('ligand', lig_name)
+        names[key] = lig_name
+        template = templates.get(lig_name)
+
+        if template:
+            graph.add(key, _duplicate_ligand_task,
+                      (lig_name, ff, opts, template),
+                      optional=(('ligand', template), ) )
+        else:
+            graph.add(key, _run_job, (make_ligand, lig_name, ff, opts) )
+
+    for pair in morph_pairs:
+        key = ('morph', ) + pair
+
+        if key in graph:
+            continue
+
+        # morphs built in worker processes are sent back released
+        names[key] = pair[0] + const.MORPH_SEP + pair[1]
+        graph.add(key, _run_job,
+                  (_morph_task, topdir, pair, morph_maps.get(pair, {}),
+                   (pair[1], pair[0]) in morph_pairs,
+                   stream or pool_type != 'thread', ff, opts),
+                  (('ligand', pair[0]), ('ligand', pair[1]) ),
+                  local=pool_type == 'thread')
+
+    com_pairs = opts[SECT_COM]['pairs']
+
+    for prot_name in opts[SECT_PROT]['molecules']:
+        for lig_name in molecules:
+            if com_pairs and not any(
+                    (p[0] == prot_name and p[1] == lig_name) or
+                    (p[0] == lig_name and p[1] == prot_name)
+                    for p in com_pairs):
+                continue
+
+            key = ('complex', prot_name, lig_name)
+            names[key] = prot_name + const.PROT_LIG_SEP + lig_name
+            graph.add(key, _run_job, (_complex_task, ff, opts),
+                      (('protein', prot_name), ('ligand', lig_name) ) )
+
+            for pair in morph_pairs:
+                if pair[0] != lig_name:
+                    continue
+
+                mkey = ('complex-morph', prot_name) + pair
+
+                if mkey in graph:
+                    continue
+
+                names[mkey] = (names[key] + '/' + pair[0] + const.MORPH_SEP +
+                               pair[1])
+                graph.add(mkey, _complex_morph_task, (topdir, opts),
+                          (key, ('morph', ) + pair), local=True)
+
+    if jobs > 1:
+        pool = make_pool(jobs, pool_type)
+    else:
+        pool = None
+
+    try:
+        graph.run(pool)
+    finally:
+        if pool:
+            if graph.workers_lost:
+                pool.terminate()
+            else:
+                pool.close()
+
+            pool.join()
+
+    failed = {'protein': [], 'ligand': [], 'complex': [], 'morph': []}
+
+    for key in graph.failed:
+        failed[key[0].replace('complex-morph', 'morph')].append(names[key])
+
+    # complexes are only warned about as in the phased build
+    for key in graph.skipped_tasks:
+        if key[0] in ('morph', 'complex-morph'):
+            failed['morph'].append(names[key])
+
+    return failed['protein'], failed['ligand'], failed['complex'], \
+           failed['morph']
+
+
+def report_failures(failed_lists):
+    """
+    Print the final message.
+
+    :param failed_lists: tuples of lists of failed names and the
+                         corresponding category
+    :type failed_lists: tuple
+    """
+
+    success = True
+
+    for failed in failed_lists:
+        if failed[0]:
+            print ('ERROR: The following %s have failed:' % failed[1])
+
+            for name in failed[0]:
+                print (' %s' % name)
+
+            success = False
+
+    if success:
+        print ('\n=== All molecules built successfully ===\n')
 
 
 def do_min(what, opts):
@@ -870,6 +1656,8 @@ defaults[SECT_LIG] = {
     'file.name': ('ligand.pdb', None),
     'file.format': ('', None),
     'molecules': ('', ('list', LIST_SEP) ),
+    'library': ('', None),
+    'library.range': ('', None),
     'morph_pairs': ('', ('pairlist', LIST_SEP, MORPH_PAIR_SEP) ),
     'morph.absolute': (False, ('bool', ) ),
     'box.type': ('', None),
@@ -884,8 +1672,12 @@ defaults[SECT_LIG] = {
     'conf_search.conj_steps': (250, (int, ) ),
     'conf_search.conj_econv': (1.0E-6, (float, ) ),
     'conf_search.ffield': ('mmff94', None),
+    'conf_search.ensemble': (1, (int, ) ),
+    'conf_search.nproc': (1, (int, ) ),
     'calc_charge': (False, ('bool', ) ),
     'gb_charges': (False, ('bool', ) ),
+    'sqm_parallel': (1, (int, ) ),
+    'dedup': (False, ('bool', ) ),
     'add_hydrogens': (False, ('bool', ) ),
     'correct_for_pH': (False, ('bool', ) ),
     'pH': (7.4, (float, ) ),
@@ -905,6 +1697,7 @@ defaults[SECT_PROT] = {
     'align_axes': (False, ('bool', ) ),
     'propka': (False, ('bool', ) ),
     'propka.pH': (7.0, (float, ) ),
+    'propka.nproc': (1, (int, ) ),
     }
 
 defaults[SECT_COM] = {
@@ -964,8 +1757,75 @@ if __name__ == '__main__':
                         help='full version information')
     parser.add_argument('--tracebacklimit', metavar='N', type=int, default=0,
                         help='set the Python traceback limit (for debugging)')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                        help='number of ligands to be parameterised in '
+                        'parallel (default: 1)')
+    parser.add_argument('--schedule', choices=('phases', 'dag'),
+                        default='phases',
+                        help='build all molecules of one kind before the '
+                        'next (phases) or start every build as soon as its '
+                        'inputs are ready (dag) (default: phases)')
+    parser.add_argument('--pool', choices=('process', 'thread'),
+                        default='process',
+                        help='run parallel jobs in worker processes or in '
+                        'threads of this process (default: process)')
+    parser.add_argument('--stream-morphs', action='store_true',
+                        help='write a compact record of each morph to disk '
+                        'and drop the molecule data until the complex morphs '
+                        'are created, keeps memory use flat for large morph '
+                        'networks')
+    parser.add_argument('--max-cores', metavar='N', type=int, default=0,
+                        help='maximum number of cores used by all external '
+                        'programs together, MD runs count the processes in '
+                        'their MPI prefix (default: no limit)')
+    parser.add_argument('--core-lock', metavar='DIR',
+                        help='share the --max-cores budget with other '
+                        'processes through lock files in DIR')
+    parser.add_argument('--copy-mode', choices=('copy', 'link'),
+                        default='copy',
+                        help='how input files are placed into work '
+                        'directories: copy, or link which reflinks them '
+                        'where supported, else hardlinks them so that they '
+                        'share their contents with the sources, and only '
+                        'copies as a last resort (default: copy)')
+    parser.add_argument('--leap-sessions', action='store_true',
+                        help='keep tleap running with the force fields '
+                        'loaded and feed it one molecule after the other '
+                        'instead of starting tleap for every topology')
+    parser.add_argument('--leap-cache', metavar='DIR',
+                        default=os.environ.get('FESETUP_CACHE_DIR', ''),
+                        help='reuse leap results from the cache in DIR, may '
+                        'be shared between runs and users (default: '
+                        '$FESETUP_CACHE_DIR or no cache)')
+    parser.add_argument('--leap-cache-size', metavar='MB', type=int,
+                        default=2048,
+                        help='maximum size of the leap cache, least recently '
+                        'used results are removed first (default: 2048)')
+    parser.add_argument('--charge-db', metavar='FILE',
+                        default=os.environ.get('FESETUP_CHARGE_DB', ''),
+                        help='reuse ligand charges from the SQLite database '
+                        'FILE and add new ones, may be shared between '
+                        'projects (default: $FESETUP_CHARGE_DB or none)')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='write wall time, CPU time of child processes, '
+                        'peak memory and external commands per molecule and '
+                        'build stage to FILE, CSV if FILE ends in .csv and '
+                        'JSON otherwise')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='write a timeline of all build steps and '
+                        'external commands to FILE in Trace Event Format '
+                        '(chrome://tracing, Perfetto)')
     args = parser.parse_args()
 
+    if args.jobs < 1:
+        parser.error('number of jobs must be at least 1')
+
+    if args.max_cores < 0:
+        parser.error('number of cores must not be negative')
+
+    if args.core_lock and not args.max_cores:
+        parser.error('--core-lock requires --max-cores')
+
     print('\n=== %s ===\n\n%s\n' % (vstring, istring))
 
     options = IniParser(copy.deepcopy(defaults))
@@ -991,13 +1851,62 @@ if __name__ == '__main__':
 
     ff = prelude(options)
 
+    # must be set up before any worker process is forked
+    amber_utils.set_core_limit(args.max_cores, args.core_lock)
+    amber_utils.use_leap_sessions(args.leap_sessions)
+    amber_utils.set_copy_mode(args.copy_mode)
+    amber_utils.use_leap_cache(args.leap_cache, args.leap_cache_size)
+    amber_chargedb.configure(args.charge_db)
+
+    if args.profile or args.trace:
+        profiler.enable(os.path.abspath(args.profile or args.trace) +
+                        '.records')
+
+    # pool workers leave through os._exit() and do not run these
+    if args.profile:
+        profile_file = os.path.abspath(args.profile)
+        atexit.register(lambda : profiler.write_summary(profile_file) )
+
+    if args.trace:
+        trace_file = os.path.abspath(args.trace)
+        atexit.register(lambda : profiler.write_trace(trace_file) )
+
     logger.write('Command line: %s\n\nOptions:\n--------' % ' '.join(sys.argv))
     logger.write('\n'.join(options.format()))
     logger.write('--------\n\nForce field and MD engine:\n%s\n' % ff)
 
 
-    # FIXME: We keep all molecule objects in memory.  For 2000 morph pairs
-    #        this may mean more than 1 GB on a 64 bit machine.
+    # NOTE: All molecule objects are kept in memory.  For 2000 morph pairs
+    #       this may mean more than 1 GB on a 64 bit machine unless
+    #       --stream-morphs is used.
+
+    morph_pairs, molecules, morph_maps = parse_morph_pairs(options)
+
+    if options[SECT_LIG]['library']:
+        ligand_library = ligutil.MolLibrary(options[SECT_LIG]['library'],
+                                            options[SECT_LIG]['file.format'])
+        molecules = select_library_ligands(ligand_library, molecules, options)
+        print('Building %i of %i ligands in library %s' %
+              (len(molecules), len(ligand_library), ligand_library.filename))
+    ligand_templates = find_duplicate_ligands(molecules, options)
+
+    if args.schedule == 'dag':
+        if morph_pairs:
+            print('Morphs will be generated for %s' %
+                  options[SECT_DEF]['AFE.type'])
+            logger.write('Morphs will be generated for %s\n' %
+                         options[SECT_DEF]['AFE.type'])
+
+        prot_failed, lig_failed, com_failed, morph_failed = \
+                     run_dag(ff, options, molecules, morph_pairs, morph_maps,
+                             args.jobs, args.pool, args.stream_morphs,
+                             ligand_templates)
+
+        report_failures( ( (prot_failed, 'proteins'), (lig_failed, 'ligands'),
+                           (com_failed, 'complexes'),
+                           (morph_failed, 'morphs') ) )
+        sys.exit(0)
+
 
     ### proteins
 
@@ -1019,52 +1928,34 @@ if __name__ == '__main__':
     Ligdata = namedtuple('Ligdata', ['ref', 'leapcmd'])
     lig_failed = []
 
-    morph_pairs = copy.deepcopy(options[SECT_LIG]['morph_pairs'])
-    molecules = copy.deepcopy(options[SECT_LIG]['molecules'])
-    morph_maps = {}
-
-    if morph_pairs:
-        temp_pairs = []
-
-        # FIXME: better error handling, parsing through IniParser?
-        for pair in morph_pairs:
-            p1 = pair[1].split('/')
-            temp_map = {}
-
-            if len(p1) > 1:
-                p1[0] = p1[0].strip()
-
-                for idx in p1[1:]:
-                    if idx:
-                        if idx.startswith('!'):
-                            a = idx[1:]
-                            b = -1
-                        else:
-                            a, b = idx.split('=')
-
-                        try:
-                            temp_map[int(a)] = int(b)
-                        except ValueError:
-                            print('Error: map contains non-integers')
-                            sys.exit(1)
-
-                morph_maps[pair[0],p1[0]] = temp_map
-
-            temp_pairs.append( (pair[0], p1[0]) )
-
-        morph_pairs = temp_pairs
-
-        mols = [val for pairs in morph_pairs for val in pairs]  # flatten
-        uniq = list(OrderedDict( (val, None) for val in mols) )
-        molecules = uniq
+    # duplicate ligands are built after their templates
+    for wave in ([n for n in molecules if n not in ligand_templates],
+                 [n for n in molecules if n in ligand_templates]):
+        for lig_name in wave:
+            if ligand_templates.get(lig_name) in lig_failed:
+                print ('WARNING: %s is built from scratch because build of '
+                       '%s failed' % (lig_name, ligand_templates[lig_name]) )
+                del ligand_templates[lig_name]
+
+        if args.jobs > 1 and len(wave) > 1:
+            # each ligand is built in its own _ligands/<name> workdir,
+            # results are returned in input order
+            pool = make_pool(min(args.jobs, len(wave)), args.pool)
+            results = pool.imap(_make_ligand_job, wave, chunksize=1)
+        else:
+            pool = None
+            results = (_make_ligand_job(lig_name) for lig_name in wave)
+
+        for lig_name, result, why in results:
+            if why is None:
+                ligands[lig_name] = Ligdata(*result)
+            else:
+                lig_failed.append(lig_name)
+                print('ERROR: %s failed: %s' % (lig_name, why))
 
-    for lig_name in molecules:
-        try:
-            ligand, cmds = make_ligand(lig_name, ff, options)
-            ligands[lig_name] = Ligdata(ligand, cmds)
-        except errors.SetupError as why:
-            lig_failed.append(lig_name)
-            print('ERROR: %s failed: %s' % (lig_name, why))
+        if pool:
+            pool.close()
+            pool.join()
 
 
     ### ligand morphs
@@ -1077,56 +1968,25 @@ if __name__ == '__main__':
     morphs = []
     morph_failed = []
 
-    for pair in morph_pairs:
-        try:
-            l1 = ligands[pair[0] ]
-            l2 = ligands[pair[1] ]
-        except KeyError as why:
-            name = pair[0] + const.MORPH_SEP + pair[1]
-            morph_failed.append(name)
-            print ('ERROR: %s failed: %s' % (name, why))
-            continue
-
-        ligand1 = l1.ref
-        ligand2 = l2.ref
-
-        cmd1 = l1.leapcmd
-        cmd2 = l2.leapcmd
-
-        isotope_map = {}
-
-        if (pair[0], pair[1]) in morph_maps:
-            isotope_map = morph_maps[pair[0], pair[1]]
-
-        basedir = os.path.join(os.getcwd(), options[SECT_LIG]['basedir'])
-        wd1 = os.path.join(os.getcwd(), const.LIGAND_WORKDIR, pair[0])
-        wd2 = os.path.join(os.getcwd(), const.LIGAND_WORKDIR, pair[1])
-
-        with mutate.Morph(ligand1, ligand2, wd1, wd2, ff,
-                          options[SECT_DEF]['AFE.type'],
-                          options[SECT_DEF]['AFE.separate_vdw_elec'],
-                          options[SECT_DEF]['mcs.timeout'],
-                          options[SECT_DEF]['mcs.match_by'],
-                          options[SECT_DEF]['gaff']) as morph:
-
-            print ('Morphing %s to %s...' % pair)
-
-            if (pair[1], pair[0]) in morph_pairs:
-                rev = ligand2
-            else:
-                rev = None
-
-            try:
-                morph.setup(cmd1, cmd2, basedir, isotope_map)
-
-                if options[SECT_LIG]['box.type']:
-                    morph.create_coords(ligand1, 'solvated', wd1,
-                                        cmd1, cmd2, rev, wd2)
-            except errors.SetupError as why:
-                morph_failed.append(morph.name)
-                print ('ERROR: %s failed: %s' % (morph.name, why))
+    if args.jobs > 1 and len(morph_pairs) > 1:
+        # each pair is built in its own _perturbations/<type>/<pair>
+        # directory, results are returned in input order
+        pool = make_pool(min(args.jobs, len(morph_pairs)), args.pool)
+        results = pool.imap(_make_morph_job, morph_pairs, chunksize=1)
+    else:
+        pool = None
+        results = (_make_morph_job(pair) for pair in morph_pairs)
 
+    for pair, morph, why in results:
+        if why is None:
             morphs.append(morph)
+        else:
+            morph_failed.append(pair[0] + const.MORPH_SEP + pair[1])
+            print('ERROR: %s failed: %s' % (morph_failed[-1], why))
+
+    if pool:
+        pool.close()
+        pool.join()
 
 
     ### complexes
@@ -1183,46 +2043,25 @@ if __name__ == '__main__':
 
     ### complex morphs
 
-    # FIXME: For some reason the cwd is _perturbations/type/morph for the
-    #        second morph in the loop below as if a chdir didn't take place(?).
-    #        So remember the cwd before entering create_coords()
-    cwd = os.getcwd()
-
     for morph in morphs:
         for complex in complexes.keys():
             name = complex.mol_name + '/' + morph.name
 
             # FIXME: Complex has no ligand component after restart
             if complex.ligand.mol_name == morph.initial_name:
-                print('Creating complex %s with ligand morph %s...' %
-                      (complex.mol_name, morph.name) )
-
-                #print(os.getcwd())
-                wd = os.path.join(cwd, const.COMPLEX_WORKDIR, complex.mol_name)
-
                 try:
-                    morph.create_coords(complex, 'complex', wd,
-                                        complexes[complex], '')
+                    _complex_morph_task(os.getcwd(), options,
+                                        (complex, complexes[complex]), morph)
                 except errors.SetupError as why:
                     morph_failed.append(name)
                     print ('ERROR: complex %s with ligand morph %s failed: %s'
                            % (complex.mol_name, morph.name, why) )
 
+        if args.stream_morphs:
+            morph.release()
 
-    ### final message
-
-    success = True
 
-    for failed in ( (prot_failed, 'proteins'), (lig_failed, 'ligands'),
-                    (com_failed, 'complexes'),
-                    (morph_failed, 'morphs') ):
-        if failed[0]:
-            print ('ERROR: The following %s have failed:' % failed[1])
-
-            for name in failed[0]:
-                print (' %s' % name)
-
-            success = False
+    ### final message
 
-    if success:
-        print ('\n=== All molecules built successfully ===\n')
+    report_failures( ( (prot_failed, 'proteins'), (lig_failed, 'ligands'),
+                       (com_failed, 'complexes'), (morph_failed, 'morphs') ) )
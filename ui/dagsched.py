@@ -0,0 +1,321 @@
+#  Copyright (C) 2017  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r"""
+A simple dependency graph scheduler.  Tasks are dispatched to a worker pool
+as soon as all the tasks they depend on have finished.  Tasks which cannot be
+sent to a worker, e.g. because their results hold unpicklable objects, are
+marked as local and run in the main process while the pool keeps working.
+"""
+
+__revision__ = "$Id$"
+
+
+import os
+import traceback
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
+
+
+
+# results are polled as a blocking wait cannot be interrupted with Ctrl-C and
+# never returns if a worker process dies
+_POLL_INTERVAL = 0.5
+# polls a task may stay unfinished after its worker process has gone
+_LOST_POLLS = 4
+
+
+class TaskGraphError(Exception):
+    pass
+
+
+class WorkerLostError(TaskGraphError):
+    pass
+
+
+class _Task(object):
+    """A node in the task graph."""
+
+    __slots__ = ('key', 'func', 'args', 'deps', 'local', 'optional')
+
+    def __init__(self, key, func, args, deps, local, optional):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.deps = deps
+        self.local = local
+        self.optional = optional
+
+
+def _run_task(func, args, started=None, key=None):
+    """
+    Run a single task and catch all exceptions so that the result always
+    reaches the main process.
+
+    :param started: shared dictionary receiving the process ID of the worker
+                    running the task
+    :type started: dict
+    :param key: key of the task
+    :type key: hashable
+    :returns: tuple of success flag, result or exception and traceback string
+    """
+
+    if started is not None:
+        started[key] = os.getpid()
+
+    try:
+        return True, func(*args), None
+    except Exception as why:
+        return False, why, traceback.format_exc()
+
+
+def _worker_pids(pool):
+    """Process IDs of the live workers of a multiprocessing pool."""
+
+    return set(proc.pid for proc in getattr(pool, '_pool', [])
+               if proc.exitcode is None)
+
+
+class TaskGraph(object):
+    """
+    A directed acyclic graph of tasks.  The results of the dependencies are
+    appended to the task arguments in the order the dependencies were given,
+    followed by the results of the optional dependencies.  The result of an
+    optional dependency which has failed or was skipped is None.
+    """
+
+    def __init__(self, expected=(), on_failed=None, on_skipped=None):
+        """
+        :param expected: exception types which mark a task as failed but do
+                         not abort the run
+        :type expected: tuple of Exception
+        :param on_failed: callback invoked with the task key and the exception
+                          when a task has failed
+        :type on_failed: callable
+        :param on_skipped: callback invoked with the task key and the key of
+                           the failed dependency when a task cannot be run
+        :type on_skipped: callable
+        """
+
+        self.tasks = OrderedDict()
+        self.expected = expected
+        self.on_failed = on_failed
+        self.on_skipped = on_skipped
+
+        self.results = {}
+        self.failed = OrderedDict()
+        self.skipped_tasks = OrderedDict()
+
+        # a pool which has lost a worker cannot be joined after close()
+        self.workers_lost = False
+
+
+    def add(self, key, func, args=(), deps=(), local=False, optional=()):
+        """
+        Add a task to the graph.
+
+        :param key: unique, hashable key of the task
+        :type key: hashable
+        :param func: the function to be called, must be picklable unless
+                     local is True
+        :type func: callable
+        :param args: arguments to func
+        :type args: tuple
+        :param deps: keys of the tasks this task depends on
+        :type deps: sequence
+        :param local: run in the main process
+        :type local: bool
+        :param optional: keys of the tasks which must have finished before
+                         this task but whose failure does not prevent it
+        :type optional: sequence
+        :raises: TaskGraphError
+        """
+
+        if key in self.tasks:
+            raise TaskGraphError('duplicate task %s' % (key, ) )
+
+        for dep in tuple(deps) + tuple(optional):
+            if dep not in self.tasks:
+                raise TaskGraphError('task %s depends on unknown task %s' %
+                                     (key, dep) )
+
+        self.tasks[key] = _Task(key, func, tuple(args), tuple(deps), local,
+                                tuple(optional) )
+
+
+    def __contains__(self, key):
+        return key in self.tasks
+
+
+    def _finish(self, key, ok, value, tb):
+        if ok:
+            self.results[key] = value
+        elif isinstance(value, self.expected):
+            self.failed[key] = value
+
+            if self.on_failed:
+                self.on_failed(key, value)
+        else:
+            raise TaskGraphError('task %s raised an unexpected error:\n%s' %
+                                 (key, tb) )
+
+
+    def _lose(self, key, why):
+        """Mark a task as failed whose result was lost."""
+
+        self.failed[key] = why
+
+        if self.on_failed:
+            self.on_failed(key, why)
+
+
+    def _collect(self, running, started, pool, gone, done):
+        """
+        Pick up the results of finished pool tasks.  A task whose worker
+        process has died never delivers a result and is marked as failed.
+        """
+
+        pids = _worker_pids(pool) if started is not None else None
+
+        for key, result in running.items():
+            if result.ready():
+                del running[key]
+
+                try:
+                    ok, value, tb = result.get()
+                except Exception as why:
+                    # e.g. MaybeEncodingError for an unpicklable result
+                    self._lose(key, why)
+                else:
+                    self._finish(key, ok, value, tb)
+
+                done.add(key)
+                continue
+
+            pid = started.get(key) if pids is not None else None
+
+            if pid is None or pid in pids:
+                continue
+
+            # the result may still be on its way from the worker
+            gone[key] = gone.get(key, 0) + 1
+
+            if gone[key] > _LOST_POLLS:
+                self.workers_lost = True
+                del running[key]
+                self._lose(key, WorkerLostError('worker process %i died '
+                                                'while running the task' %
+                                                pid) )
+                done.add(key)
+
+
+    def run(self, pool=None):
+        """
+        Execute all tasks.  Tasks are dispatched in the order they were added
+        once their dependencies have finished successfully.  A task whose
+        dependency has failed or was skipped is skipped itself.  A task whose
+        worker process dies or whose result cannot be sent back is marked as
+        failed.
+
+        :param pool: worker pool providing apply_async(), e.g. a
+                     multiprocessing.Pool or ThreadPool; if None all tasks are
+                     run in the main process
+        :type pool: Pool
+        :returns: dictionary of results keyed by task key
+        :raises: TaskGraphError
+        """
+
+        pending = OrderedDict(self.tasks)
+        done = set()
+        running = OrderedDict()
+        gone = {}
+
+        # worker processes record which task they are running
+        if pool and not isinstance(pool, ThreadPool):
+            manager = multiprocessing.Manager()
+            started = manager.dict()
+        else:
+            manager = None
+            started = None
+
+        try:
+            while pending or running:
+                local = None
+
+                if running:
+                    self._collect(running, started, pool, gone, done)
+
+                for key, task in pending.items():
+                    bad = [d for d in task.deps
+                           if d in self.failed or d in self.skipped_tasks]
+
+                    if bad:
+                        del pending[key]
+                        self.skipped_tasks[key] = bad[0]
+
+                        if self.on_skipped:
+                            self.on_skipped(key, bad[0])
+
+                        continue
+
+                    if not all(d in done for d in task.deps) or \
+                           not all(d in done or d in self.skipped_tasks
+                                   for d in task.optional):
+                        continue
+
+                    args = task.args + tuple(self.results[d]
+                                             for d in task.deps) + \
+                           tuple(self.results.get(d) for d in task.optional)
+
+                    if task.local or not pool:
+                        if not local:
+                            local = (key, args)
+
+                        continue
+
+                    del pending[key]
+                    running[key] = pool.apply_async(_run_task,
+                                                    (task.func, args,
+                                                     started, key) )
+
+                if local:
+                    key, args = local
+                    del pending[key]
+
+                    self._finish(key, *_run_task(self.tasks[key].func,
+                                                 args) )
+                    done.add(key)
+
+                    continue
+
+                if not running:
+                    if pending:
+                        raise TaskGraphError('unresolvable dependencies for '
+                                             '%s' % ', '.join(str(k) for k
+                                                              in pending) )
+                    break
+
+                # wakes up early when the oldest task finishes
+                running.itervalues().next().wait(_POLL_INTERVAL)
+        finally:
+            if manager:
+                manager.shutdown()
+
+        return self.results
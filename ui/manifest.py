@@ -0,0 +1,173 @@
+#  Copyright (C) 2017  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r"""
+Build manifests for incremental rebuilds.  The fingerprint of all inputs of a
+build stage is stored in a small JSON file next to the artefact the stage
+creates.  The stage only needs to be rerun when the artefact is missing or
+the fingerprint of its current inputs differs from the stored one.
+Artefacts built before manifests were introduced are adopted as current.
+"""
+
+__revision__ = "$Id$"
+
+
+import os
+import json
+import hashlib
+
+
+
+MANIFEST_EXT = '.manifest'
+_BLOCK_SIZE = 1024 * 1024
+
+
+def _hash_file(filename, digest):
+    with open(filename, 'rb') as data:
+        while True:
+            block = data.read(_BLOCK_SIZE)
+
+            if not block:
+                break
+
+            digest.update(block)
+
+
+def hash_path(path):
+    """
+    Compute the SHA1 of a file or of all files below a directory.  The
+    relative file names are part of the hash of a directory.
+
+    :param path: file or directory name
+    :type path: str
+    :returns: hex digest or None if path does not exist
+    :rtype: str
+    """
+
+    if os.path.isfile(path):
+        digest = hashlib.sha1()
+        _hash_file(path, digest)
+
+        return digest.hexdigest()
+
+    if not os.path.isdir(path):
+        return None
+
+    digest = hashlib.sha1()
+
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+
+        for name in sorted(files):
+            filename = os.path.join(root, name)
+
+            if name.endswith(MANIFEST_EXT) or not os.path.isfile(filename):
+                continue
+
+            digest.update(os.path.relpath(filename, path) + '\0')
+            _hash_file(filename, digest)
+
+    return digest.hexdigest()
+
+
+def fingerprint(*items):
+    """
+    Compute the fingerprint of the inputs of a build stage.
+
+    :param items: JSON serialisable data, e.g. options, file hashes or the
+                  fingerprints of upstream stages
+    :returns: hex digest
+    :rtype: str
+    """
+
+    data = json.dumps(items, sort_keys=True, default=repr)
+
+    return hashlib.sha1(data).hexdigest()
+
+
+def _manifest_name(artefact):
+    return artefact.rstrip(os.sep) + MANIFEST_EXT
+
+
+def has_manifest(artefact):
+    """
+    Check if the fingerprint of an artefact has been recorded.
+
+    :param artefact: file or directory name of the artefact
+    :type artefact: str
+    :rtype: bool
+    """
+
+    return os.path.isfile(_manifest_name(artefact) )
+
+
+def is_current(artefact, fprint):
+    """
+    Check if an artefact exists and was built from inputs with the given
+    fingerprint.  An artefact without manifest was built before manifests
+    were introduced.  It is stamped with the current fingerprint and taken
+    as current.
+
+    :param artefact: file or directory name of the artefact
+    :type artefact: str
+    :param fprint: fingerprint of the current inputs
+    :type fprint: str
+    :rtype: bool
+    """
+
+    if not os.path.exists(artefact):
+        return False
+
+    if not has_manifest(artefact):
+        try:
+            stamp(artefact, fprint)
+        except (IOError, OSError):
+            pass
+
+        return True
+
+    try:
+        with open(_manifest_name(artefact), 'r') as manifest:
+            data = json.load(manifest)
+    except (IOError, ValueError):
+        return False
+
+    return data.get('fingerprint') == fprint
+
+
+def stamp(artefact, fprint):
+    """
+    Record the fingerprint of the inputs an artefact was built from.  The
+    manifest is replaced atomically so concurrent readers never see a partial
+    file.
+
+    :param artefact: file or directory name of the artefact
+    :type artefact: str
+    :param fprint: fingerprint of the inputs
+    :type fprint: str
+    """
+
+    filename = _manifest_name(artefact)
+    tmpname = '%s.%i' % (filename, os.getpid() )
+
+    with open(tmpname, 'w') as manifest:
+        json.dump({'artefact': os.path.basename(artefact.rstrip(os.sep) ),
+                   'fingerprint': fprint}, manifest)
+
+    os.rename(tmpname, filename)